@@ -0,0 +1,113 @@
+import html
+from datetime import datetime
+
+from PySide6.QtCore import Qt, Signal, QTimer, QSize
+from PySide6.QtGui import QPalette, QColor
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QLineEdit, QListWidget, QListWidgetItem, QLabel
+
+from services.chat_library import MATCH_START, MATCH_END
+
+
+class SearchPane(QWidget):
+    # Emits the session and the message position of the chosen result
+    result_chosen = Signal(int, int)
+    # Emitted from the library's search thread, the connection queues it to the pane
+    searched = Signal(str, object, float)
+
+    def __init__(self, library, parent=None):
+        super().__init__(parent)
+        self.library = library
+
+        self.search_edit = QLineEdit()
+        palette = self.search_edit.palette()
+        palette.setColor(QPalette.Highlight, QColor("#5bb481"))
+        self.search_edit.setPalette(palette)
+        self.search_edit.setPlaceholderText("Search all conversations")
+        self.search_edit.textChanged.connect(self.schedule_search)
+        self.search_edit.returnPressed.connect(self.run_search)
+
+        # Restarted on every keystroke, the library is queried once typing pauses
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.run_search)
+        self.searched.connect(self.show_results)
+
+        self.status_label = QLabel("")
+
+        self.result_list = QListWidget()
+        self.result_list.setVerticalScrollMode(QListWidget.ScrollPerPixel)
+        self.result_list.itemClicked.connect(self.on_result_clicked)
+        self.result_list.setStyleSheet("""
+                    QListWidget { background-color: transparent; border: none; }
+                    QListWidget::item { border-bottom: 1px solid #3a3a3a; padding: 4px; }
+                    QListWidget::item:selected, QListWidget::item:hover { background-color: #2b8451; }
+                    QScrollBar:vertical {
+                        border: none;
+                        background-color: transparent;
+                        width: 8px;
+                    }
+                    QScrollBar::handle:vertical {
+                        background-color: #599e5e;
+                        border-radius: 0px;
+                    }
+                    QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical {
+                        background: none;
+                    }
+                    """)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(5, 0, 5, 5)
+        layout.addWidget(self.search_edit)
+        layout.addWidget(self.status_label)
+        layout.addWidget(self.result_list)
+
+    def focus(self):
+        self.search_edit.setFocus()
+        self.search_edit.selectAll()
+
+    def schedule_search(self):
+        self.search_timer.start()
+
+    def run_search(self):
+        self.search_timer.stop()
+        text = self.search_edit.text()
+        if not text.strip():
+            self.result_list.clear()
+            self.status_label.setText("")
+            return
+        # Typing goes on while the library searches, a result for older text is never shown
+        self.library.search_later(text, self.searched.emit)
+
+    def show_results(self, text, results, elapsed):
+        if text != self.search_edit.text():
+            return
+        self.result_list.clear()
+        self.status_label.setText(f"<font color='#b3b7b7'>{len(results)} results in {elapsed * 1000:.0f} ms</font>")
+
+        # Room for the item padding and border of the stylesheet
+        width = self.result_list.viewport().width() - 10
+        for result in results:
+            item = QListWidgetItem()
+            item.setData(Qt.UserRole, (result['session'], result['position']))
+            if result['model']:
+                item.setToolTip(result['model'])
+            label = QLabel(self.format_result(result))
+            label.setWordWrap(True)
+            label.setAttribute(Qt.WA_TransparentForMouseEvents)
+            self.result_list.addItem(item)
+            item.setSizeHint(QSize(width, label.heightForWidth(width) + 10))
+            self.result_list.setItemWidget(item, label)
+
+    def format_result(self, result):
+        # The snippet is escaped first, the match markers are control characters escaping leaves alone
+        snippet = html.escape(result['snippet']).replace(MATCH_START, "<b><font color='#5bb481'>") \
+            .replace(MATCH_END, "</font></b>")
+        started = datetime.fromtimestamp(result['started']).strftime("%Y-%m-%d %H:%M") if result['started'] else ""
+        sender = f"{html.escape(result['sender'])}: " if result['sender'] else ""
+        return (f"<font color='#b3b7b7'>{html.escape(result['character'] or '')} · {started}</font><br>"
+                f"{sender}{snippet}")
+
+    def on_result_clicked(self, item):
+        session, position = item.data(Qt.UserRole)
+        self.result_chosen.emit(session, position)
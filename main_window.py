@@ -3,26 +3,36 @@ import re
 import sys
 from datetime import datetime
 
-import psutil
 import qtawesome as qta
-from PySide6.QtCore import Qt, QSize, Signal, QThread, QPoint
+from PySide6.QtCore import Qt, QSize, QPoint, QEvent, QTimer, Signal
 from PySide6.QtGui import (QColor, QFont, QPalette, QIcon)
-from PySide6.QtGui import (QStandardItemModel, QStandardItem)
 from PySide6.QtWidgets import (QApplication, QMainWindow, QListView, QVBoxLayout,
                                QWidget, QPushButton, QSplitter,
-                               QGridLayout, QAbstractItemView, QLabel, QHBoxLayout, QFileDialog)
+                               QGridLayout, QAbstractItemView, QLabel, QHBoxLayout, QFileDialog, QMessageBox)
 
 import services.completion as Server
 import services.settings_handler as Settings
+import services.tracing as tracing
 import services.windows_api_handler
 from components.custom_textedit import CustomTextEdit
 from components.custom_titlebar import CustomTitleBar
+from components.search_pane import SearchPane
 from downloader_window import DownloaderWindow
 from memory_window import MemoryWindow, MemoryManager
 from services.chat_bubble_delegate import ChatBubbleDelegate
-from services.completion import Worker as CompletionWorker
+from services.chat_history import ChatHistory
+from services.chat_library import ChatLibrary
+from services.chat_model import ChatModel
+from services.chat_store import ChatStore
+from services.cold_start import choose_load_strategy, Prefetcher, LoadHistory
+from services.context_manager import ContextManager, TokenCounter, estimate_tokens, MESSAGE_OVERHEAD
+from services.engine import get_engine, chat_job, call_job
+from services.http_client import close_client
 from services.locale_handler import get_iso_country_code, get_formatted_date_and_holiday
 from services.notification import show_notification
+from services.residency import ResidencyManager
+from services.resource_monitor import ResourceMonitor
+from services.telemetry import get_telemetry
 from services.translator import Translator
 from settings_window import SettingsWindow
 
@@ -31,29 +41,10 @@ from settings_window import SettingsWindow
 os.environ["QT_AUTO_SCREEN_SCALE_FACTOR"] = "1"
 
 
-class MemoryMonitorThread(QThread):
-    update_signal = Signal(str)
-
-    def __init__(self):
-        super().__init__()
-
-    def run(self):
-        while True:
-            available_memory_gb = psutil.virtual_memory().available / 1073741824
-            memory_usage_str = f"{available_memory_gb:.2f}GB"
-
-            cpu_usage = psutil.cpu_percent(interval=None)
-            cpu_usage_str = f"{cpu_usage}"
-
-            status_str = f"<font color='#b3b7b7'>CPU:</font> {cpu_usage_str}% <font color='#b3b7b7'> Free RAM:</font> {memory_usage_str}"
-            self.update_signal.emit(status_str)
-
-            self.sleep(1)
-
-            # TODO: how to monitor GPU and VRAM.... pynvml?
-
-
 class ChatWindow(QMainWindow):
+    # Emitted from the token counter's thread once estimated counts can be replaced by exact ones
+    tokens_counted = Signal()
+
     def __init__(self):
         super().__init__()
 
@@ -65,8 +56,6 @@ class ChatWindow(QMainWindow):
         self.is_server_running = False
 
         self.multi_paragraph_enabled = True  # Testing TODO
-        self.initial_state = None
-        self.previous_state = None
 
         self.setWindowTitle("Matcha Chat 2")
         self.setWindowFlags(Qt.Window | Qt.FramelessWindowHint | Qt.WindowSystemMenuHint | Qt.WindowMinimizeButtonHint
@@ -89,13 +78,49 @@ class ChatWindow(QMainWindow):
 
         self.move(int((screen_width - self.init_width) / 2), int((screen_height - self.init_height) / 2))
 
+        self.token_counter = TokenCounter()
+        self.token_counter.online = False
+        self.token_counter.counted = self.tokens_counted.emit
+        self.tokens_counted.connect(self.update_token_status)
+
+        self.residency = ResidencyManager()
+        self.residency.ready.connect(self.on_server_ready)
+        self.residency.crashed.connect(self.on_server_crashed)
+
+        # Chrome trace of the send-to-render pipeline, written to temp/ on quit
+        tracing.enable(Settings.load_settings()['trace'] == 1)
+
+        self.telemetry = get_telemetry()
+        self.telemetry.recorded.connect(self.on_perf_recorded)
+
+        # Warm the page cache while the UI starts so the first launch reads from RAM
+        self.load_plan = None
+        self.load_history = LoadHistory(os.path.join(Server.temp_dir, 'load_history.json'))
+        self.prefetcher = None
+        self.start_prefetch()
+
+        # Each resident model has its own, set when a model is activated
+        self.slot_cache = None
+        self.slot_key = None
+        self.slot_save_job = None
+        self.slot_restore_pending = False
+
+        # Created by the first init_chat and kept across reloads, the undo history points into it
+        self.context = None
+        self.history = None
+
         self.restore_shadow()
         self.init_ui()
         self.init_chat()
+        self.bind_library()
+        self.update_slot_key()
         self.init_thread()
-        self.save_init()
 
         self.memory_manager = None
+        self.engine = get_engine()
+        self.chat_job = None
+        self.memory_job = None
+        self.translation_job = None
 
         # self.update_translator_settings()
 
@@ -106,9 +131,6 @@ class ChatWindow(QMainWindow):
             print('init translator!')
             self.translator.init_translator()
 
-        self.messages = []
-        self.messages_prev = []
-
         self.raise_()
         self.activateWindow()
 
@@ -117,9 +139,21 @@ class ChatWindow(QMainWindow):
         self.layout.setContentsMargins(5, 0, 5, 0)
 
         self.chatListView = QListView()
-        self.model = QStandardItemModel()
+        # The last session is restored from its journal, older pages are read back as the view scrolls up
+        chat_dir = os.path.join(Server.temp_dir, 'chat')
+        self.chat_store = ChatStore(chat_dir, 'messages')
+        self.context_store = ChatStore(chat_dir, 'context')
+        # Every conversation is also kept in the searchable library, the journal only holds the open one
+        self.library = ChatLibrary(os.path.join(Server.temp_dir, 'library.db'))
+        self.model = ChatModel(self.chat_store)
         self.chatListView.setModel(self.model)
-        self.chatListView.setItemDelegate(ChatBubbleDelegate())
+        self.chatListView.setItemDelegate(
+            ChatBubbleDelegate(render_cache_mb=Settings.load_settings()['render_cache_mb']))
+        self.chatListView.verticalScrollBar().valueChanged.connect(self.on_chat_scrolled)
+        # Lay rows out in idle-time batches instead of all at once after every insert
+        self.chatListView.setLayoutMode(QListView.Batched)
+        self.scroll_pending = False
+        self.relayout_pending = False
 
         # Set fake smooth scrolling
         self.chatListView.setWordWrap(True)
@@ -130,8 +164,9 @@ class ChatWindow(QMainWindow):
 
         self.layout.addWidget(self.chatListView)
 
+    @tracing.traced("send_message", "ui")
     def send_message(self):
-        self.save_current()
+        self.history.begin_turn()
         try:
             user_input = self.inputText.toPlainText().strip()
             raw_input = user_input
@@ -139,12 +174,13 @@ class ChatWindow(QMainWindow):
             print("input: " + user_input)
 
             if self.in_translate:
-                user_input = self.translator.translate(text_input=user_input,
-                                                       source_lang=self.target,
-                                                       target_lang='en')
+                with tracing.span("translate_input", "translate"):
+                    user_input = self.translator.translate(text_input=user_input,
+                                                           source_lang=self.target,
+                                                           target_lang='en')
                 print("translated_input: " + user_input)
 
-            self.messages.append({"role": "user", "content": user_input})
+            self.context.append("user", user_input)
 
             if not self.out_translate:
                 raw_input = user_input
@@ -156,17 +192,44 @@ class ChatWindow(QMainWindow):
                 # if multiline
                 # text = user_input.replace(" *", "\n\n*")
                 segments = [segment for segment in raw_input.splitlines() if segment.strip()]
+                rows = []
                 for segment in segments:
                     if segment.startswith(f"{self.ai_name}:"):
                         segment = segment[len(f"{self.ai_name}:"):].strip()
                     # if>
-                    self.add_message(segment, self.user_color, "Right", self.user_name)
+                    rows.append((segment, self.user_color, "Right", self.user_name))
+                self.add_messages(rows)
 
-            model = "gpt-3.5-turbo"
+            self.history.begin_reply()
+            self.update_history_buttons()
+            self.submit_reply()
+        except Exception as e:
+            print(f"Error sending message: {e}")
 
-            self.worker = CompletionWorker(self.base_url, model, self.messages, self.temperature)
-            self.worker.finished.connect(self.on_response_received)
-            self.worker.start()
+    def submit_reply(self):
+        try:
+            self.stream_row = None
+            self.stream_text = ""
+
+            with tracing.span("context_fit", "ui"):
+                messages = self.context.fit(self.token_budget)
+                self.update_token_status()
+
+            self.chat_job = chat_job(messages, self.temperature, stream=self.stream, max_tokens=self.new_predict)
+            if self.slot_restore_pending:
+                self.slot_restore_pending = False
+                if self.slot_cache.has(self.slot_key):
+                    # Reload the saved KV state first so this character's prompt is not evaluated again
+                    restore_job = self.slot_cache.restore_job(self.slot_key)
+                    self.engine.submit(restore_job)
+                    self.chat_job.after = restore_job
+            self.chat_job.token_received.connect(self.on_token_received)
+            self.chat_job.finished.connect(self.on_response_received)
+            self.chat_job.failed.connect(self.on_response_failed)
+            tracing.begin("reply", self.chat_job, "reply", stream=self.stream)
+            self.engine.submit(self.chat_job)
+            self.stop_button.setEnabled(True)
+            self.thread.set_busy(True)
         except Exception as e:
             print(f"Error sending message: {e}")
 
@@ -189,11 +252,36 @@ class ChatWindow(QMainWindow):
         self.target = trans_settings['target']
         print(f'Saved! {self.in_translate}')
 
+    def on_token_received(self, token):
+        self.stream_text += token
+
+        text = self.stream_text.strip()
+        if text.startswith(f"{self.ai_name}:"):
+            text = text[len(f"{self.ai_name}:"):].strip()
+        if text == "":
+            return
+
+        # Grow a single bubble in place, it is replaced by the final segments once the reply is complete
+        self.model.set_stream(text, self.ai_color, "Left", self.ai_name)
+        if self.stream_row is None:
+            self.stream_row = self.model.rowCount() - 1
+            self.scroll_to_bottom()
+        else:
+            # The view does not resize a row on dataChanged, tokens in one tick share a single relayout
+            self.scroll_to_bottom(relayout=True)
+
+    @tracing.traced("on_response_received", "ui")
     def on_response_received(self, response, token_count):
         print(f"response: {response}\ntoken:{token_count}")
-        self.current_tokens_sum = token_count
+        if token_count >= 0:
+            self.current_tokens_sum = token_count
+        self.stop_button.setEnabled(False)
+        self.thread.set_busy(False)
+        tracing.end("reply", self.chat_job, "reply", tokens=token_count)
 
-        self.worker.quit()
+        if self.stream_row is not None:
+            self.model.clear_stream()
+            self.stream_row = None
 
         response_text = response
         if response_text.startswith(f"{self.ai_name}: "):
@@ -207,8 +295,11 @@ class ChatWindow(QMainWindow):
                 response_text = response_text[: -len(marker)]
                 break
 
-        self.messages_prev = self.messages
-        self.messages.append({"role": "assistant", "content": response_text})
+        # Stopped before anything was generated
+        if response_text.strip() == "":
+            return
+
+        self.context.append("assistant", response_text)
 
         # notification TODO: add a switch
         text_truncated = self.truncate_string(response_text, 64)
@@ -220,41 +311,72 @@ class ChatWindow(QMainWindow):
         text = text.replace("<br>", "\n\n*")
 
         if self.multi_paragraph_enabled is False:
-            if self.out_translate:
-                text = self.translator.translate(text_input=text,
-                                                 source_lang='en',
-                                                 target_lang=self.target)
-            self.add_message(text, self.ai_color, "Left", self.ai_name)
+            split_texts = [text]
+        else:
+            with tracing.span("split_long_text", "ui"):
+                text = text.replace(" *", "\n\n*")
+                segments = [segment for segment in text.splitlines() if segment.strip()]
+                split_texts = []
+                for segment in segments:
+                    if segment.startswith(f"{self.ai_name}: "):
+                        segment = segment[len(f"{self.ai_name}: "):].strip()
+                    if segment.startswith(f"{self.ai_name}:"):
+                        segment = segment[len(f"{self.ai_name}:"):].strip()
+
+                    split_texts.extend(self.split_long_text(segment, 150))
+
+        if self.out_translate:
+            # Translation runs on the engine's worker, bubbles are added when it is done
+            self.translation_job = call_job(self.translate_segments, split_texts)
+            self.translation_job.result.connect(self.add_ai_messages)
+            self.engine.submit(self.translation_job)
         else:
-            text = text.replace(" *", "\n\n*")
-            segments = [segment for segment in text.splitlines() if segment.strip()]
-            for segment in segments:
-                if segment.startswith(f"{self.ai_name}: "):
-                    segment = segment[len(f"{self.ai_name}: "):].strip()
-                if segment.startswith(f"{self.ai_name}:"):
-                    segment = segment[len(f"{self.ai_name}:"):].strip()
-
-                split_texts = self.split_long_text(segment, 150)
-                for split_text in split_texts:
-                    if self.out_translate:
-                        split_text = self.translator.translate(text_input=split_text,
-                                                               source_lang='en',
-                                                               target_lang=self.target)
-                    self.add_message(split_text, self.ai_color, "Left", self.ai_name)
-
-        self.token_status.setText(f"<font color='#b3b7b7'>Capacity:</font> {self.current_tokens_sum} <font "
-                                  f"color='#b3b7b7'>/ {self.tokes_limit}</font>")
+            self.add_ai_messages(split_texts)
+
+        self.update_token_status()
         print('Done generate.')
 
+    def on_response_failed(self, message):
+        # Nothing of the reply is kept, the user's message stays and can be sent again with regenerate
+        self.stop_button.setEnabled(False)
+        self.thread.set_busy(False)
+        tracing.end("reply", self.chat_job, "reply", error=message)
+        if self.stream_row is not None:
+            self.model.clear_stream()
+            self.stream_row = None
+        QMessageBox.warning(self, "Reply failed", f"The server could not answer: {message}")
+
+    def update_token_status(self):
+        self.context.fit(self.token_budget)
+        self.token_status.setText(f"<font color='#b3b7b7'>Capacity:</font> {self.context.fitted_tokens} <font "
+                                  f"color='#b3b7b7'>/ {self.token_budget}</font>")
+
+        stats = self.engine.stats()
+        self.token_status.setToolTip(f"Slots busy: {stats['busy']}/{stats['slots']}\n"
+                                     f"Queued: {stats['queued_interactive']} chat, "
+                                     f"{stats['queued_background']} background\n"
+                                     f"Average wait: {stats['wait_ms_interactive']:.0f} ms chat, "
+                                     f"{stats['wait_ms_background']:.0f} ms background")
+
+    @tracing.traced("translate_output", "translate")
+    def translate_segments(self, segments):
+        return [self.translator.translate(text_input=segment,
+                                          source_lang='en',
+                                          target_lang=self.target) for segment in segments]
+
+    @tracing.traced("add_ai_messages", "layout")
+    def add_ai_messages(self, segments):
+        self.add_messages([(segment, self.ai_color, "Left", self.ai_name) for segment in segments])
+
+    def stop_generation(self):
+        if self.chat_job is not None:
+            self.chat_job.cancel()
+
     def generate_memory_entry(self):
         chat_history = "\n"
-        for row in range(self.model.rowCount()):
-            item = self.model.item(row)
-            text = item.data(Qt.DisplayRole)
-            sender = item.data(Qt.UserRole)
-
-            if sender:
-                chat_history = chat_history + f'{sender}: {text}\n'
+        for message in self.model.serialize():
+            if message['sender']:
+                chat_history = chat_history + f"{message['sender']}: {message['text']}\n"
             else:
                 pass
 
@@ -273,13 +395,17 @@ class ChatWindow(QMainWindow):
             {"role": "user", "content": f"\n\nChat History:\n\n{chat_history}"},
         ]
 
-        self.worker = CompletionWorker(self.base_url, "gpt-3.5-turbo", messages, self.temperature)
-        self.worker.finished.connect(self.on_mem_entry_received)
-        self.worker.start()
+        self.memory_job = chat_job(messages, self.temperature, kind="summary")
+        self.memory_job.finished.connect(self.on_mem_entry_received)
+        self.memory_job.failed.connect(self.on_mem_entry_failed)
+        self.engine.submit(self.memory_job)
 
     def on_mem_entry_received(self):
         pass  # TODO
 
+    def on_mem_entry_failed(self, message):
+        QMessageBox.warning(self, "Summary failed", f"The server could not write the summary: {message}")
+
     def truncate_string(self, s, max_length):
         if len(s) <= max_length:
             return s
@@ -295,6 +421,7 @@ class ChatWindow(QMainWindow):
 
     def open_settings_window(self):
         self.setting_window = SettingsWindow(parent=self)
+        self.setting_window.model_changed.connect(self.switch_model)
         self.setting_window.show()
 
     def open_memory_window(self):
@@ -303,46 +430,149 @@ class ChatWindow(QMainWindow):
         self.memory_window = MemoryWindow(parent=self, _memory_manager=self.memory_manager)
         self.memory_window.show()
 
-    def save_init(self):
-        self.initial_state = self.serialize_model()
-
-    def save_current(self):
-        self.previous_state = self.serialize_model()
+    def discard_generation(self):
+        # The reply and its translation are dropped together, either would otherwise still add bubbles
+        if self.chat_job is not None:
+            self.chat_job.token_received.disconnect(self.on_token_received)
+            self.chat_job.finished.disconnect(self.on_response_received)
+            self.chat_job.failed.disconnect(self.on_response_failed)
+            self.chat_job.cancel()
+            self.chat_job = None
+        if self.translation_job is not None:
+            self.translation_job.result.disconnect(self.add_ai_messages)
+            self.translation_job.cancel()
+            self.translation_job = None
+        self.stop_button.setEnabled(False)
+        self.thread.set_busy(False)
+        self.stream_row = None
 
     def reset(self):
-        if self.initial_state is not None:
-            self.deserialize_model(self.initial_state)
-
+        self.discard_generation()
+        # The finished conversation stays in the library, the next one gets a session of its own
+        self.unbind_library()
+        self.model.truncate(0)
+        self.context_store.truncate(0)
+        self.history.clear()
+        # Started before the reload so the server's KV state is saved under the finished conversation's key
+        session = self.library.start_session(self.ai_name, self.user_name, self.active_model_name())
+        self.reload_chat()
+        self.bind_library(session)
+
+    # Picks up changed prompt settings, the conversation itself is kept
+    def reload_chat(self):
+        previous_key = self.slot_key
+        self.save_slot()
         self.init_chat()
-        self.inputText.setEnabled(True)
-
-        self.messages_prev = []
+        self.inputText.setEnabled(self.residency.is_ready())
+        if self.slot_key != previous_key:
+            self.slot_restore_pending = True
+
+    def update_slot_key(self):
+        # The saved KV state belongs to one conversation of the library, under the prompt it was computed with
+        session = self.library.current
+        self.slot_key = f"{session.id if session is not None else ''}\n{self.ai_name}\n{self.sys_prompt}"
+
+    def bind_library(self, session=None):
+        # The open conversation goes on in its library session, both stores copied over again if they disagree
+        if session is None:
+            session = self.library.current
+        if session is None:
+            session = self.library.start_session(self.ai_name, self.user_name, self.active_model_name())
+        if self.library.count(session.id) != len(self.chat_store):
+            session.truncate(0)
+            session.extend(0, self.chat_store.read(0, len(self.chat_store)))
+        if self.library.context_count(session.id) != len(self.context_store):
+            session.context.truncate(0)
+            session.context.extend(0, self.context_store.read(0, len(self.context_store)))
+        self.chat_store.mirror = session
+        self.context_store.mirror = session.context
+
+    def unbind_library(self):
+        self.chat_store.mirror = None
+        self.context_store.mirror = None
+
+    def active_model_name(self):
+        return self.residency.active.name if self.residency.active else None
+
+    def toggle_search_pane(self):
+        self.search_pane.setVisible(not self.search_pane.isVisible())
+        if self.search_pane.isVisible():
+            self.search_pane.focus()
+
+    def open_search_result(self, session_id, position):
+        self.discard_generation()
+        if session_id != self.chat_store.mirror.id:
+            rows = self.library.read(session_id)
+            entries = self.library.read_context(session_id)
+            if not entries:
+                # Sessions from before the library kept the context, rebuilt from the bubbles as well as it goes;
+                # consecutive bubbles of one side were one message in the context
+                for row in rows:
+                    if row['role'] == 'system':
+                        continue
+                    if entries and entries[-1]['role'] == row['role']:
+                        entries[-1]['content'] += "\n" + row['text']
+                    else:
+                        entries.append({'role': row['role'], 'content': row['text']})
+                for entry in entries:
+                    entry['tokens'] = estimate_tokens(entry['content']) + MESSAGE_OVERHEAD
+
+            # Loading the other conversation must not be mirrored back into the library
+            self.unbind_library()
+            self.model.load(rows)
+            self.context_store.replace(entries)
+            self.bind_library(self.library.open_session(session_id))
+            self.history.clear()
+            self.reload_chat()
+
+        row = self.model.show_around(position)
+        if row < self.model.rowCount():
+            self.chatListView.doItemsLayout()
+            self.chatListView.scrollTo(self.model.index(row, 0), QAbstractItemView.ScrollHint.PositionAtCenter)
+
+    def save_slot(self):
+        if not self.is_server_running:
+            return
+        self.slot_save_job = self.slot_cache.save_job(self.slot_key)
+        self.slot_save_job.after = self.chat_job
+        self.engine.submit(self.slot_save_job)
+
+    def wait_slot_save(self, timeout=5.0):
+        if self.slot_save_job is not None and self.slot_save_job.future is not None:
+            try:
+                self.slot_save_job.future.result(timeout)
+            except Exception as e:
+                print(f"Slot save did not finish: {e}")
+
+    def update_history_buttons(self):
+        self.undo_button.setEnabled(self.history.can_undo())
+        self.redo_button.setEnabled(self.history.can_redo())
+        self.regenerate_button.setEnabled(self.history.can_regenerate())
 
     def undo(self):
-        if self.previous_state is not None:
-            self.deserialize_model(self.previous_state)
+        self.discard_generation()
+        self.history.undo()
+        self.update_history_buttons()
         self.scroll_to_bottom()
-        self.inputText.setEnabled(True)
-        self.messages = self.messages_prev
-
-    def serialize_model(self):
-        data = []
-        for row in range(self.model.rowCount()):
-            item = self.model.item(row)
-            data.append({
-                'text': item.data(Qt.DisplayRole),
-                'color': item.data(Qt.BackgroundRole),
-                'alignment': item.data(Qt.TextAlignmentRole),
-                'sender': item.data(Qt.UserRole)
-            })
-        return data
-
-    def deserialize_model(self, data):
-        self.model.clear()
-        for item_data in data:
-            self.add_message(item_data['text'], QColor(item_data['color']), item_data['alignment'], item_data['sender'])
+        self.inputText.setEnabled(self.residency.is_ready())
+        self.update_token_status()
 
+    def redo(self):
+        self.discard_generation()
+        self.history.redo()
+        self.update_history_buttons()
+        self.scroll_to_bottom()
+        self.update_token_status()
+
+    def regenerate(self):
+        if not self.residency.is_ready():
+            return
+        self.discard_generation()
+        if not self.history.regenerate():
+            return
+        self.update_history_buttons()
         self.scroll_to_bottom()
+        self.submit_reply()
 
     def init_ui(self):
         self.mainSplitter = QSplitter(Qt.Horizontal)
@@ -379,6 +609,14 @@ class ChatWindow(QMainWindow):
         bottom_hbox = QHBoxLayout()
         self.status_bar = QLabel('Loading...')
         bottom_hbox.addWidget(self.status_bar)
+        self.perf_status = QLabel("")
+        self.perf_status.setCursor(Qt.PointingHandCursor)
+        self.perf_status.mousePressEvent = self.export_telemetry
+        bottom_hbox.addWidget(self.perf_status)
+        bottom_hbox.addStretch()
+        self.server_status = QLabel("")
+        self.residency.status_changed.connect(self.server_status.setText)
+        bottom_hbox.addWidget(self.server_status)
         bottom_hbox.addStretch()
         token_status_str = f"<font color='#b3b7b7'>Capacity:</font> Halt"
         self.token_status = QLabel(token_status_str)
@@ -394,27 +632,65 @@ class ChatWindow(QMainWindow):
         self.gridLayout.setRowStretch(2, 1)
         self.gridLayout.setRowStretch(3, 0)
 
+        self.search_pane = SearchPane(self.library)
+        self.search_pane.result_chosen.connect(self.open_search_result)
+        self.search_pane.hide()
+
         # Set R&L layouts
         self.mainSplitter.addWidget(self.leftWidget)
+        self.mainSplitter.addWidget(self.search_pane)
 
         self.setCentralWidget(self.mainSplitter)
 
     def init_thread(self):
-        self.thread = MemoryMonitorThread()
+        self.thread = ResourceMonitor()
+        self.thread.pid_source = lambda: self.residency.active.supervisor.pid if self.residency.active else None
+        self.thread.context_source = lambda: self.context.fitted_tokens
         self.thread.update_signal.connect(self.update_memory_usage)
         self.thread.start()
 
     def update_memory_usage(self, memory_usage_str):
         self.status_bar.setText(memory_usage_str)
+        tooltip = []
+        for name, label in (('server', "Server"), ('app', "Matcha Chat + translator")):
+            sample = self.thread.latest(name)
+            if sample is not None:
+                tooltip.append(f"{label}: {sample['rss'] / 1048576:.0f} MB RSS, {sample['cpu']:.0f}% CPU, "
+                               f"{sample['threads']} threads, {sample['faults']} page faults")
+        self.status_bar.setToolTip("\n".join(tooltip))
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.WindowStateChange:
+            # Poll slowly while minimized
+            self.thread.set_visible(not self.isMinimized())
+        super().changeEvent(event)
+
+    def on_perf_recorded(self, record):
+        self.perf_status.setText(f"<font color='#b3b7b7'>Gen:</font> {record['gen_tps']:.1f}t/s "
+                                 f"<font color='#b3b7b7'>Prompt:</font> {record['prompt_ms_per_token']:.1f}ms/t "
+                                 f"<font color='#b3b7b7'>Cached:</font> {record['cached_tokens']}/"
+                                 f"{record['prompt_tokens']}")
+        summary = self.telemetry.summary()
+        if summary is not None:
+            self.perf_status.setToolTip(f"Last {summary['replies']} replies on {record['model']}:\n"
+                                        f"{summary['gen_tps']:.1f} tokens/s generation\n"
+                                        f"{summary['prompt_ms_per_token']:.1f} ms/token prompt eval\n"
+                                        f"{summary['cached_ratio']:.0%} of prompt tokens from cache\n\n"
+                                        f"Click to export as CSV")
+
+    def export_telemetry(self, event):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export performance log", "performance.csv",
+                                                   "CSV file (*.csv);;All files (*)")
+        if file_path:
+            self.telemetry.export_csv(file_path)
 
     # Blank sender for sys/env message maybe...?
     def add_message(self, text, color, alignment, sender=None):
-        item = QStandardItem()
-        item.setData(text, Qt.DisplayRole)
-        item.setData(color, Qt.BackgroundRole)
-        item.setData(alignment, Qt.TextAlignmentRole)
-        item.setData(sender, Qt.UserRole)
-        self.model.appendRow(item)
+        self.add_messages([(text, color, alignment, sender)])
+
+    # Rows of (text, color, alignment, sender) go into the model as one insert
+    def add_messages(self, rows):
+        self.model.extend(rows)
         self.scroll_to_bottom()
 
     def export_chat_history_to_html(self):
@@ -449,12 +725,11 @@ class ChatWindow(QMainWindow):
                 </head>
                 <body>
                     <h1>Chat History</h1>\n''')
-                for row in range(self.model.rowCount()):
-                    item = self.model.item(row)
-                    text = item.data(Qt.DisplayRole)
-                    color = item.data(Qt.BackgroundRole)
-                    alignment = item.data(Qt.TextAlignmentRole)
-                    sender = item.data(Qt.UserRole)
+                for message in self.model.serialize():
+                    text = message['text']
+                    color = message['color']
+                    alignment = message['alignment']
+                    sender = message['sender']
 
                     if alignment == 'Left':
                         align = 'left'
@@ -478,11 +753,42 @@ class ChatWindow(QMainWindow):
         self.windowEffect = services.windows_api_handler.WindowEffect()
         self.windowEffect.setAcrylicEffect(int(self.winId()), gradientColor='00101080')
 
-    def scroll_to_bottom(self):
+    def scroll_to_bottom(self, relayout=False):
+        # scrollTo forces the pending layout, so every call in one event loop tick is folded into one
+        self.relayout_pending = self.relayout_pending or relayout
+        if not self.scroll_pending:
+            self.scroll_pending = True
+            QTimer.singleShot(0, self.flush_scroll)
+
+    def flush_scroll(self):
+        self.scroll_pending = False
+        if not self.model.at_latest():
+            self.model.show_latest()
+        if self.relayout_pending:
+            self.relayout_pending = False
+            self.chatListView.doItemsLayout()
         if self.model.rowCount() > 0:
             lastIndex = self.model.index(self.model.rowCount() - 1, 0)
             self.chatListView.scrollTo(lastIndex, QAbstractItemView.ScrollHint.EnsureVisible)
 
+    def on_chat_scrolled(self, value):
+        bar = self.chatListView.verticalScrollBar()
+        if value <= bar.minimum() + bar.pageStep() // 2 and self.model.has_older():
+            # Keep the first visible bubble where it is while a page is inserted above it
+            anchor = self.chatListView.indexAt(QPoint(0, 0))
+            top = self.chatListView.visualRect(anchor).top()
+            inserted = self.model.load_older()
+            self.chatListView.doItemsLayout()
+            rect = self.chatListView.visualRect(self.model.index(anchor.row() + inserted, 0))
+            bar.setValue(bar.value() + rect.top() - top)
+        elif value >= bar.maximum() - bar.pageStep() // 2 and not self.model.at_latest():
+            anchor = self.chatListView.indexAt(QPoint(0, 0))
+            top = self.chatListView.visualRect(anchor).top()
+            evicted = self.model.load_newer()
+            self.chatListView.doItemsLayout()
+            rect = self.chatListView.visualRect(self.model.index(anchor.row() - evicted, 0))
+            bar.setValue(bar.value() + rect.top() - top)
+
     def init_toolbar(self):
         self.record_button = QPushButton()
         self.record_button.setIcon(qta.icon('fa5s.microphone'))
@@ -515,6 +821,24 @@ class ChatWindow(QMainWindow):
         self.undo_button.clicked.connect(self.undo)
         self.undo_button.setToolTip("Undo last sent message.")
 
+        self.redo_button = QPushButton()
+        self.redo_button.setIcon(qta.icon('fa5s.redo', color='lightgray'))
+        self.redo_button.setIconSize(QSize(16, 16))
+        self.redo_button.clicked.connect(self.redo)
+        self.redo_button.setToolTip("Redo the last undone message.")
+
+        self.regenerate_button = QPushButton()
+        self.regenerate_button.setIcon(qta.icon('fa5s.sync-alt', color='lightgray'))
+        self.regenerate_button.setIconSize(QSize(16, 16))
+        self.regenerate_button.clicked.connect(self.regenerate)
+        self.regenerate_button.setToolTip("Generate the last reply again.")
+
+        self.search_button = QPushButton()
+        self.search_button.setIcon(qta.icon('fa5s.search', color='lightgray'))
+        self.search_button.setIconSize(QSize(16, 16))
+        self.search_button.clicked.connect(self.toggle_search_pane)
+        self.search_button.setToolTip("Search all conversations.")
+
         self.delete_button = QPushButton()
         self.delete_button.setIcon(qta.icon('fa5s.trash', color='lightgray'))
         self.delete_button.setIconSize(QSize(18, 18))
@@ -539,6 +863,13 @@ class ChatWindow(QMainWindow):
         self.server_button.setToolTip("Launch or stop the llama.cpp server.")
         self.server_button.clicked.connect(self.launch_or_stop_server)
 
+        self.stop_button = QPushButton()
+        self.stop_button.setIcon(qta.icon('fa5s.stop-circle', color='lightgray'))
+        self.stop_button.setIconSize(QSize(18, 18))
+        self.stop_button.setToolTip("Stop generating, keep the reply so far.")
+        self.stop_button.clicked.connect(self.stop_generation)
+        self.stop_button.setEnabled(False)
+
         self.add_mem_button = QPushButton()
         self.add_mem_button.setIcon(qta.icon('fa5s.save', color='lightgray'))
         self.add_mem_button.setIconSize(QSize(20, 20))
@@ -546,9 +877,10 @@ class ChatWindow(QMainWindow):
         self.add_mem_button.clicked.connect(self.generate_memory_entry)
 
         for widget in [self.record_button, self.photo_button, download_button,
-                       self.undo_button, self.delete_button, self.mem_button, self.add_mem_button,
+                       self.undo_button, self.redo_button, self.regenerate_button, self.search_button, self.delete_button,
+                       self.mem_button, self.add_mem_button,
                        "Stretch",
-                       self.server_button, self.model_list_button, settings_button
+                       self.stop_button, self.server_button, self.model_list_button, settings_button
                        ]:
             if widget == "Stretch":
                 self.toolBar.addStretch()
@@ -557,18 +889,97 @@ class ChatWindow(QMainWindow):
                 self.toolBar.addWidget(widget)
 
     def launch_or_stop_server(self):
-        self.reset()
-        self.init_chat()
+        self.discard_generation()
+        self.reload_chat()
         if self.is_server_running:
             self.server_button.setIcon(qta.icon('fa5s.play', color='#fd879a'))
-            Server.kill()
+            self.wait_slot_save()
+            self.residency.stop_all()
             self.is_server_running = False
+            self.token_counter.online = False
             self.inputText.setEnabled(False)
+            self.server_status.setText("")
         else:
-            Server.boot()
+            self.activate_model(Server.selected_model_path())
             self.server_button.setIcon(qta.icon('fa5s.stop', color='lightgray'))
             self.is_server_running = True
-            self.inputText.setEnabled(True)
+
+    def activate_model(self, model_path):
+        if model_path not in self.residency.residents:
+            self.load_plan = choose_load_strategy(model_path, Server.model_settings(model_path))
+            print(f"Load strategy: {self.load_plan['strategy']} ({self.load_plan['reason']})")
+        resident = self.residency.activate(model_path)
+        self.telemetry.set_source(resident.name, resident.supervisor.log_path)
+        self.chat_store.mirror.describe(self.ai_name, self.user_name, resident.name)
+        self.slot_cache = resident.slot_cache
+        self.slot_restore_pending = True
+        # Token counts depend on the model's vocabulary
+        self.token_counter.clear()
+        self.token_counter.online = resident.supervisor.is_ready
+        # Otherwise input is enabled once /health reports the model is loaded
+        self.inputText.setEnabled(resident.supervisor.is_ready)
+        self.context.invalidate()
+        if resident.supervisor.is_ready:
+            self.update_token_status()
+
+    def switch_model(self, filename):
+        model_path = os.path.join(Server.models_dir, filename)
+        if not self.is_server_running or self.residency.active is None or \
+                self.residency.active.model_path == model_path:
+            return
+        self.discard_generation()
+        self.save_slot()
+        self.wait_slot_save()
+        self.activate_model(model_path)
+
+    def start_prefetch(self):
+        settings = Settings.load_settings()
+        model_path = Server.selected_model_path()
+        if not settings['prefetch'] or not os.path.exists(model_path):
+            return
+        if choose_load_strategy(model_path, settings)['prefetch']:
+            self.prefetcher = Prefetcher(model_path)
+            self.prefetcher.start()
+
+    def on_server_ready(self, seconds):
+        self.token_counter.online = True
+        self.inputText.setEnabled(True)
+
+        strategy = self.load_plan['strategy'] if self.load_plan else 'mmap'
+        prefetched = self.prefetcher is not None and self.prefetcher.seconds is not None
+        resident = self.residency.active
+        entry = self.load_history.record(resident.model_path, strategy, seconds, resident.supervisor.log_path,
+                                         prefetched)
+        self.context.invalidate()
+        self.update_token_status()
+        self.server_status.setText(f"<font color='#b3b7b7'>Model ready in</font> {seconds:.1f}s")
+        self.server_status.setToolTip(f"Load strategy: {strategy}"
+                                      + (f", model load {entry['load_seconds']:.1f}s" if entry['load_seconds'] else "")
+                                      + (", page cache prefetched" if prefetched else ""))
+
+    def on_server_crashed(self, code):
+        self.token_counter.online = False
+        self.inputText.setEnabled(False)
+        self.slot_restore_pending = True
+
+    def on_quit(self):
+        print('Server shutdown.')
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.residency.stop_all()
+        self.telemetry.close()
+        self.thread.stop()
+        self.thread.wait(1000)
+        self.engine.shutdown()
+        self.chat_store.close()
+        self.context_store.close()
+        self.library.close()
+        if tracing.is_enabled():
+            trace_path = os.path.join(Server.temp_dir, f"trace-{datetime.now():%Y%m%d-%H%M%S}.json")
+            print(f"Trace: {tracing.dump(trace_path)} events written to {trace_path}")
+        # The servers were asked to exit first and have been shutting down alongside the rest
+        self.residency.wait_stopped()
+        close_client()
 
     def init_chat(self):
         self.update_translator_settings()
@@ -581,25 +992,46 @@ class ChatWindow(QMainWindow):
         self.ai_color = "#8dd4f4"
         self.user_name = prompt_settings["user_name"]
         self.ai_name = prompt_settings["ai_name"]
-        self.base_url = "http://localhost:35634/v1/chat/completions"
         self.sys_prompt = prompt_settings["sys_prompt"]
+        self.update_slot_key()
 
         iso_code = get_iso_country_code()
         date, holiday = get_formatted_date_and_holiday(iso_code)
         current_time = datetime.now().strftime("%I:%M %p")
         if holiday != "":
-            self.sys_prompt_mod = self.sys_prompt + f" [Conversation Start time: {current_time}, Date: {date}, Holiday: {holiday}]"
+            self.session_note = f"[Conversation Start time: {current_time}, Date: {date}, Holiday: {holiday}]"
         else:
-            self.sys_prompt_mod = self.sys_prompt + f" [Conversation Start time: {current_time}, Date: {date}]"
-
-        self.messages = [
-            {"role": "system",
-             "content": str(self.sys_prompt_mod)},
-        ]
+            self.session_note = f"[Conversation Start time: {current_time}, Date: {date}]"
+
+        if self.context is None:
+            self.context = ContextManager(counter=self.token_counter, store=self.context_store)
+            # Undo points are positions in the message store and the context
+            self.history = ChatHistory(self.model, self.context)
+        context_settings = Settings.load_context_settings()
+        self.context.pin_system = context_settings['pin_system'] == 1
+        self.context.drop_oldest = context_settings['drop_oldest'] == 1
+        self.context.keep_turns = context_settings['keep_turns']
+        # The system prompt is sent byte-identical every session so llama.cpp can reuse its cached prefix
+        self.context.resume(str(self.sys_prompt))
+        self.context.set_volatile(self.session_note)
+        self.update_history_buttons()
 
         self.current_tokens_sum = 0
         self.tokes_limit = int(settings["capacity"])
+        self.new_predict = int(settings["new_predict"])
+        # Room left for the prompt once the reply is reserved, unlimited replies reserve a quarter
+        reserve = self.new_predict if self.new_predict > 0 else self.tokes_limit // 4
+        self.token_budget = self.tokes_limit - reserve
         self.temperature = float(settings["temperature"])
+        self.stream = settings["stream"] == 1
+        self.stream_row = None
+        self.stream_text = ""
+
+    def closeEvent(self, event):
+        if self.is_server_running:
+            self.save_slot()
+            self.wait_slot_save()
+        super().closeEvent(event)
 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
@@ -626,11 +1058,6 @@ class ChatWindow(QMainWindow):
                 pos.y() < margin or pos.y() > self.height() - margin)
 
 
-def on_close():
-    print('Server shutdown.')
-    Server.kill()
-
-
 if __name__ == '__main__':
     app = QApplication(sys.argv + ['-platform', 'windows:darkmode=2'])
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
@@ -642,7 +1069,7 @@ if __name__ == '__main__':
     mainFont = QFont("Segoe UI")
     app.setFont(QFont(mainFont))
 
-    app.aboutToQuit.connect(on_close)
     window = ChatWindow()
+    app.aboutToQuit.connect(window.on_quit)
     window.show()
     sys.exit(app.exec())
@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+
+import psutil
+import requests
+from PySide6.QtCore import QObject, Signal
+
+import services.completion as Server
+import services.settings_handler as Settings
+from services.http_client import get_client
+from services.server_supervisor import ServerSupervisor
+
+TUNE_PORT = Server.SERVER_PORT + 1
+BATCH_CANDIDATES = [128, 256, 512, 1024]
+
+# A typical turn: the new part of the prompt plus a short reply
+TURN_PROMPT_TOKENS = 512
+TURN_PREDICT_TOKENS = 128
+
+PROBE_PROMPT = "The quick brown fox jumps over the lazy dog. " * 48
+PROBE_PREDICT = 32
+
+
+def thread_candidates():
+    physical = psutil.cpu_count(logical=False) or 1
+    logical = psutil.cpu_count() or physical
+    return sorted({max(1, physical // 2), max(1, physical - 1), physical, logical})
+
+
+def gpu_layer_candidates(info, current):
+    # A build without GPU offload ignores -ngl, there is nothing to search
+    if not Server.gpu_backend():
+        return [current]
+    if not info or not info['layers']:
+        return sorted({0, current // 2, current, 99})
+    # A quarter of the blocks at a time, the last one also offloads the output layer
+    layers = info['layers']
+    return sorted({0, layers // 4, layers // 2, layers * 3 // 4, layers + 1})
+
+
+def turn_seconds(result):
+    return (TURN_PROMPT_TOKENS / max(result['prompt_tps'], 1e-6)
+            + TURN_PREDICT_TOKENS / max(result['gen_tps'], 1e-6))
+
+
+class AutoTuner(QObject):
+    progress = Signal(str)
+    finished = Signal(object)
+    failed = Signal(str)
+
+    def __init__(self, model_path, settings=None, info=None, port=TUNE_PORT):
+        super().__init__()
+        self.model_path = model_path
+        self.info = info
+        self.settings = settings if settings is not None else Settings.load_settings()
+        self.port = port
+        self.thread = None
+        self.cancel_event = threading.Event()
+        self.supervisor = None
+        self.results = []
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.cancel_event.clear()
+        self.thread = threading.Thread(target=self._run, name="auto-tune", daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+        supervisor = self.supervisor
+        if supervisor is not None:
+            supervisor.stop()
+
+    def _run(self):
+        if self._main_server_running():
+            self.failed.emit("Stop the chat server before tuning, both copies of the model won't fit in RAM.")
+            return
+
+        # Coordinate search: GPU layers first since they change everything else, then threads, then batch
+        best = {'threads': self.settings['threads'], 'batch': self.settings['batch'],
+                'gpu_layers': self.settings['gpu_layers']}
+        best_result = None
+        for key, candidates in (('gpu_layers', gpu_layer_candidates(self.info, best['gpu_layers'])),
+                                ('threads', thread_candidates()),
+                                ('batch', BATCH_CANDIDATES)):
+            for value in candidates:
+                if self.cancel_event.is_set():
+                    return
+                trial = dict(best, **{key: value})
+                if any(all(measured[k] == trial[k] for k in trial) for measured in self.results):
+                    continue
+                result = self._probe(trial)
+                if result is None:
+                    continue
+                self.results.append(dict(trial, **result))
+                if best_result is None or turn_seconds(result) < turn_seconds(best_result):
+                    best, best_result = trial, result
+
+        if best_result is None:
+            self.failed.emit("No configuration could be measured, see the tuning log.")
+            return
+
+        tuned = dict(best, **best_result)
+        Settings.save_tuned_settings(os.path.basename(self.model_path), tuned)
+        self.finished.emit(tuned)
+
+    def _main_server_running(self):
+        try:
+            get_client().get(f"http://127.0.0.1:{Server.SERVER_PORT}/health", timeout=0.5)
+            return True
+        except requests.RequestException:
+            return False
+
+    def _probe(self, trial):
+        label = f"-t {trial['threads']} -b {trial['batch']} -ngl {trial['gpu_layers']}"
+        self.progress.emit(f"Probing {label}...")
+
+        settings = dict(self.settings, **trial)
+        # One slot and no draft model, the probe should only measure the main model
+        settings['parallel'] = 1
+        self.supervisor = ServerSupervisor(port=self.port, log_path=os.path.join(Server.temp_dir, 'tune_output.log'),
+                                           max_restarts=0)
+        self.supervisor.command_factory = lambda: Server.build_command(self.port, self.model_path, settings,
+                                                                       draft_path="")
+        self.supervisor.start()
+        try:
+            while not self.supervisor.is_ready:
+                if self.cancel_event.is_set() or not self.supervisor.thread or not self.supervisor.thread.is_alive():
+                    print(f"Tune: {label} failed to load")
+                    return None
+                time.sleep(0.1)
+
+            url = f"http://127.0.0.1:{self.port}/completion"
+            payload = {"prompt": PROBE_PROMPT, "n_predict": PROBE_PREDICT, "cache_prompt": False,
+                       "temperature": 0.0}
+            client = get_client()
+            # First request warms up the compute buffers
+            client.post_json(url, dict(payload, n_predict=1))
+            timings = client.post_json(url, payload)['timings']
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"Tune: {label} probe failed: {e}")
+            return None
+        finally:
+            # The next probe uses the same port
+            self.supervisor.stop()
+            self.supervisor.wait()
+            self.supervisor = None
+
+        result = {'prompt_tps': round(timings['prompt_per_second'], 1),
+                  'gen_tps': round(timings['predicted_per_second'], 1)}
+        self.progress.emit(f"{label}: {result['prompt_tps']} prompt tok/s, {result['gen_tps']} gen tok/s")
+        return result
@@ -1,51 +1,166 @@
-from PySide6.QtCore import Qt, QRectF, QSize
-from PySide6.QtGui import QPainter, QFont, QFontMetrics, QPainterPath, QBrush, QColor, QPen
+import math
+from collections import OrderedDict
+
+from PySide6.QtCore import Qt, QRectF, QSize, QPointF
+from PySide6.QtGui import (QPainter, QFont, QFontMetrics, QPainterPath, QBrush, QColor, QPen, QPixmap, QTextLayout,
+                           QTextOption)
 from PySide6.QtWidgets import QStyledItemDelegate
 
+from services.chat_model import (DISPLAY_ROLE, BACKGROUND_ROLE, ALIGNMENT_ROLE, SENDER_ROLE, MESSAGE_ID_ROLE,
+                                 STREAMING_ROLE)
+
+# Widths are rounded down to this many pixels, a resize within a bucket reuses the cached layouts
+WIDTH_BUCKET = 8
+
+SHADOW_OFFSET = 3
+
+SENDER_FLAGS = Qt.AlignLeft | Qt.AlignVCenter
+ANTIALIASING = QPainter.Antialiasing
+
+
+class BubbleLayout:
+    __slots__ = ('key', 'text_layout', 'bubble_width', 'bubble_height', 'sender', 'sender_width', 'max_width')
+
 
 class ChatBubbleDelegate(QStyledItemDelegate):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, cache_size=4096, render_cache_mb=0):
         super().__init__(parent)
         self.vertical_spacing = 10
         self.horizontal_padding = 20
         self.vertical_padding = 10  # Adjusted inside bubble
         self.sender_height = 20
 
+        self.font = QFont("Segoe UI", 12)
+        self.fm = QFontMetrics(self.font)
+        self.text_option = QTextOption()
+        self.text_option.setWrapMode(QTextOption.WordWrap)
+        self.shadow_brush = QBrush(QColor(0, 0, 0, 32))
+        self.sender_pen = QPen(Qt.white)
+        self.text_pen = QPen(Qt.black)
+
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # Rasterized bubbles, blitted instead of redrawing paths and antialiased text on every scroll
+        self.render_budget = render_cache_mb * 1024 * 1024
+        self.pixmaps = OrderedDict()
+        self.pixmap_bytes = 0
+
+    def layout(self, index, width):
+        # The view asks with a zero width before its first layout, so the bucket is part of the key instead of
+        # clearing the cache on every change; layouts of an old width stop being hit and fall out of the LRU
+        bucket = int(width) - int(width) % WIDTH_BUCKET
+
+        model = index.model()
+        text = model.data(index, DISPLAY_ROLE)
+        alignment = model.data(index, ALIGNMENT_ROLE)
+        sender = model.data(index, SENDER_ROLE)
+        key = (model.data(index, MESSAGE_ID_ROLE), hash(text), sender, alignment, bucket)
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return cached
+        self.misses += 1
+
+        cached = BubbleLayout()
+        cached.key = key
+        cached.max_width = bucket * 0.75
+        cached.sender = " " + sender if alignment == 'Left' else sender + " "
+        cached.sender_width = self.fm.horizontalAdvance(cached.sender)
+
+        # Wrap once and keep the lines, drawText with TextWordWrap would wrap again on every paint
+        # QTextLayout only breaks lines on the Unicode line separator
+        cached.text_layout = QTextLayout(text.replace('\n', '\u2028'), self.font)
+        cached.text_layout.setTextOption(self.text_option)
+        cached.text_layout.beginLayout()
+        line_width = cached.max_width - self.horizontal_padding * 2
+        height = 0.0
+        text_width = 0.0
+        while True:
+            line = cached.text_layout.createLine()
+            if not line.isValid():
+                break
+            line.setLineWidth(line_width)
+            line.setPosition(QPointF(0, height))
+            height += line.height()
+            text_width = max(text_width, line.naturalTextWidth())
+        cached.text_layout.endLayout()
+
+        cached.bubble_width = math.ceil(text_width) + self.horizontal_padding * 2
+        cached.bubble_height = math.ceil(height) + self.vertical_padding * 2
+
+        self.cache[key] = cached
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return cached
+
     def paint(self, painter, option, index):
-        text = index.model().data(index, Qt.DisplayRole)
-        color = index.model().data(index, Qt.BackgroundRole)
-        alignment = index.model().data(index, Qt.TextAlignmentRole)
-        sender = index.model().data(index, Qt.UserRole)
-        sender = " " + sender if alignment == 'Left' else sender + " "
-
-        painter.save()
-        painter.setRenderHint(QPainter.Antialiasing)
-
-        font = QFont("Segoe UI", 12)
-        painter.setFont(font)
-        fm = QFontMetrics(font)
-
-        # Calculate text bounding rect
-        max_width = option.rect.width() * 0.75
-        text_bounding_rect = fm.boundingRect(0, 0, max_width - self.horizontal_padding * 2, 10000, Qt.TextWordWrap,
-                                             text)
-
-        # Calculate bubble size and position
-        bubble_width = text_bounding_rect.width() + self.horizontal_padding * 2
-        bubble_height = text_bounding_rect.height() + self.vertical_padding * 2
-        bubble_x = option.rect.left() if alignment == 'Left' else option.rect.right() - bubble_width
-        bubble_y = option.rect.top() + self.sender_height
-
-        shadow_offset = 3
-        shadow_color = QColor(0, 0, 0, 32)
-        shadow_rect = QRectF(bubble_x + shadow_offset, bubble_y + shadow_offset, bubble_width, bubble_height)
+        model = index.model()
+        color = model.data(index, BACKGROUND_ROLE)
+        alignment = model.data(index, ALIGNMENT_ROLE)
+        rect = option.rect
+        cached = self.layout(index, rect.width())
+
+        # A streamed reply changes with every token, caching it would only churn the budget
+        if self.render_budget <= 0 or model.data(index, STREAMING_ROLE):
+            painter.save()
+            self.draw_bubble(painter, rect.left(), rect.top(), rect.right(), cached, color, alignment)
+            painter.restore()
+            return
+
+        dpr = painter.device().devicePixelRatioF()
+        key = (cached.key, color.rgba(), dpr)
+        pixmap = self.pixmaps.get(key)
+        if pixmap is None:
+            pixmap = self.render(cached, color, alignment, dpr)
+            self.pixmaps[key] = pixmap
+            self.pixmap_bytes += pixmap.width() * pixmap.height() * 4
+            while self.pixmap_bytes > self.render_budget and len(self.pixmaps) > 1:
+                _, evicted = self.pixmaps.popitem(last=False)
+                self.pixmap_bytes -= evicted.width() * evicted.height() * 4
+        else:
+            self.pixmaps.move_to_end(key)
+
+        pixmap_x = rect.left() if alignment == 'Left' else rect.right() - self.render_width(cached)
+        painter.drawPixmap(pixmap_x, rect.top(), pixmap)
+
+    @staticmethod
+    def render_width(cached):
+        # A short reply under a long sender name is narrower than the name above it
+        return max(cached.bubble_width, cached.sender_width)
+
+    def render(self, cached, color, alignment, dpr):
+        width = self.render_width(cached)
+        pixmap = QPixmap(math.ceil((width + SHADOW_OFFSET) * dpr),
+                         math.ceil((self.sender_height + cached.bubble_height + SHADOW_OFFSET) * dpr))
+        pixmap.setDevicePixelRatio(dpr)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        self.draw_bubble(painter, 0, 0, width, cached, color, alignment)
+        painter.end()
+        return pixmap
+
+    def draw_bubble(self, painter, left, top, right, cached, color, alignment):
+        bubble_width = cached.bubble_width
+        bubble_height = cached.bubble_height
+
+        painter.setRenderHint(ANTIALIASING)
+        painter.setFont(self.font)
+
+        # Calculate bubble position
+        bubble_x = left if alignment == 'Left' else right - bubble_width
+        bubble_y = top + self.sender_height
+
+        shadow_rect = QRectF(bubble_x + SHADOW_OFFSET, bubble_y + SHADOW_OFFSET, bubble_width, bubble_height)
         path_shadow = QPainterPath()
         path_shadow.addRoundedRect(shadow_rect, 10, 10)
-        painter.fillPath(path_shadow, QBrush(shadow_color))
+        painter.fillPath(path_shadow, self.shadow_brush)
 
-        bubble_rect = QRectF(option.rect.left(), option.rect.top() + self.sender_height, bubble_width, bubble_height)
-        if alignment == 'Right':
-            bubble_rect.moveRight(option.rect.right())
+        bubble_rect = QRectF(bubble_x, bubble_y, bubble_width, bubble_height)
 
         # Draw bubble
         path = QPainterPath()
@@ -53,25 +168,95 @@ class ChatBubbleDelegate(QStyledItemDelegate):
         painter.fillPath(path, QBrush(color))
 
         # Draw sender name
-        sender_name_pos = bubble_rect.left() if alignment == 'Left' else bubble_rect.right() - fm.width(sender)
-        sender_rect = QRectF(sender_name_pos, option.rect.top(), bubble_width, self.sender_height)
-        painter.setPen(QPen(Qt.white))
-        painter.drawText(sender_rect, Qt.AlignLeft | Qt.AlignVCenter, sender)
+        sender_name_pos = bubble_rect.left() if alignment == 'Left' else bubble_rect.right() - cached.sender_width
+        sender_rect = QRectF(sender_name_pos, top, cached.sender_width, self.sender_height)
+        painter.setPen(self.sender_pen)
+        painter.drawText(sender_rect, SENDER_FLAGS, cached.sender)
 
         # Draw message text
-        text_draw_rect = QRectF(bubble_rect.left() + self.horizontal_padding, bubble_rect.top() + self.vertical_padding,
-                                bubble_width - self.horizontal_padding * 2, bubble_height - self.vertical_padding * 2)
-        painter.setPen(QPen(Qt.black))
-        painter.drawText(text_draw_rect, Qt.TextWordWrap, text)
-
-        painter.restore()
+        painter.setPen(self.text_pen)
+        cached.text_layout.draw(painter, QPointF(bubble_rect.left() + self.horizontal_padding,
+                                                 bubble_rect.top() + self.vertical_padding))
 
     def sizeHint(self, option, index):
-        text = index.model().data(index, Qt.DisplayRole)
-        font = QFont("Segoe UI", 12)
-        fm = QFontMetrics(font)
-        max_width = option.rect.width() * 0.75
-        text_bounding_rect = fm.boundingRect(0, 0, max_width - self.horizontal_padding * 2, 10000, Qt.TextWordWrap,
-                                             text)
-        bubble_height = text_bounding_rect.height() + self.vertical_padding * 2 + self.sender_height + self.vertical_spacing * 2
-        return QSize(int(max_width), int(bubble_height))
\ No newline at end of file
+        cached = self.layout(index, option.rect.width())
+        bubble_height = cached.bubble_height + self.sender_height + self.vertical_spacing * 2
+        return QSize(int(cached.max_width), int(bubble_height))
+
+
+if __name__ == "__main__":
+    # Benchmark: sizeHint and paint for 10k rows, first pass, cached pass and a resize within the width bucket,
+    # then frame times scrolling through 1,000 long bubbles with and without the render cache.
+    import os
+    import random
+    import tempfile
+    import time
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6.QtGui import QImage
+    from PySide6.QtWidgets import QApplication, QListView, QStyleOptionViewItem
+    from services.chat_model import ChatModel
+    from services.chat_store import ChatStore
+
+    app = QApplication([])
+    rows = 10000
+    words = "the quick brown fox jumps over a lazy dog while tea gets cold on the table".split()
+    store = ChatStore(tempfile.mkdtemp(), "bench")
+    model = ChatModel(store, page_size=rows, max_pages=1)
+    model.extend((" ".join(random.choices(words, k=random.randint(3, 60))), "#8dd4f4" if row % 2 else "#6edcbe",
+                  "Left" if row % 2 else "Right", "Fluffy" if row % 2 else "Puff") for row in range(rows))
+    indexes = [model.index(row, 0) for row in range(rows)]
+
+    delegate = ChatBubbleDelegate(cache_size=rows)
+    image = QImage(700, 400, QImage.Format_ARGB32_Premultiplied)
+
+    def run(width, label):
+        option = QStyleOptionViewItem()
+        start = time.perf_counter()
+        for index in indexes:
+            option.rect.setRect(0, 0, width, 100)
+            delegate.sizeHint(option, index)
+        size_hint_ms = (time.perf_counter() - start) * 1000
+
+        painter = QPainter(image)
+        start = time.perf_counter()
+        for index in indexes:
+            option.rect.setRect(0, 0, width, 200)
+            delegate.paint(painter, option, index)
+        paint_ms = (time.perf_counter() - start) * 1000
+        painter.end()
+        print(f"{label:<22} sizeHint {size_hint_ms:7.1f} ms, paint {paint_ms:7.1f} ms for {rows} rows")
+
+    run(700, "first pass (uncached)")
+    run(700, "cached")
+    run(703, "resize within bucket")
+    run(820, "resize to new bucket")
+    print(f"hits {delegate.hits}, misses {delegate.misses}")
+
+    store.truncate(0)
+    long_model = ChatModel(store, page_size=1000, max_pages=1)
+    long_model.extend((" ".join(random.choices(words, k=random.randint(80, 160))), "#8dd4f4" if row % 2 else "#6edcbe",
+                       "Left" if row % 2 else "Right", "Fluffy" if row % 2 else "Puff") for row in range(1000))
+    view = QListView()
+    view.resize(700, 900)
+    view.setModel(long_model)
+    frame = QImage(view.viewport().size(), QImage.Format_ARGB32_Premultiplied)
+
+    def scroll_frames(render_cache_mb):
+        view.setItemDelegate(ChatBubbleDelegate(view, render_cache_mb=render_cache_mb))
+        view.doItemsLayout()
+        bar = view.verticalScrollBar()
+        times = []
+        for _ in range(2):
+            times.clear()
+            for value in range(bar.minimum(), bar.maximum(), 60):
+                bar.setValue(value)
+                start = time.perf_counter()
+                view.viewport().render(frame)
+                times.append((time.perf_counter() - start) * 1000)
+        times.sort()
+        return sum(times) / len(times), times[int(len(times) * 0.95)]
+
+    for label, budget in (("live drawing", 0), ("render cache 64 MB", 64)):
+        average, p95 = scroll_frames(budget)
+        print(f"{label:<22} {average:6.2f} ms/frame average, {p95:6.2f} ms p95 (second pass, 1,000 long bubbles)")
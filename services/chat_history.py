@@ -0,0 +1,75 @@
+class Turn:
+    # Where a turn starts in the message store and in the context; nothing before these positions is copied
+    __slots__ = ('rows', 'context', 'reply_rows', 'reply_context')
+
+    def __init__(self, rows, context):
+        self.rows = rows
+        self.context = context
+        self.reply_rows = rows
+        self.reply_context = context
+
+
+class ChatHistory:
+    def __init__(self, model, context, limit=100):
+        self.model = model
+        self.context = context
+        self.limit = limit
+        self.turns = []
+        # Undone turns with the messages and context entries cut off them, only the tail is kept
+        self.undone = []
+
+    def begin_turn(self):
+        self.turns.append(Turn(self.model.total(), len(self.context)))
+        if len(self.turns) > self.limit:
+            del self.turns[0]
+        self.undone.clear()
+
+    def begin_reply(self):
+        if self.turns:
+            self.turns[-1].reply_rows = self.model.total()
+            self.turns[-1].reply_context = len(self.context)
+
+    def clear(self):
+        self.turns.clear()
+        self.undone.clear()
+
+    def can_undo(self):
+        return bool(self.turns)
+
+    def can_redo(self):
+        return bool(self.undone)
+
+    def can_regenerate(self):
+        return bool(self.turns) and self.turns[-1].reply_context > self.turns[-1].context
+
+    def undo(self):
+        if not self.turns:
+            return False
+        turn = self.turns.pop()
+        records = self.model.store.read(turn.rows, self.model.total())
+        entries = self.context.read(turn.context)
+        self.undone.append((turn, records, entries))
+        self.model.truncate(turn.rows)
+        self.context.truncate(turn.context)
+        return True
+
+    def redo(self):
+        if not self.undone:
+            return False
+        turn, records, entries = self.undone.pop()
+        self.model.truncate(turn.rows)
+        self.context.truncate(turn.context)
+        self.model.extend_records(records)
+        self.context.extend(entries)
+        self.turns.append(turn)
+        return True
+
+    def regenerate(self):
+        # Drop the last reply but keep the message it answered, the caller sends it again
+        if not self.can_regenerate():
+            return False
+        turn = self.turns[-1]
+        self.model.truncate(turn.reply_rows)
+        self.context.truncate(turn.reply_context)
+        self.undone.clear()
+        return True
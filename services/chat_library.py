@@ -0,0 +1,412 @@
+import math
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    character TEXT,
+    user TEXT,
+    model TEXT,
+    started REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT,
+    sender TEXT,
+    text TEXT,
+    color TEXT,
+    alignment TEXT,
+    created REAL,
+    UNIQUE (session, position)
+);
+CREATE TABLE IF NOT EXISTS context (
+    session INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT,
+    content TEXT,
+    tokens INTEGER,
+    PRIMARY KEY (session, position)
+);
+CREATE TABLE IF NOT EXISTS words (
+    word TEXT PRIMARY KEY,
+    messages INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+# Chat rows only know their side, the user's bubbles are the ones on the right
+ROLES = {'Right': 'user', 'Left': 'assistant'}
+
+COUNT_WORDS = ("INSERT INTO words (word, messages) VALUES (?, ?) "
+               "ON CONFLICT (word) DO UPDATE SET messages = messages + excluded.messages")
+
+# Put around the matched words of a snippet, the search pane turns them into bold once the text is escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+# Letters and digits like the unicode61 tokenizer, an underscore splits words there as well
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+# Ranking runs over the newest this many matches, which come straight off the index in rowid order. FTS5's own
+# bm25() first counts every message holding each word, and a prefix query merges the lists of every word it
+# covers; both take hundreds of milliseconds for common words in a few million messages
+CANDIDATES = 1000
+# The typed prefix stands for this many of the most common words starting with it
+EXPANSIONS = 32
+K1 = 1.2
+B = 0.75
+
+
+def fold(text):
+    # What the unicode61 tokenizer does to a word before indexing it, so "cafe" finds and highlights "Café"
+    if text.isascii():
+        return text.lower()
+    return ''.join(c for c in unicodedata.normalize('NFKD', text.casefold()) if not unicodedata.combining(c))
+
+
+def word_counts(texts):
+    # How many of the texts hold each word, for the words table
+    counts = {}
+    for text in texts:
+        for word in set(WORD_PATTERN.findall(fold(text))):
+            counts[word] = counts.get(word, 0) + 1
+    return list(counts.items())
+
+
+def snippet(text, words, size=16):
+    # About size words around the first match
+    tokens = list(WORD_PATTERN.finditer(text))
+    if not tokens:
+        return text[:100]
+
+    def matches(token):
+        return fold(token.group()) in words
+
+    first = next((n for n, token in enumerate(tokens) if matches(token)), 0)
+    start = max(0, min(first - size // 4, len(tokens) - size))
+    end = min(len(tokens), start + size)
+    parts = ['…'] if start > 0 else []
+    position = tokens[start].start()
+    for token in tokens[start:end]:
+        parts.append(text[position:token.start()])
+        parts.append(f"{MATCH_START}{token.group()}{MATCH_END}" if matches(token) else token.group())
+        position = token.end()
+    parts.append(text[position:] if end == len(tokens) else '…')
+    return ''.join(parts)
+
+
+def connect(path):
+    connection = sqlite3.connect(path, timeout=10.0, check_same_thread=False)
+    # Searches read a snapshot while the writer commits, and a commit only waits for the WAL, not the database
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class LibraryContext:
+    # Mirrors one conversation's context store, so reopening it sends the model what it was sent before
+    def __init__(self, library, session_id):
+        self.library = library
+        self.id = session_id
+
+    def extend(self, position, records):
+        self.library.execute_many(
+            "INSERT INTO context (session, position, role, content, tokens) VALUES (?, ?, ?, ?, ?)",
+            [(self.id, position + n, record['role'], record['content'], record['tokens'])
+             for n, record in enumerate(records)])
+
+    def truncate(self, count):
+        self.library.execute("DELETE FROM context WHERE session = ? AND position >= ?", (self.id, count))
+
+
+class LibrarySession:
+    # Mirrors one conversation's ChatStore into the library, by position like the store itself
+    def __init__(self, library, session_id):
+        self.library = library
+        self.id = session_id
+        self.context = LibraryContext(library, session_id)
+
+    def extend(self, position, records):
+        now = time.time()
+        self.library.execute_many(
+            "INSERT INTO messages (session, position, role, sender, text, color, alignment, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(self.id, position + n, ROLES.get(record['alignment'], 'system'), record['sender'], record['text'],
+              record['color'], record['alignment'], now) for n, record in enumerate(records)])
+        self.library.execute_many(COUNT_WORDS, word_counts(record['text'] for record in records))
+        self.library.execute("UPDATE sessions SET updated = ? WHERE id = ?", (now, self.id))
+
+    # The words table keeps counting truncated messages, undo is rare and the idf only has to be about right
+    def truncate(self, count):
+        self.library.execute("DELETE FROM messages WHERE session = ? AND position >= ?", (self.id, count))
+
+    def describe(self, character, user, model=None):
+        self.library.execute("UPDATE sessions SET character = ?, user = ?, model = COALESCE(?, model) WHERE id = ?",
+                             (character, user, model, self.id))
+
+
+class ChatLibrary:
+    # Every conversation with its messages in SQLite, with an FTS5 index kept up to date by triggers. Writes go
+    # through a background thread that commits in batches, reads run on the caller's connection and searches
+    # typed in the pane on a thread of their own.
+    def __init__(self, path, commit_interval=0.2):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.connection = connect(path)
+        self.connection.executescript(SCHEMA)
+        # Only this process writes, so session ids are handed out here instead of waiting for the writer
+        self.next_session = self.connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM sessions").fetchone()[0]
+        row = self.connection.execute("SELECT value FROM state WHERE key = 'current'").fetchone()
+        # The session the open conversation belongs to, it goes on after a restart
+        self.current = LibrarySession(self, row[0]) if row is not None else None
+
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, name="library-writer", daemon=True)
+        self.writer.start()
+
+        # Only the newest search waits, a search still running when another comes in is interrupted
+        self.search_connection = connect(path)
+        self.search_condition = threading.Condition()
+        self.search_pending = None
+        self.search_running = False
+        self.searcher = threading.Thread(target=self.search_loop, name="library-search", daemon=True)
+        self.searcher.start()
+
+    def execute(self, statement, parameters=()):
+        self.queue.put((False, statement, parameters))
+
+    def execute_many(self, statement, rows):
+        if rows:
+            self.queue.put((True, statement, rows))
+
+    def start_session(self, character, user, model=None):
+        session_id = self.next_session
+        self.next_session += 1
+        if self.current is not None:
+            # A conversation that never got a message is not worth a search result
+            self.execute("DELETE FROM sessions WHERE id = ? AND NOT EXISTS "
+                         "(SELECT 1 FROM messages WHERE session = ?)", (self.current.id, self.current.id))
+            self.execute("DELETE FROM context WHERE session = ? AND NOT EXISTS "
+                         "(SELECT 1 FROM sessions WHERE id = ?)", (self.current.id, self.current.id))
+        now = time.time()
+        self.execute("INSERT INTO sessions (id, character, user, model, started, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                     (session_id, character, user, model, now, now))
+        return self.open_session(session_id)
+
+    def open_session(self, session_id):
+        self.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('current', ?)", (session_id,))
+        self.current = LibrarySession(self, session_id)
+        return self.current
+
+    # Reads see what the writer has committed, at most commit_interval behind
+    def count(self, session_id):
+        return self.connection.execute("SELECT COUNT(*) FROM messages WHERE session = ?", (session_id,)).fetchone()[0]
+
+    def context_count(self, session_id):
+        return self.connection.execute("SELECT COUNT(*) FROM context WHERE session = ?", (session_id,)).fetchone()[0]
+
+    def read(self, session_id):
+        rows = self.connection.execute("SELECT role, sender, text, color, alignment FROM messages "
+                                       "WHERE session = ? ORDER BY position", (session_id,))
+        return [{'role': role, 'text': text, 'color': color, 'alignment': alignment, 'sender': sender}
+                for role, sender, text, color, alignment in rows]
+
+    def read_context(self, session_id):
+        rows = self.connection.execute("SELECT role, content, tokens FROM context WHERE session = ? ORDER BY position",
+                                       (session_id,))
+        return [{'role': role, 'content': content, 'tokens': tokens} for role, content, tokens in rows]
+
+    def search(self, text, limit=50, connection=None):
+        connection = connection or self.connection
+        words = WORD_PATTERN.findall(fold(text))
+        if not words:
+            return []
+        try:
+            total = connection.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            # The last word matches as a prefix so results come up while typing, it is looked up in the words
+            # table and stands for the most common words starting with it
+            frequencies = dict(connection.execute(
+                "SELECT word, messages FROM words WHERE word IN (%s)" % ','.join('?' * (len(words) - 1)),
+                words[:-1])) if len(words) > 1 else {}
+            expansions = connection.execute(
+                "SELECT word, messages FROM words WHERE word >= ? AND word < ? ORDER BY messages DESC LIMIT ?",
+                (words[-1], words[-1] + '\U0010ffff', EXPANSIONS)).fetchall()
+            if not expansions:
+                return []
+            # Every word has to match
+            query = ' AND '.join(['"%s"' % word for word in words[:-1]] +
+                                 ['(%s)' % ' OR '.join('"%s"' % word for word, _ in expansions)])
+            rows = connection.execute(
+                "SELECT m.id, m.text, m.session, m.position, m.sender, s.character, s.model, s.started FROM "
+                "(SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT ?) f "
+                "JOIN messages m ON m.id = f.rowid JOIN sessions s ON s.id = m.session",
+                (query, CANDIDATES)).fetchall()
+        except sqlite3.OperationalError as e:
+            if str(e) != 'interrupted':
+                print(f"Search failed: {e}")
+            return []
+        if not rows:
+            return []
+
+        # BM25 over the candidates, with the idf of every word taken from the words table
+        def idf(count):
+            count = min(count, total)
+            return math.log((total - count + 0.5) / (count + 0.5) + 1)
+
+        exact = words[:-1]
+        prefixed = {word for word, _ in expansions}
+        weights = [idf(frequencies.get(word, 0)) for word in exact] + [idf(sum(count for _, count in expansions))]
+        docs = [WORD_PATTERN.findall(fold(row[1])) for row in rows]
+        average = sum(map(len, docs)) / len(docs)
+        scored = []
+        for row, doc in zip(rows, docs):
+            norm = K1 * (1 - B + B * len(doc) / average)
+            counts = [doc.count(word) for word in exact] + [sum(1 for token in doc if token in prefixed)]
+            score = sum(weight * count * (K1 + 1) / (count + norm) for weight, count in zip(weights, counts))
+            scored.append((score, row[0], row))
+        # Newer messages win a tie
+        scored.sort(reverse=True)
+
+        matched = prefixed.union(exact)
+        return [{'snippet': snippet(text, matched), 'session': session, 'position': position, 'sender': sender,
+                 'character': character, 'model': model, 'started': started}
+                for _, _, (_, text, session, position, sender, character, model, started) in scored[:limit]]
+
+    def search_later(self, text, callback, limit=50):
+        # callback(text, results, elapsed) is called from the search thread, and only for the newest text
+        with self.search_condition:
+            self.search_pending = (text, callback, limit)
+            if self.search_running:
+                self.search_connection.interrupt()
+            self.search_condition.notify()
+
+    def search_loop(self):
+        while True:
+            with self.search_condition:
+                while self.search_pending is None:
+                    self.search_condition.wait()
+                request, self.search_pending = self.search_pending, None
+                if request is False:
+                    return
+                self.search_running = True
+            text, callback, limit = request
+            start = time.perf_counter()
+            results = self.search(text, limit, self.search_connection)
+            elapsed = time.perf_counter() - start
+            with self.search_condition:
+                self.search_running = False
+                stale = self.search_pending is not None
+            if not stale:
+                callback(text, results, elapsed)
+
+    def write_loop(self):
+        connection = connect(self.path)
+        counted = connection.execute("SELECT EXISTS (SELECT 1 FROM words)").fetchone()[0]
+        if not counted and connection.execute("SELECT EXISTS (SELECT 1 FROM messages)").fetchone()[0]:
+            # A library from before the words table is counted once
+            with connection:
+                connection.executemany(COUNT_WORDS, word_counts(text for text, in connection.execute(
+                    "SELECT text FROM messages")))
+        while True:
+            batch = [self.queue.get()]
+            # Everything queued within the interval goes into one transaction
+            deadline = time.monotonic() + self.commit_interval
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            synced = []
+            with connection:
+                for item in batch:
+                    if item is None:
+                        break
+                    if isinstance(item, threading.Event):
+                        synced.append(item)
+                        continue
+                    many, statement, parameters = item
+                    try:
+                        if many:
+                            connection.executemany(statement, parameters)
+                        else:
+                            connection.execute(statement, parameters)
+                    except sqlite3.Error as e:
+                        print(f"Library write failed: {e}")
+            for event in synced:
+                event.set()
+            if batch[-1] is None:
+                connection.close()
+                return
+
+    def flush(self, timeout=5.0):
+        event = threading.Event()
+        self.queue.put(event)
+        return event.wait(timeout)
+
+    def close(self):
+        with self.search_condition:
+            self.search_pending = False
+            if self.search_running:
+                self.search_connection.interrupt()
+            self.search_condition.notify()
+        self.searcher.join()
+        self.search_connection.close()
+        self.queue.put(None)
+        self.writer.join()
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    # Benchmark: index two million messages in 40-message batches through the writer, then time ranked searches
+    # for a rare word, common words and a prefix.
+    import os
+    import random
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), "library.db")
+    library = ChatLibrary(path)
+    words = ("the quick brown fox jumps over a lazy dog while tea gets cold on the table and everyone talks "
+             "about the weather the garden the cat the maid the kettle").split()
+    count = 2000000
+    start = time.perf_counter()
+    session = None
+    for first in range(0, count, 40):
+        if first % 2000 == 0:
+            session = library.start_session("Fluffy", "Puff", "model.gguf")
+        rows = [{'text': " ".join(random.choices(words, k=random.randint(5, 40))) +
+                 (" zanzibar" if random.random() < 0.0001 else ""),
+                 'color': "#8dd4f4", 'alignment': "Left" if n % 2 else "Right", 'sender': "Fluffy" if n % 2 else "Puff"}
+                for n in range(40)]
+        session.extend(first % 2000, rows)
+    library.flush(timeout=None)
+    print(f"indexed {count} messages in {time.perf_counter() - start:.1f} s, "
+          f"{os.path.getsize(path) / 1048576:.0f} MB")
+
+    for text in ("zanzibar", "kettle garden", "weath", "cat maid tea"):
+        start = time.perf_counter()
+        results = library.search(text)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = results[0]['snippet'][:40] if results else None
+        print(f"search {text!r:<16} {elapsed:7.1f} ms, {len(results)} results, best: {best!r}")
+    library.close()
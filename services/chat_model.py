@@ -0,0 +1,317 @@
+import sys
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex
+from PySide6.QtGui import QColor
+
+# Looking up a Qt enum member costs microseconds in PySide6, data() runs several times per painted row
+DISPLAY_ROLE = int(Qt.DisplayRole)
+BACKGROUND_ROLE = int(Qt.BackgroundRole)
+ALIGNMENT_ROLE = int(Qt.TextAlignmentRole)
+SENDER_ROLE = int(Qt.UserRole)
+# Stable per-message id, so a row that changes text (streaming) or moves keeps its identity
+MESSAGE_ID_ROLE = SENDER_ROLE + 1
+# True for the reply still being streamed, its text changes with every token
+STREAMING_ROLE = SENDER_ROLE + 2
+
+# One QColor per distinct bubble color, shared by every row that uses it
+_colors = {}
+
+
+def color_name(color):
+    if isinstance(color, QColor):
+        return sys.intern(color.name())
+    return sys.intern(str(color))
+
+
+def shared_color(name):
+    color = _colors.get(name)
+    if color is None:
+        color = _colors[name] = QColor(name)
+    return color
+
+
+class Message:
+    # Sender, color and alignment repeat on every row, they are interned so each message only owns its text
+    __slots__ = ('id', 'text', 'color', 'alignment', 'sender')
+
+    def __init__(self, message_id, text, color, alignment, sender):
+        self.id = message_id
+        self.text = text
+        self.color = color
+        self.alignment = alignment
+        self.sender = sender
+
+
+def record(text, color, alignment, sender=None):
+    return {'text': text, 'color': color_name(color), 'alignment': alignment, 'sender': sender}
+
+
+def make(position, row):
+    # The position in the store doubles as the message id, it stays the same when a page is loaded again
+    return Message(position, row['text'], sys.intern(row['color']), sys.intern(row['alignment']),
+                   sys.intern(row['sender']) if row['sender'] else row['sender'])
+
+
+class ChatModel(QAbstractListModel):
+    # Only a window of pages is held as rows, the rest of the conversation stays in the store
+    def __init__(self, store, page_size=50, max_pages=8, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.offset = len(store)
+        self.messages = []
+        # The reply being streamed, shown after the window but not stored until it is complete
+        self.stream = None
+        self.show_latest()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.messages) + (self.stream is not None)
+
+    def data(self, index, role=DISPLAY_ROLE):
+        if not index.isValid():
+            return None
+        row = index.row()
+        message = self.messages[row] if row < len(self.messages) else self.stream
+        if role == DISPLAY_ROLE:
+            return message.text
+        if role == BACKGROUND_ROLE:
+            return shared_color(message.color)
+        if role == ALIGNMENT_ROLE:
+            return message.alignment
+        if role == SENDER_ROLE:
+            return message.sender
+        if role == MESSAGE_ID_ROLE:
+            return message.id
+        if role == STREAMING_ROLE:
+            return message is self.stream
+        return None
+
+    def total(self):
+        return len(self.store)
+
+    def at_latest(self):
+        return self.offset + len(self.messages) == len(self.store)
+
+    def has_older(self):
+        return self.offset > 0
+
+    def show_latest(self):
+        self.show(max(0, len(self.store) - self.page_size))
+
+    def show_around(self, position):
+        # Opens a page with position in the middle, for jumping to a search hit; returns its row
+        self.clear_stream()
+        position = max(0, min(position, len(self.store) - 1))
+        self.show(max(0, min(position - self.page_size // 2, len(self.store) - self.page_size)))
+        return position - self.offset
+
+    def show(self, offset):
+        self.beginResetModel()
+        self.offset = offset
+        self.messages = [make(offset + n, row) for n, row in
+                         enumerate(self.store.read(offset, offset + self.page_size))]
+        self.endResetModel()
+
+    def append(self, text, color, alignment, sender=None):
+        self.extend([(text, color, alignment, sender)])
+
+    def extend(self, rows):
+        self.extend_records([record(*row) for row in rows])
+
+    def extend_records(self, records):
+        # One rowsInserted for the whole batch, the view lays out once instead of once per row
+        if not records:
+            return
+        following = self.at_latest()
+        first = len(self.store)
+        self.store.extend(records)
+        if not following:
+            self.show_latest()
+            return
+
+        self.beginInsertRows(QModelIndex(), len(self.messages), len(self.messages) + len(records) - 1)
+        self.messages.extend(make(first + n, row) for n, row in enumerate(records))
+        self.endInsertRows()
+        self.evict_top()
+
+    def load_older(self):
+        count = min(self.page_size, self.offset)
+        if count == 0:
+            return 0
+        messages = [make(self.offset - count + n, row) for n, row in
+                    enumerate(self.store.read(self.offset - count, self.offset))]
+        self.beginInsertRows(QModelIndex(), 0, count - 1)
+        self.messages[:0] = messages
+        self.offset -= count
+        self.endInsertRows()
+        self.evict_bottom()
+        return count
+
+    def load_newer(self):
+        # Returns the rows dropped from the top, the view shifts its scroll position by them
+        end = self.offset + len(self.messages)
+        count = min(self.page_size, len(self.store) - end)
+        if count == 0:
+            return 0
+        messages = [make(end + n, row) for n, row in enumerate(self.store.read(end, end + count))]
+        self.beginInsertRows(QModelIndex(), len(self.messages), len(self.messages) + count - 1)
+        self.messages.extend(messages)
+        self.endInsertRows()
+        return self.evict_top()
+
+    def evict_top(self):
+        count = len(self.messages) - self.page_size * self.max_pages
+        if count <= 0:
+            return 0
+        self.beginRemoveRows(QModelIndex(), 0, count - 1)
+        del self.messages[:count]
+        self.offset += count
+        self.endRemoveRows()
+        return count
+
+    def evict_bottom(self):
+        # The streamed reply is drawn right after the window, so keep the window at the end while it runs
+        count = len(self.messages) - self.page_size * self.max_pages
+        if count <= 0 or self.stream is not None:
+            return 0
+        self.beginRemoveRows(QModelIndex(), len(self.messages) - count, len(self.messages) - 1)
+        del self.messages[-count:]
+        self.endRemoveRows()
+        return count
+
+    def set_stream(self, text, color, alignment, sender=None):
+        if self.stream is not None:
+            self.stream.text = text
+            index = self.index(len(self.messages), 0)
+            self.dataChanged.emit(index, index, [DISPLAY_ROLE])
+            return
+        if not self.at_latest():
+            self.show_latest()
+        self.beginInsertRows(QModelIndex(), len(self.messages), len(self.messages))
+        self.stream = make(len(self.store), record(text, color, alignment, sender))
+        self.endInsertRows()
+
+    def clear_stream(self):
+        if self.stream is None:
+            return
+        self.beginRemoveRows(QModelIndex(), len(self.messages), len(self.messages))
+        self.stream = None
+        self.endRemoveRows()
+
+    def truncate(self, count):
+        # Drops every message from position count on, undo points are just such positions
+        self.clear_stream()
+        if count >= len(self.store):
+            return
+        self.store.truncate(count)
+        if count <= self.offset:
+            self.show_latest()
+        elif count < self.offset + len(self.messages):
+            self.beginRemoveRows(QModelIndex(), count - self.offset, len(self.messages) - 1)
+            del self.messages[count - self.offset:]
+            self.endRemoveRows()
+
+    def serialize(self):
+        return self.store.read(0, len(self.store))
+
+    def load(self, data):
+        self.stream = None
+        self.store.replace([record(row['text'], row['color'], row['alignment'], row['sender']) for row in data])
+        self.show_latest()
+
+
+if __name__ == "__main__":
+    # Benchmark: memory and append throughput for a 100k message session against the QStandardItemModel
+    # the chat view used before, and the time to open a 50 and a 50k message conversation in a view.
+    import os
+    import random
+    import tempfile
+    import time
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6.QtGui import QStandardItemModel, QStandardItem
+    from PySide6.QtWidgets import QApplication, QListView
+    from services.chat_bubble_delegate import ChatBubbleDelegate
+    from services.chat_store import ChatStore
+
+    app = QApplication([])
+    directory = tempfile.mkdtemp()
+    count = 100000
+    words = "the quick brown fox jumps over a lazy dog while tea gets cold on the table".split()
+    rows = [(" ".join(random.choices(words, k=random.randint(3, 40))), "#8dd4f4" if n % 2 else "#6edcbe",
+             "Left" if n % 2 else "Right", "Fluffy" if n % 2 else "Puff") for n in range(count)]
+
+    def standard_one_by_one():
+        model = QStandardItemModel()
+        for n, (text, color, alignment, sender) in enumerate(rows):
+            item = QStandardItem()
+            item.setData(text, Qt.DisplayRole)
+            item.setData(color, Qt.BackgroundRole)
+            item.setData(alignment, Qt.TextAlignmentRole)
+            item.setData(sender, Qt.UserRole)
+            item.setData(n, MESSAGE_ID_ROLE)
+            model.appendRow(item)
+        return model
+
+    def chat_model(name):
+        store = ChatStore(directory, name)
+        store.truncate(0)
+        return ChatModel(store)
+
+    def chat_one_by_one():
+        model = chat_model("one_by_one")
+        for row in rows:
+            model.append(*row)
+        return model
+
+    def chat_batched(batch=40):
+        model = chat_model("batched")
+        for start in range(0, count, batch):
+            model.extend(rows[start:start + batch])
+        return model
+
+    # Measured first, before freed models leave memory for the allocator to reuse
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        process = psutil.Process()
+        kept = []
+        for label, build in (("ChatModel", chat_batched), ("QStandardItemModel", standard_one_by_one)):
+            before = process.memory_info().rss
+            kept.append(build())
+            print(f"{label:<22} {(process.memory_info().rss - before) / count:9.0f} bytes/message RSS")
+        for model in kept[:1]:
+            model.store.close()
+        del kept
+
+    for label, build in (("QStandardItemModel", standard_one_by_one), ("ChatModel.append", chat_one_by_one),
+                         ("ChatModel.extend(40)", chat_batched)):
+        start = time.perf_counter()
+        model = build()
+        seconds = time.perf_counter() - start
+        print(f"{label:<22} {count / seconds:9.0f} messages/s")
+        if isinstance(model, ChatModel):
+            model.store.close()
+        del model
+
+    for size in (50, 50000):
+        name = f"open_{size}"
+        store = ChatStore(directory, name)
+        store.extend(record(*row) for row in rows[:size])
+        store.close()
+
+        view = QListView()
+        view.resize(400, 800)
+        view.setItemDelegate(ChatBubbleDelegate())
+        start = time.perf_counter()
+        model = ChatModel(ChatStore(directory, name))
+        view.setModel(model)
+        view.doItemsLayout()
+        view.scrollToBottom()
+        print(f"open {size:>5} messages     {(time.perf_counter() - start) * 1000:7.1f} ms, {model.rowCount()} rows")
+        model.store.close()
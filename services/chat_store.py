@@ -0,0 +1,356 @@
+import itertools
+import json
+import mmap
+import os
+import queue
+import threading
+import time
+import zlib
+from array import array
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def encode(record):
+    return json.dumps(record, ensure_ascii=False).encode('utf-8')
+
+
+def frame(payload):
+    # Journal lines carry their own CRC, a line torn by a crash is found and dropped on the next load
+    return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+
+def read_journal(path):
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return [], 0
+    ops = []
+    position = 0
+    while True:
+        end = data.find(b'\n', position)
+        if end == -1:
+            break
+        crc, _, payload = data[position:end].partition(b' ')
+        try:
+            if int(crc, 16) != zlib.crc32(payload):
+                break
+            ops.append(json.loads(payload))
+        except ValueError:
+            break
+        position = end + 1
+    return ops, position
+
+
+def map_file(path):
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return None, None
+    try:
+        return file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        file.close()
+        return None, None
+
+
+def read_snapshot(path):
+    # Record lines followed by a '#' trailer with the count, the last journal sequence and a CRC of the body
+    file, data = map_file(path)
+    if data is None:
+        return None
+    body_end = data.rfind(b'\n#', 0, len(data) - 1) + 1
+    try:
+        trailer = json.loads(data[body_end + 1:])
+        valid = zlib.crc32(data[:body_end]) == trailer['crc']
+    except (ValueError, KeyError):
+        valid = False
+    if not valid:
+        data.close()
+        file.close()
+        return None
+
+    offsets = array('Q', [0])
+    position = data.find(b'\n', 0, body_end)
+    while position != -1:
+        offsets.append(position + 1)
+        position = data.find(b'\n', position + 1, body_end)
+    return file, data, offsets, trailer['seq']
+
+
+class ChatStore:
+    # A compacted snapshot read through mmap plus the records appended since, mirrored to a journal by a
+    # background writer; every page can still be read by position
+    def __init__(self, directory, name='messages', fsync_interval=0.05, compact_after=1000):
+        self.directory = directory
+        self.name = name
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+        os.makedirs(directory, exist_ok=True)
+
+        self.file = None
+        self.map = None
+        self.offsets = array('Q', [0])
+        self.base = 0
+        self.tail = []
+        self.seq = 0
+        self.gen = 0
+        self.compacting = None
+        self.compacted = None
+        # Told of every extend and truncate after loading, with the position they apply at
+        self.mirror = None
+        self.load()
+
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, args=(open(self.path('journal'), 'ab'),),
+                                       name=f"{name}-journal", daemon=True)
+        self.writer.start()
+        self.maybe_compact()
+
+    def path(self, kind, gen=None):
+        return os.path.join(self.directory, f"{self.name}.{self.gen if gen is None else gen}.{kind}")
+
+    def generations(self):
+        gens = set()
+        for filename in os.listdir(self.directory):
+            parts = filename.split('.')
+            if len(parts) >= 3 and parts[0] == self.name and parts[1].isdigit():
+                gens.add(int(parts[1]))
+        return sorted(gens, reverse=True)
+
+    def load(self):
+        gens = self.generations()
+        for gen in gens:
+            # A compaction that did not finish leaves a newer generation without a valid snapshot
+            snapshot = read_snapshot(self.path('snapshot', gen))
+            if snapshot is not None:
+                self.gen = gen
+                self.file, self.map, self.offsets, self.seq = snapshot
+                self.base = len(self.offsets) - 1
+                break
+
+        ops, valid_end = read_journal(self.path('journal'))
+        for op in ops:
+            if op['s'] <= self.seq:
+                continue
+            self.seq = op['s']
+            if 'a' in op:
+                self.tail.extend(encode(record) for record in op['a'])
+            else:
+                self.drop(op['t'])
+        if os.path.exists(self.path('journal')) and os.path.getsize(self.path('journal')) != valid_end:
+            with open(self.path('journal'), 'r+b') as file:
+                file.truncate(valid_end)
+
+        for gen in gens:
+            if gen != self.gen:
+                self.remove_generation(gen)
+
+    def remove_generation(self, gen):
+        for kind in ('snapshot', 'journal', 'snapshot.tmp'):
+            try:
+                os.remove(self.path(kind, gen))
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return self.base + len(self.tail)
+
+    def read(self, start, stop):
+        self.swap()
+        stop = min(stop, len(self))
+        if start >= stop:
+            return []
+        rows = []
+        if start < self.base:
+            data = self.map[self.offsets[start]:self.offsets[min(stop, self.base)]]
+            rows = [json.loads(line) for line in data.splitlines()]
+        if stop > self.base:
+            rows.extend(json.loads(payload) for payload in self.tail[max(start - self.base, 0):stop - self.base])
+        return rows
+
+    def extend(self, records):
+        self.swap()
+        records = list(records)
+        if not records:
+            return
+        if self.mirror is not None:
+            self.mirror.extend(len(self), records)
+        payloads = [encode(record) for record in records]
+        self.tail.extend(payloads)
+        self.seq += 1
+        self.queue.put(('op', frame(b'{"s":%d,"a":[%s]}' % (self.seq, b','.join(payloads)))))
+        self.maybe_compact()
+
+    def drop(self, count):
+        if count < self.base:
+            self.base = count
+            self.tail = []
+        else:
+            del self.tail[count - self.base:]
+
+    def truncate(self, count):
+        self.swap()
+        if count >= len(self):
+            return
+        self.drop(count)
+        if self.mirror is not None:
+            self.mirror.truncate(count)
+        if self.compacting is not None:
+            self.compacting['kept'] = min(self.compacting['kept'], count)
+        self.seq += 1
+        self.queue.put(('op', frame(b'{"s":%d,"t":%d}' % (self.seq, count))))
+
+    def replace(self, records):
+        self.truncate(0)
+        self.extend(records)
+
+    def maybe_compact(self):
+        # Compacting once the tail reaches a quarter of the snapshot keeps the copying linear in a long session
+        if self.compacting is not None or len(self.tail) < max(self.compact_after, self.base // 4):
+            return
+        # The writer copies the live part of the current snapshot and appends the tail, both are immutable
+        self.compacting = {'kept': len(self)}
+        self.queue.put(('compact', self.gen + 1, self.offsets[:self.base + 1], list(self.tail), self.seq))
+
+    def swap(self):
+        if self.compacted is None:
+            return
+        gen, offsets = self.compacted
+        self.compacted = None
+        kept = self.compacting['kept']
+        self.compacting = None
+
+        # Records appended after the compaction started are the only ones left in memory
+        self.tail = self.tail[kept - self.base:]
+        self.base = kept
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        self.remove_generation(self.gen)
+        self.gen = gen
+        self.file, self.map = map_file(self.path('snapshot'))
+        self.offsets = offsets
+
+    def write_loop(self, journal):
+        while True:
+            batch = [self.queue.get()]
+            # Everything queued within the interval shares one fsync
+            deadline = time.monotonic() + self.fsync_interval
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            synced = []
+            for item in batch:
+                if item is None:
+                    break
+                if item[0] == 'op':
+                    journal.write(item[1])
+                elif item[0] == 'compact':
+                    journal = self.compact(journal, *item[1:])
+                else:
+                    synced.append(item[1])
+            journal.flush()
+            os.fsync(journal.fileno())
+            for event in synced:
+                event.set()
+            if batch[-1] is None:
+                journal.close()
+                return
+
+    def compact(self, journal, gen, offsets, tail, seq):
+        journal.flush()
+        os.fsync(journal.fileno())
+        tmp_path = self.path('snapshot.tmp', gen)
+        crc = 0
+        with open(tmp_path, 'wb') as out:
+            if offsets[-1]:
+                with open(self.path('snapshot', gen - 1), 'rb') as source:
+                    remaining = offsets[-1]
+                    while remaining:
+                        chunk = source.read(min(CHUNK_SIZE, remaining))
+                        out.write(chunk)
+                        crc = zlib.crc32(chunk, crc)
+                        remaining -= len(chunk)
+            end = offsets[-1]
+            for payload in tail:
+                line = payload + b'\n'
+                out.write(line)
+                crc = zlib.crc32(line, crc)
+                end += len(line)
+                offsets.append(end)
+            out.write(b'#' + json.dumps({'count': len(offsets) - 1, 'seq': seq, 'crc': crc}).encode() + b'\n')
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self.path('snapshot', gen))
+
+        journal.close()
+        journal = open(self.path('journal', gen), 'ab')
+        self.compacted = (gen, offsets)
+        return journal
+
+    def flush(self, timeout=5.0):
+        event = threading.Event()
+        self.queue.put(('sync', event))
+        return event.wait(timeout)
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        self.swap()
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+
+
+def _write_forever(directory):
+    store = ChatStore(directory, fsync_interval=0.01, compact_after=500)
+    n = len(store)
+    for step in itertools.count(1):
+        store.extend([{'text': f"message {n} " + "word " * (n % 40), 'color': '#8dd4f4', 'alignment': 'Left',
+                       'sender': 'Fluffy', 'n': n}])
+        n += 1
+        # Undo now and then, truncations have to survive the kill as well
+        if step % 97 == 0:
+            n -= 3
+            store.truncate(n)
+
+
+if __name__ == "__main__":
+    # Benchmark: reload time of a 100k message session, then kill -9 a process mid-write several times and check
+    # that every reload gives a consistent prefix of what was written.
+    import multiprocessing
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    store = ChatStore(directory)
+    for start in range(0, 100000, 40):
+        store.extend({'text': f"message {n} " + "word " * (n % 60), 'color': '#8dd4f4', 'alignment': 'Left',
+                      'sender': 'Fluffy'} for n in range(start, start + 40))
+    store.close()
+    for label in ("reload", "reload after compaction"):
+        start = time.perf_counter()
+        store = ChatStore(directory)
+        count = len(store)
+        page = store.read(count - 50, count)
+        print(f"{label:<24} {count} messages in {(time.perf_counter() - start) * 1000:.1f} ms, "
+              f"last: {page[-1]['text'][:14]!r}")
+        store.close()
+
+    directory = tempfile.mkdtemp()
+    for attempt in range(5):
+        process = multiprocessing.Process(target=_write_forever, args=(directory,))
+        process.start()
+        time.sleep(0.5 + attempt * 0.3)
+        process.kill()
+        process.join()
+        store = ChatStore(directory)
+        rows = store.read(0, len(store))
+        consistent = all(row['n'] == n for n, row in enumerate(rows))
+        print(f"killed writer {attempt + 1}: {len(rows)} messages recovered, consistent: {consistent}, "
+              f"files: {sorted(os.listdir(directory))}")
+        store.close()
@@ -0,0 +1,115 @@
+import json
+import os
+import re
+import threading
+import time
+
+import psutil
+
+HEADROOM = 512 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024 * 1024
+
+LOAD_TIME_PATTERN = re.compile(r"load time\s*=\s*([\d.]+)\s*ms")
+
+STRATEGY_ARGS = {
+    'mmap': [],
+    'no-mmap': ['--no-mmap'],
+    'mlock': ['--mlock'],
+}
+
+
+def choose_load_strategy(model_path, settings, available=None):
+    try:
+        size = os.path.getsize(model_path)
+    except OSError:
+        return {'strategy': 'mmap', 'prefetch': False, 'reason': "model file not found"}
+    if available is None:
+        available = psutil.virtual_memory().available
+
+    if settings['load_strategy'] in STRATEGY_ARGS:
+        return {'strategy': settings['load_strategy'], 'prefetch': available > size + HEADROOM,
+                'reason': "set in config"}
+
+    if settings['gpu_layers'] > 0 and available > size + HEADROOM:
+        # With mmap the host copy of offloaded layers stays mapped, reading it once frees it after upload
+        return {'strategy': 'no-mmap', 'prefetch': False, 'reason': "layers offloaded to GPU"}
+    if available > size * 1.5 + HEADROOM:
+        return {'strategy': 'mlock', 'prefetch': True, 'reason': "plenty of free RAM, keep the model resident"}
+    if available > size + HEADROOM:
+        return {'strategy': 'mmap', 'prefetch': True, 'reason': "model fits in free RAM"}
+    # Prefetching would only evict its own pages, let the OS page weights in on demand
+    return {'strategy': 'mmap', 'prefetch': False, 'reason': "model larger than free RAM"}
+
+
+def strategy_args(strategy):
+    return list(STRATEGY_ARGS.get(strategy, []))
+
+
+class Prefetcher:
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.cancel_event = threading.Event()
+        self.thread = None
+        self.seconds = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="model-prefetch", daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _run(self):
+        start = time.monotonic()
+        try:
+            with open(self.model_path, 'rb', buffering=0) as file:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                # Reading is enough to pull the pages into the OS page cache
+                while not self.cancel_event.is_set() and file.read(CHUNK_SIZE):
+                    pass
+        except OSError as e:
+            print(f"Prefetch failed: {e}")
+            return
+        if not self.cancel_event.is_set():
+            self.seconds = time.monotonic() - start
+            print(f"Prefetched {os.path.basename(self.model_path)} in {self.seconds:.1f}s")
+
+
+def parse_load_time(log_text):
+    match = LOAD_TIME_PATTERN.search(log_text)
+    return float(match.group(1)) / 1000 if match else None
+
+
+def read_load_time(log_path):
+    try:
+        with open(log_path, 'r', encoding='utf-8', errors='replace') as file:
+            return parse_load_time(file.read())
+    except FileNotFoundError:
+        return None
+
+
+class LoadHistory:
+    def __init__(self, filename, keep=20):
+        self.filename = filename
+        self.keep = keep
+        try:
+            with open(filename, 'r') as file:
+                self.history = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.history = {}
+
+    def record(self, model_path, strategy, ready_seconds, log_path, prefetched):
+        entry = {
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'strategy': strategy,
+            'prefetched': prefetched,
+            'ready_seconds': round(ready_seconds, 2),
+            'load_seconds': read_load_time(log_path),
+        }
+        entries = self.history.setdefault(os.path.basename(model_path), [])
+        entries.append(entry)
+        del entries[:-self.keep]
+        with open(self.filename, 'w') as file:
+            json.dump(self.history, file, indent=4)
+        return entry
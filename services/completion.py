@@ -1,50 +1,14 @@
 import configparser
 import os
-import subprocess
-import threading
+import platform
+import sys
 
-import requests
-from PySide6.QtCore import QThread, Signal
-
-
-class Worker(QThread):
-    finished = Signal(str, int)
-
-    def __init__(self, base_url, model, messages, temperature=0.7, penalty=1.0):
-        super().__init__()
-        self.base_url = base_url
-        self.model = model
-        self.messages = messages
-        self.temperature = temperature
-        self.penalty = penalty
-
-    def run(self):
-        try:
-            print("OK")
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer no-key",
-            }
-
-            data = {
-                "model": self.model,
-                "cache_prompt": True,
-                "messages": self.messages,
-                "temperature": self.temperature,
-                "frequency_penalty": self.penalty
-            }
-
-            response = requests.post(self.base_url, headers=headers, json=data)
-            response_data = response.json()
-
-            assistant_message = response_data['choices'][0]['message']['content']
-            total_tokens_used = response_data['usage']['total_tokens']
-
-            print(total_tokens_used)
-            self.finished.emit(assistant_message, total_tokens_used)
-        except Exception as e:
-            print(f"Error sending message: {e}")
+import psutil
 
+from services.settings_handler import load_settings, load_tuned_settings
+from services.cold_start import HEADROOM, choose_load_strategy, strategy_args
+from services.model_index import estimate_memory
+from services.speculative import draft_args
 
 temp_dir = os.path.join(os.getcwd(), 'temp')
 os.makedirs(temp_dir, exist_ok=True)
@@ -57,35 +21,35 @@ print(models_dir)
 backend_dir = os.path.join(os.getcwd(), 'backend')
 os.makedirs(backend_dir, exist_ok=True)
 
+slots_dir = os.path.join(temp_dir, 'slots')
+os.makedirs(slots_dir, exist_ok=True)
 
-def load_settings():
-    config = configparser.ConfigParser()
+log_path = os.path.join(temp_dir, 'llama_output.log')
 
-    settings = {
-        'threads': 14,
-        'capacity': 4096,
-        'temperature': 0.7,
-        'new_predict': 512,
-        'gpu_layers': 0,
-        'grp_n': 1,
-        'grp_w': 512
-    }
-
-    config.read('config.ini')
-
-    if config.has_section('Settings'):
-        for key in settings:
-            if config.has_option('Settings', key):
-                value = config.get('Settings', key)
-                if key in ['threads', 'capacity', 'new_predict', 'gpu_layers', 'grp_n', 'grp_w']:
-                    settings[key] = int(value)
-                elif key == 'temperature':
-                    settings[key] = float(value)
+SERVER_PORT = 35634
 
-    return settings
+# Runtime libraries the GPU builds of llama.cpp ship next to the server binary
+GPU_LIBRARIES = ('cuda', 'cublas', 'vulkan', 'hip', 'rocm', 'sycl', 'opencl', 'clblast')
+
+
+def parallel_slots(settings, info=None, available=None):
+    # One slot for the chat. Every extra slot for background jobs keeps the full capacity and so multiplies the
+    # KV cache, it is only added when the model is known and the estimate with it still fits in free RAM
+    if settings['parallel'] > 0:
+        return settings['parallel']
+    if info is None:
+        return 1
+    if available is None:
+        available = psutil.virtual_memory().available
+    most = 3 if settings['capacity'] <= 2048 else 2 if settings['capacity'] <= 4096 else 1
+    for slots in range(most, 1, -1):
+        estimate = estimate_memory(info, settings['capacity'], settings['gpu_layers'], slots, settings['batch'])
+        if estimate['ram'] + HEADROOM <= available:
+            return slots
+    return 1
 
 
-def boot_func():
+def selected_model():
     config = configparser.ConfigParser()
     config_file = './config.ini'
     if not os.path.exists(config_file):
@@ -96,56 +60,78 @@ def boot_func():
         filename = config.get('LLM', 'selected_file', fallback="")
         if filename == "":
             filename = "kunoichi-7b.Q6_K.gguf"
+    return filename
 
-    settings = load_settings()
-
-    if str(settings['grp_n']) == "1":
-        command = [
-            backend_dir + '/server',
-            '-m', models_dir + f'/{filename}',
-            '--host', '127.0.0.1',
-            '--port', '35634',
-            '-t', str(settings['threads']),
-            '-c', str(settings['capacity']),
-            '-ngl', str(settings['gpu_layers']),
-            '-b', '512',
-            '--grp-attn-n', str(settings['grp_n']),
-            '--grp-attn-w', str(settings['grp_w'])
-        ]
-    else:
-        command = [
-            backend_dir + '/server',
-            '-m', models_dir + f'/{filename}',
-            '--host', '127.0.0.1',
-            '--port', '35634',
-            '-t', str(settings['threads']),
-            '-c', str(settings['capacity']),
-            '-ngl', str(settings['gpu_layers']),
-            '-b', '512'
-        ]
 
-    with open(temp_dir + '/llama_output.log', 'w') as output_file:
-        process = subprocess.Popen(command, stdout=output_file, stderr=subprocess.STDOUT,
-                                   creationflags=subprocess.CREATE_NO_WINDOW)
-    process.wait()
+def selected_model_path():
+    return os.path.join(models_dir, selected_model())
+
 
-    if process.returncode != 0:
-        print("Server exited with error code:", process.returncode)
+def selected_draft_path():
+    config = configparser.ConfigParser()
+    config.read('./config.ini')
+    filename = config.get('LLM', 'draft_file', fallback="")
+    return os.path.join(models_dir, filename) if filename != "" else ""
 
 
-def boot():
-    server_thread = threading.Thread(target=boot_func)
-    server_thread.daemon = True
-    server_thread.start()
+def model_settings(model_path, settings=None):
+    # The settings with what auto-tune measured best for this model on top
+    settings = dict(load_settings() if settings is None else settings)
+    tuned = load_tuned_settings(os.path.basename(model_path))
+    if tuned is not None:
+        settings.update({key: tuned[key] for key in ('threads', 'batch', 'gpu_layers')})
+    return settings
 
 
-def kill():
-    result = subprocess.run(['taskkill', '/f', '/im', 'server.exe'],
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.PIPE,
-                            creationflags=subprocess.CREATE_NO_WINDOW)
+def server_binary():
+    names = ['server.exe', 'llama-server.exe'] if os.name == 'nt' else ['server', 'llama-server']
+    for name in names:
+        path = os.path.join(backend_dir, name)
+        if os.path.exists(path):
+            return path
+    return os.path.join(backend_dir, names[0])
+
+
+def gpu_backend():
+    # Apple silicon builds always offload through Metal
+    if sys.platform == 'darwin' and platform.machine() == 'arm64':
+        return True
+    try:
+        names = os.listdir(backend_dir)
+    except OSError:
+        return False
+    return any(library in name.lower() for name in names for library in GPU_LIBRARIES)
+
+
+def build_command(port=SERVER_PORT, model_path=None, settings=None, draft_path=None, slot_path=slots_dir,
+                  slots=None):
+    if model_path is None:
+        model_path = selected_model_path()
+    if settings is None:
+        settings = model_settings(model_path)
+    if slots is None:
+        slots = parallel_slots(settings)
+
+    command = [
+        server_binary(),
+        '-m', model_path,
+        '--host', '127.0.0.1',
+        '--port', str(port),
+        '-t', str(settings['threads']),
+        '-c', str(settings['capacity'] * slots),
+        '-np', str(slots),
+        '-ngl', str(settings['gpu_layers']),
+        '-b', str(settings['batch']),
+        '--slot-save-path', slot_path
+    ]
+
+    # Group size 1 = LongLM disabled
+    if settings['grp_n'] > 1:
+        command += [
+            '--grp-attn-n', str(settings['grp_n']),
+            '--grp-attn-w', str(settings['grp_w'])
+        ]
 
-    if result.returncode == 0:
-        pass
-    else:
-        print("Error: Command failed with return code", result.returncode)
+    command += strategy_args(choose_load_strategy(model_path, settings)['strategy'])
+    command += draft_args(selected_draft_path() if draft_path is None else draft_path, settings)
+    return command
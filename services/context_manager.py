@@ -0,0 +1,245 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from services.http_client import get_client
+
+# Role markers and separators the chat template adds around every message
+MESSAGE_OVERHEAD = 4
+
+WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text):
+    return int(len(WORD_PATTERN.findall(text)) * 4 / 3) + 1
+
+
+class TokenCounter:
+    # Counts on the server's tokenizer from a thread of its own. A text not counted yet is estimated and queued,
+    # the caller counts it again once counted() has been called.
+    def __init__(self, retry_after=5.0, cache_size=4096):
+        self.retry_after = retry_after
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.server_down_since = None
+        self.online = True
+        # Called from the counting thread once the queued texts are counted
+        self.counted = None
+
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()
+        # Bumped by clear, a count for another model's vocabulary that comes back afterwards is not kept
+        self.generation = 0
+        self.worker = threading.Thread(target=self.count_loop, name="token-counter", daemon=True)
+        self.worker.start()
+
+    # Returns (tokens, exact), exact is False while the text waits for the server or the server can't be reached
+    def count(self, text):
+        with self.condition:
+            if text in self.cache:
+                self.cache.move_to_end(text)
+                return self.cache[text], True
+            if self.online and (self.server_down_since is None
+                                or time.monotonic() - self.server_down_since >= self.retry_after):
+                self.pending[text] = None
+                self.condition.notify()
+        return estimate_tokens(text), False
+
+    def clear(self):
+        with self.condition:
+            self.cache.clear()
+            self.pending.clear()
+            self.generation += 1
+
+    def count_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                text, _ = self.pending.popitem(last=False)
+                drained = not self.pending
+                generation = self.generation
+            try:
+                tokens = len(get_client().tokenize(text, timeout=(0.5, 5.0)))
+            except Exception:
+                # Asked again by the next count after retry_after
+                with self.condition:
+                    self.server_down_since = time.monotonic()
+                    self.pending.clear()
+                continue
+
+            with self.condition:
+                if generation != self.generation:
+                    continue
+                self.server_down_since = None
+                self.cache[text] = tokens
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                drained = drained and not self.pending
+            if drained and self.counted is not None:
+                self.counted()
+
+
+class ContextEntry:
+    __slots__ = ('role', 'content', 'tokens', 'exact')
+
+    def __init__(self, role, content, tokens, exact):
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+        self.exact = exact
+
+
+class ContextManager:
+    # The newest entries are kept in memory, older ones stay in the store until a fit or an undo reaches them.
+    # Positions are the same as in the store, the system prompt at position 0 is always loaded.
+    def __init__(self, counter=None, pin_system=True, drop_oldest=True, keep_turns=0, store=None):
+        self.counter = counter or TokenCounter()
+        # Entries are mirrored to a ChatStore so the context survives a restart
+        self.store = store
+        self.pin_system = pin_system
+        self.drop_oldest = drop_oldest
+        self.keep_turns = keep_turns
+
+        self.head = None
+        self.entries = []
+        # Position of entries[0]
+        self.offset = 0
+        self.fitted_tokens = 0
+
+        # Per-session text (clock, date...) kept out of the system prompt so the prompt prefix stays cacheable
+        self.volatile = ""
+        self.volatile_tokens = 0
+
+    def __len__(self):
+        return self.offset + len(self.entries)
+
+    def set_volatile(self, text):
+        self.volatile = text
+        self.volatile_tokens = self.counter.count(text)[0] if text else 0
+
+    def append(self, role, content):
+        tokens, exact = self.counter.count(content)
+        self.extend([ContextEntry(role, content, tokens + MESSAGE_OVERHEAD, exact)])
+
+    def truncate(self, length):
+        if length == 0:
+            self.head = None
+            self.entries = []
+            self.offset = 0
+        elif length <= self.offset:
+            self.entries = []
+            self.offset = length
+        else:
+            del self.entries[length - self.offset:]
+        if self.store is not None:
+            self.store.truncate(length)
+
+    def extend(self, entries):
+        # Entries cut off by truncate, put back with their counts
+        entries = list(entries)
+        if not entries:
+            return
+        if self.store is not None:
+            self.store.extend({'role': entry.role, 'content': entry.content, 'tokens': entry.tokens}
+                              for entry in entries)
+        if self.head is None:
+            self.head = entries[0]
+            self.offset = 1
+            entries = entries[1:]
+        self.entries.extend(entries)
+
+    def entry(self, position):
+        if position == 0:
+            return self.head
+        if position < self.offset:
+            self.load(position)
+        return self.entries[position - self.offset]
+
+    def read(self, start):
+        if max(start, 1) < self.offset:
+            self.load(max(start, 1))
+        entries = self.entries[max(start - self.offset, 0):]
+        return [self.head] + entries if start == 0 and self.head is not None else entries
+
+    def load(self, position, page=64):
+        # A page at a time from the store, counts are kept as estimates until the entry is counted again
+        start = max(1, min(position, self.offset - page))
+        rows = self.store.read(start, self.offset)
+        self.entries[:0] = [ContextEntry(row['role'], row['content'], row['tokens'], False) for row in rows]
+        self.offset = start
+
+    def resume(self, system_prompt):
+        # Picks up the saved conversation, only its system prompt is read now
+        self.head = None
+        self.entries = []
+        self.offset = 0
+        self.fitted_tokens = 0
+        saved = self.store.read(0, 1) if self.store is not None else []
+        if saved and saved[0]['role'] == "system" and saved[0]['content'] == system_prompt:
+            self.head = ContextEntry("system", system_prompt, saved[0]['tokens'], False)
+            self.offset = len(self.store)
+            return
+        # The system prompt changed in the settings, the rest of the conversation goes on under the new one
+        rows = self.store.read(0, len(self.store)) if self.store is not None else []
+        self.truncate(0)
+        self.append("system", system_prompt)
+        self.extend(ContextEntry(row['role'], row['content'], row['tokens'], False)
+                    for row in rows if row['role'] != "system")
+
+    def invalidate(self):
+        # Counts from another model's vocabulary, entries are counted again as a fit reaches them
+        for entry in self.entries:
+            entry.exact = False
+        if self.head is not None:
+            self.head.exact = False
+        if self.volatile:
+            self.set_volatile(self.volatile)
+
+    def recount(self, entry):
+        # Entries counted while the server was down, or loaded from the store, only hold an estimate
+        if not entry.exact:
+            tokens, entry.exact = self.counter.count(entry.content)
+            entry.tokens = tokens + MESSAGE_OVERHEAD
+
+    def fit(self, budget):
+        first = 0
+        pinned = []
+        if self.pin_system and self.head is not None and self.head.role == "system":
+            self.recount(self.head)
+            pinned = [self.head]
+            first = 1
+        used = sum(entry.tokens for entry in pinned)
+        # The volatile note goes into the first user turn, its room is set aside before turns are dropped
+        room = budget - used - (self.volatile_tokens if self.volatile else 0)
+
+        # Walks back from the newest entry, so a fit costs what goes into the request and not the whole history.
+        # The request starts at the oldest whole turn that still fits, or at the last entry when nothing does.
+        start = len(self)
+        fitted = suffix = users = 0
+        for position in range(len(self) - 1, first - 1, -1):
+            entry = self.entry(position)
+            if entry.role == "user":
+                users += 1
+                if users > self.keep_turns > 0:
+                    break
+            self.recount(entry)
+            suffix += entry.tokens
+            if self.drop_oldest and suffix > room and start < len(self):
+                break
+            if entry.role == "user" or position in (first, len(self) - 1):
+                start, fitted = position, suffix
+
+        messages = [{"role": entry.role, "content": entry.content} for entry in pinned + self.read(start)]
+        used += fitted
+
+        if self.volatile:
+            for message in messages:
+                if message["role"] == "user":
+                    message["content"] = f"{self.volatile}\n{message['content']}"
+                    used += self.volatile_tokens
+                    break
+
+        self.fitted_tokens = used
+        return messages
@@ -0,0 +1,477 @@
+import asyncio
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, Signal
+
+import services.settings_handler as Settings
+import services.tracing as tracing
+from services.http_client import get_client, abort, SERVER_URL
+from services.speculative import acceptance_from_timings
+from services.telemetry import get_telemetry
+
+SENTENCE_END = re.compile(r'[.?!]+["\')*]*\s+|\n+')
+
+CHAT_PATH = "/v1/chat/completions"
+
+INTERACTIVE = 0
+BACKGROUND = 1
+INTERACTIVE_KINDS = ("chat", "slot")
+
+
+class Job(QObject):
+    token_received = Signal(str)
+    sentence_received = Signal(str)
+    finished = Signal(str, int)
+    result = Signal(object)
+    failed = Signal(str)
+
+    def __init__(self, kind, path=None, payload=None, stream=False, method="POST", func=None, args=()):
+        super().__init__()
+        self.kind = kind
+        self.path = path
+        self.payload = payload
+        self.stream = stream
+        self.method = method
+        self.func = func
+        self.args = args
+        self.after = None
+        self.priority = INTERACTIVE if kind in INTERACTIVE_KINDS else BACKGROUND
+        self.slot = None
+        self.preempted = False
+        self.server = None
+
+        self.response = None
+        self.usage = None
+        self.timings = None
+        self.cache_stats = None
+        self.draft_stats = None
+        self.future = None
+        self.engine = None
+        self.task = None
+        self.partial = ""
+        self.cancelled = False
+        self.cancel_time = None
+        self.cancel_latency = None
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def cancel(self):
+        if self.cancelled or self.done():
+            return
+        self.cancelled = True
+        self.cancel_time = time.perf_counter()
+        if self.engine is not None:
+            self.engine.cancel(self)
+
+
+def chat_job(messages, temperature=0.7, penalty=1.0, stream=False, kind="chat", model="gpt-3.5-turbo",
+             max_tokens=-1):
+    payload = {
+        "model": model,
+        "cache_prompt": True,
+        "messages": list(messages),
+        "temperature": temperature,
+        "frequency_penalty": penalty
+    }
+    if max_tokens > 0:
+        payload["max_tokens"] = max_tokens
+    # stream only decides whether tokens are emitted as they come, the request itself is always streamed
+    return Job(kind, CHAT_PATH, payload, stream=stream)
+
+
+def call_job(func, *args, kind="translation"):
+    return Job(kind, func=func, args=args)
+
+
+def request_job(path, payload=None, kind="request"):
+    return Job(kind, path, payload, method="GET" if payload is None else "POST")
+
+
+def prompt_cache_stats(timings, usage):
+    if not timings or 'prompt_n' not in timings:
+        return None
+    evaluated = timings['prompt_n']
+    if 'cache_n' in timings:
+        cached = timings['cache_n']
+        total = cached + evaluated
+    elif usage and 'prompt_tokens' in usage:
+        total = usage['prompt_tokens']
+        cached = max(0, total - evaluated)
+    else:
+        return None
+    return {"cached": cached, "evaluated": evaluated, "total": total,
+            "ratio": cached / total if total else 0.0}
+
+
+async def iter_sse_chunks(lines):
+    async for line in lines:
+        if not line or not line.startswith("data:"):
+            continue
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            break
+        yield json.loads(payload)
+
+
+class CompletionEngine:
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.client = None
+        # Local CPU work such as translation, one worker so it never competes with itself
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine-blocking")
+        # Calls on the shared HTTP client block, one worker per pooled connection so a long reply on one slot
+        # never holds up a request for another
+        self.http_executor = ThreadPoolExecutor(max_workers=Settings.load_network_settings()['pool_size'],
+                                                thread_name_prefix="engine-http")
+        self.jobs = set()
+        self.lock = threading.Lock()
+        self.closing = False
+        self.server_url = SERVER_URL
+
+        # Server slot scheduling, slot 0 is kept for the interactive chat
+        self.slot_count = 1
+        self.busy_slots = {}
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.wait_times = {INTERACTIVE: deque(maxlen=100), BACKGROUND: deque(maxlen=100)}
+
+    def set_slot_count(self, count):
+        self.slot_count = max(1, count)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._dispatch)
+
+    def set_server_url(self, url):
+        # Jobs keep the server they were submitted to
+        self.server_url = url
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,), name="completion-engine", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.client = get_client()
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def submit(self, job):
+        self.start()
+        job.engine = self
+        if job.server is None:
+            job.server = self.server_url
+        with self.lock:
+            self.jobs.add(job)
+        job.future = asyncio.run_coroutine_threadsafe(self._execute(job), self.loop)
+        job.future.add_done_callback(lambda _: self._forget(job))
+        return job
+
+    def _forget(self, job):
+        with self.lock:
+            self.jobs.discard(job)
+
+    def cancel(self, job):
+        self.loop.call_soon_threadsafe(self._cancel_task, job)
+
+    def _cancel_task(self, job):
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+
+    def pending(self):
+        with self.lock:
+            return len(self.jobs)
+
+    async def _execute(self, job):
+        job.task = asyncio.current_task()
+        # Coroutines interleave on the loop thread, so engine spans are async spans keyed by job
+        tracing.begin(job.kind, job, "engine")
+        try:
+            if job.after is not None and job.after.future is not None:
+                # Ordering only, the outcome of the previous job does not matter
+                await asyncio.wait([asyncio.wrap_future(job.after.future)])
+            if job.cancelled:
+                raise asyncio.CancelledError
+            if job.func is not None:
+                value = await self.loop.run_in_executor(self.executor, job.func, *job.args)
+                job.result.emit(value)
+            elif job.path == CHAT_PATH:
+                await self._run_scheduled(job, self._run_chat)
+            elif job.kind == "slot":
+                # Saving or restoring the chat slot's KV cache waits for the slot like a reply does
+                await self._run_scheduled(job, self._run_request)
+            else:
+                await self._run_request(job)
+        except asyncio.CancelledError:
+            if self.closing:
+                raise
+            await self._finish_cancelled(job)
+        except Exception as e:
+            print(f"Error in {job.kind} job: {e}")
+            job.failed.emit(str(e))
+        finally:
+            tracing.end(job.kind, job, "engine", cancelled=job.cancelled)
+
+    async def _run_scheduled(self, job, run):
+        while True:
+            slot = None
+            try:
+                # A job can be handed a slot and preempted before it resumes, that has to be requeued as well
+                slot = await self._acquire_slot(job)
+                await run(job)
+                return
+            except asyncio.CancelledError:
+                if not job.preempted or job.cancelled or self.closing:
+                    raise
+                # Gave the slot up to the chat, run again from scratch once a slot is free. job.preempted tells the
+                # preemption apart from a real cancel; 3.11 also counts cancel requests, the one handled is taken back
+                task = asyncio.current_task()
+                if hasattr(task, "uncancel"):
+                    task.uncancel()
+                job.preempted = False
+                job.partial = ""
+                print(f"{job.kind} job preempted, requeued")
+            finally:
+                if slot is not None:
+                    self._release_slot(slot)
+
+    async def _acquire_slot(self, job):
+        future = self.loop.create_future()
+        entry = (job.priority, next(self.sequence), job, future)
+        start = self.loop.time()
+        self.waiters.append(entry)
+        self._dispatch()
+        tracing.begin("slot_wait", future, "engine")
+        try:
+            slot = await future
+        except asyncio.CancelledError:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+            elif future.done() and not future.cancelled():
+                self._release_slot(future.result())
+            raise
+        finally:
+            tracing.end("slot_wait", future, "engine")
+        self.wait_times[job.priority].append(self.loop.time() - start)
+        return slot
+
+    def _release_slot(self, slot):
+        self.busy_slots.pop(slot, None)
+        self._dispatch()
+
+    def _free_slot(self, job):
+        if job.priority == INTERACTIVE:
+            candidates = [0]
+        elif self.slot_count > 1:
+            candidates = range(1, self.slot_count)
+        elif any(entry[0] == INTERACTIVE for entry in self.waiters):
+            candidates = []
+        else:
+            candidates = [0]
+        for slot in candidates:
+            if slot not in self.busy_slots:
+                return slot
+        return None
+
+    def _dispatch(self):
+        self.waiters.sort(key=lambda entry: entry[:2])
+        for entry in list(self.waiters):
+            priority, _, job, future = entry
+            if future.done():
+                self.waiters.remove(entry)
+                continue
+            slot = self._free_slot(job)
+            if slot is None:
+                holder = self.busy_slots.get(0)
+                if (priority == INTERACTIVE and holder is not None and holder.priority == BACKGROUND
+                        and not holder.preempted):
+                    holder.preempted = True
+                    holder.task.cancel()
+                continue
+            self.waiters.remove(entry)
+            self.busy_slots[slot] = job
+            job.slot = slot
+            future.set_result(slot)
+
+    def stats(self):
+        queued = [entry[0] for entry in self.waiters]
+        return {
+            "slots": self.slot_count,
+            "busy": len(self.busy_slots),
+            "queued_interactive": queued.count(INTERACTIVE),
+            "queued_background": queued.count(BACKGROUND),
+            "wait_ms_interactive": self._average_wait(INTERACTIVE),
+            "wait_ms_background": self._average_wait(BACKGROUND),
+        }
+
+    def _average_wait(self, priority):
+        times = list(self.wait_times[priority])
+        return sum(times) / len(times) * 1000 if times else 0.0
+
+    async def _finish_cancelled(self, job):
+        # The response socket is already closed at this point, which is what makes llama.cpp drop the task
+        await self._wait_server_idle(job.server)
+        if job.cancel_time is not None:
+            job.cancel_latency = time.perf_counter() - job.cancel_time
+            print(f"Cancelled {job.kind} job, server idle after {job.cancel_latency * 1000:.0f} ms")
+
+        if job.path == CHAT_PATH:
+            job.finished.emit(job.partial, -1)
+
+    async def _wait_server_idle(self, server, timeout=1.0):
+        deadline = self.loop.time() + timeout
+        while self.loop.time() < deadline:
+            try:
+                health = (await self._call(self.client.get, server + "/health", (0.5, 1.0))).json()
+            except Exception:
+                return
+            if health.get("slots_processing", 0) == 0:
+                return
+            await asyncio.sleep(0.02)
+
+    async def _call(self, func, *args):
+        return await self.loop.run_in_executor(self.http_executor, func, *args)
+
+    async def _open(self, url, payload):
+        # Returns once the response headers are in; a request cancelled before that is closed when they arrive
+        future = self.http_executor.submit(self.client.post, url, payload, True)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda done: done.cancelled() or done.exception() or abort(done.result()))
+            raise
+
+    async def _iter_lines(self, response):
+        lines = response.iter_lines(chunk_size=None)
+        while (line := await self._call(next, lines, None)) is not None:
+            yield line.decode("utf-8", errors="replace")
+
+    async def _run_request(self, job):
+        if job.method == "GET":
+            response = await self._call(self.client.get, job.server + job.path)
+        else:
+            response = await self._call(self.client.post, job.server + job.path, job.payload)
+        response.raise_for_status()
+        job.response = response.json()
+        job.result.emit(job.response)
+
+    async def _run_chat(self, job):
+        start_time = time.perf_counter()
+        sentence = ""
+        total_tokens_used = -1
+        # Streamed even when the caller wants the whole reply: the response, and with it the socket a cancel
+        # shuts down, exists as soon as the server takes the request instead of after the last token
+        payload = dict(job.payload, id_slot=job.slot, slot_id=job.slot, stream=True,
+                       stream_options={"include_usage": True})
+
+        # Until the first token is mostly prompt eval, after it is decoding
+        tracing.begin("prompt_eval", job, "engine")
+        response = None
+        completed = False
+        try:
+            response = await self._open(job.server + job.path, payload)
+            response.raise_for_status()
+            lines = self._iter_lines(response)
+            async for chunk in iter_sse_chunks(lines):
+                if chunk.get('usage'):
+                    job.usage = chunk['usage']
+                    total_tokens_used = job.usage['total_tokens']
+                if chunk.get('timings'):
+                    job.timings = chunk['timings']
+
+                choices = chunk.get('choices') or [{}]
+                content = choices[0].get('delta', {}).get('content')
+                if not content:
+                    continue
+
+                if job.partial == "":
+                    print(f"First token after {time.perf_counter() - start_time:.2f}s")
+                    tracing.end("prompt_eval", job, "engine")
+                    tracing.begin("decode", job, "engine")
+                job.partial += content
+                if not job.stream:
+                    continue
+                job.token_received.emit(content)
+
+                sentence += content
+                match = SENTENCE_END.search(sentence)
+                if match:
+                    job.sentence_received.emit(sentence[:match.end()].strip())
+                    sentence = sentence[match.end():]
+
+            # Read past [DONE] to the end of the body so the connection can go back to the pool
+            async for _ in lines:
+                pass
+            completed = True
+        finally:
+            timings = job.timings or {}
+            tracing.end("decode" if job.partial else "prompt_eval", job, "engine",
+                        server_prompt_ms=timings.get('prompt_ms'), server_predicted_ms=timings.get('predicted_ms'))
+            if response is not None:
+                if completed:
+                    response.close()
+                else:
+                    abort(response)
+
+        if sentence.strip():
+            job.sentence_received.emit(sentence.strip())
+
+        self._report_cache(job)
+        print(total_tokens_used)
+        job.finished.emit(job.partial, total_tokens_used)
+
+    def _report_cache(self, job):
+        get_telemetry().record(job)
+        job.cache_stats = prompt_cache_stats(job.timings, job.usage)
+        if job.cache_stats is not None:
+            print(f"Prompt cache: {job.cache_stats['cached']}/{job.cache_stats['total']} tokens reused "
+                  f"({job.cache_stats['ratio']:.1%})")
+
+        job.draft_stats = acceptance_from_timings(job.timings)
+        if job.draft_stats is not None:
+            print(f"Draft acceptance: {job.draft_stats['rate']:.1%}, "
+                  f"{job.draft_stats['tokens_per_second']:.1f} tokens/s")
+
+    def shutdown(self, timeout=2.0):
+        if self.thread is None:
+            return
+        self.closing = True
+
+        async def cancel_all():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(cancel_all(), self.loop).result(timeout)
+        except Exception as e:
+            print(f"Engine shutdown: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.http_executor.shutdown(wait=False, cancel_futures=True)
+        self.thread = None
+        self.closing = False
+
+
+_engine = None
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = CompletionEngine()
+    return _engine
@@ -0,0 +1,143 @@
+import json
+import socket
+import threading
+import time
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import services.settings_handler as Settings
+
+SERVER_URL = "http://127.0.0.1:35634"
+
+
+class HttpClient:
+    def __init__(self, base_url=SERVER_URL, connect_timeout=3.0, read_timeout=600.0, pool_size=8):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+
+        # One keep-alive pool per resident server. Only a failed connect is retried; a POST is never sent twice.
+        # A pooled connection the server has since closed is dropped by urllib3 when it is taken from the pool,
+        # so only a close racing the send itself surfaces as an error
+        self.session = requests.Session()
+        retries = Retry(total=1, connect=1, read=0, status=0, other=0, redirect=0, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": "Bearer no-key",
+        })
+        self.encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def url(self, path):
+        return urljoin(self.base_url, path)
+
+    def post(self, path, payload, stream=False, timeout=None):
+        body = self.encoder.encode(payload).encode("utf-8")
+        return self.session.post(self.url(path), data=body, stream=stream, timeout=timeout or self.timeout)
+
+    def get(self, path, timeout=None):
+        return self.session.get(self.url(path), timeout=timeout or self.timeout)
+
+    def post_json(self, path, payload, timeout=None):
+        response = self.post(path, payload, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def tokenize(self, text, timeout=None):
+        return self.post_json("/tokenize", {"content": text}, timeout=timeout)["tokens"]
+
+    def embedding(self, text, timeout=None):
+        return self.post_json("/embedding", {"content": text}, timeout=timeout)["embedding"]
+
+    def close(self):
+        self.session.close()
+
+
+def abort(response):
+    # Shutting the socket down wakes a worker blocked reading the response, and the server sees the client leave
+    connection = getattr(response.raw, '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+_server_url = SERVER_URL
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            settings = Settings.load_network_settings()
+            _client = HttpClient(base_url=_server_url,
+                                 connect_timeout=settings['connect_timeout'],
+                                 read_timeout=settings['read_timeout'],
+                                 pool_size=settings['pool_size'])
+        return _client
+
+
+def set_server_url(url):
+    global _server_url
+    with _client_lock:
+        _server_url = url
+        if _client is not None:
+            _client.base_url = url
+
+
+def close_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: per-request overhead of a fresh connection vs the pooled client
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = b'{"choices":[{"message":{"content":"ok"}}],"usage":{"total_tokens":1}}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    payload = {"messages": [{"role": "user", "content": "Hello " * 200}], "cache_prompt": True}
+    rounds = 500
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        requests.post(url + "/v1/chat/completions", json=payload).json()
+    before = (time.perf_counter() - start) / rounds * 1000
+
+    client = HttpClient(base_url=url)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        client.post_json("/v1/chat/completions", payload)
+    after = (time.perf_counter() - start) / rounds * 1000
+
+    print(f"requests.post: {before:.3f} ms/request")
+    print(f"HttpClient:    {after:.3f} ms/request")
+    server.shutdown()
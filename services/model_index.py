@@ -0,0 +1,226 @@
+import json
+import math
+import os
+import re
+import struct
+
+GGUF_MAGIC = b'GGUF'
+DEFAULT_ALIGNMENT = 32
+
+# GGUF metadata value types
+UINT8, INT8, UINT16, INT16, UINT32, INT32, FLOAT32, BOOL, STRING, ARRAY, UINT64, INT64, FLOAT64 = range(13)
+SCALAR_FORMATS = {
+    UINT8: '<B', INT8: '<b', UINT16: '<H', INT16: '<h', UINT32: '<I', INT32: '<i',
+    FLOAT32: '<f', BOOL: '<?', UINT64: '<Q', INT64: '<q', FLOAT64: '<d'
+}
+
+# llama_ftype, what general.file_type stores
+FILE_TYPES = {
+    0: 'F32', 1: 'F16', 2: 'Q4_0', 3: 'Q4_1', 7: 'Q8_0', 8: 'Q5_0', 9: 'Q5_1', 10: 'Q2_K', 11: 'Q3_K_S',
+    12: 'Q3_K_M', 13: 'Q3_K_L', 14: 'Q4_K_S', 15: 'Q4_K_M', 16: 'Q5_K_S', 17: 'Q5_K_M', 18: 'Q6_K',
+    19: 'IQ2_XXS', 20: 'IQ2_XS', 21: 'Q2_K_S', 22: 'IQ3_XS', 23: 'IQ3_XXS', 24: 'IQ1_S', 25: 'IQ4_NL',
+    26: 'IQ3_S', 27: 'IQ3_M', 28: 'IQ2_S', 29: 'IQ2_M', 30: 'IQ4_XS', 31: 'IQ1_M', 32: 'BF16'
+}
+
+LAYER_PATTERN = re.compile(r'blk\.(\d+)\.')
+
+# Compute buffers and runtime overhead llama.cpp allocates on top of weights and KV cache
+COMPUTE_OVERHEAD = 256 * 1024 * 1024
+
+
+class GGUFReader:
+    def __init__(self, file):
+        self.file = file
+
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        data = self.file.read(size)
+        if len(data) != size:
+            raise ValueError("unexpected end of GGUF header")
+        return struct.unpack(fmt, data)[0]
+
+    def string(self):
+        return self.file.read(self.unpack('<Q')).decode('utf-8', errors='replace')
+
+    def value(self, value_type):
+        if value_type == STRING:
+            return self.string()
+        if value_type == ARRAY:
+            item_type = self.unpack('<I')
+            count = self.unpack('<Q')
+            # Vocabularies are large, only their length is kept
+            if item_type in SCALAR_FORMATS:
+                self.file.seek(count * struct.calcsize(SCALAR_FORMATS[item_type]), os.SEEK_CUR)
+            elif item_type == STRING:
+                for _ in range(count):
+                    self.file.seek(self.unpack('<Q'), os.SEEK_CUR)
+            else:
+                for _ in range(count):
+                    self.value(item_type)
+            return count
+        return self.unpack(SCALAR_FORMATS[value_type])
+
+
+def read_gguf(path):
+    # Reads metadata and tensor infos only, tensor data is never touched
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        reader = GGUFReader(file)
+        if file.read(4) != GGUF_MAGIC:
+            raise ValueError(f"{os.path.basename(path)} is not a GGUF file")
+        version = reader.unpack('<I')
+        count_format = '<I' if version == 1 else '<Q'
+        tensor_count = reader.unpack(count_format)
+        kv_count = reader.unpack(count_format)
+
+        metadata = {}
+        for _ in range(kv_count):
+            key = reader.string()
+            metadata[key] = reader.value(reader.unpack('<I'))
+
+        tensors = []
+        for _ in range(tensor_count):
+            name = reader.string()
+            n_dims = reader.unpack('<I')
+            elements = 1
+            for _ in range(n_dims):
+                elements *= reader.unpack('<Q')
+            reader.unpack('<I')
+            tensors.append((name, elements, reader.unpack('<Q')))
+
+        alignment = metadata.get('general.alignment', DEFAULT_ALIGNMENT)
+        data_start = (file.tell() + alignment - 1) // alignment * alignment
+
+    # Tensor data is laid out back to back, so offsets give exact byte sizes for any quant type
+    tensors.sort(key=lambda tensor: tensor[2])
+    ends = [tensor[2] for tensor in tensors[1:]] + [file_size - data_start]
+
+    arch = metadata.get('general.architecture', '')
+    layer_bytes = [0] * metadata.get(f'{arch}.block_count', 0)
+    other_bytes = 0
+    output_bytes = 0
+    parameters = 0
+    for (name, elements, offset), end in zip(tensors, ends):
+        parameters += elements
+        match = LAYER_PATTERN.match(name)
+        if match and int(match.group(1)) < len(layer_bytes):
+            layer_bytes[int(match.group(1))] += end - offset
+        else:
+            other_bytes += end - offset
+            if name.startswith('output'):
+                output_bytes += end - offset
+
+    head_count = metadata.get(f'{arch}.attention.head_count', 0)
+    embedding = metadata.get(f'{arch}.embedding_length', 0)
+    return {
+        'name': metadata.get('general.name', os.path.basename(path)),
+        'architecture': arch,
+        'parameters': parameters,
+        'file_type': FILE_TYPES.get(metadata.get('general.file_type'), 'unknown'),
+        'context_length': metadata.get(f'{arch}.context_length', 0),
+        'layers': len(layer_bytes),
+        'embedding_length': embedding,
+        'kv_length': embedding * metadata.get(f'{arch}.attention.head_count_kv', head_count) // max(head_count, 1),
+        'vocab_size': metadata.get('tokenizer.ggml.tokens', 0),
+        'layer_bytes': layer_bytes,
+        'other_bytes': other_bytes,
+        'output_bytes': output_bytes,
+        'weight_bytes': sum(layer_bytes) + other_bytes
+    }
+
+
+class ModelIndex:
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.dirty = False
+        try:
+            with open(cache_path, 'r') as file:
+                self.entries = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    def get(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = os.path.abspath(path)
+        entry = self.entries.get(key)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['info']
+
+        try:
+            info = read_gguf(path)
+        except (OSError, ValueError, UnicodeDecodeError, struct.error) as e:
+            print(f"Model index: can't read {path}: {e}")
+            info = None
+        self.entries[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'info': info}
+        self.dirty = True
+        return info
+
+    def scan(self, directory):
+        models = {}
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('gguf'):
+                models[filename] = self.get(os.path.join(directory, filename))
+        self.save()
+        return models
+
+    def save(self):
+        if self.dirty:
+            with open(self.cache_path, 'w') as file:
+                json.dump(self.entries, file)
+            self.dirty = False
+
+
+def estimate_memory(info, capacity, gpu_layers, slots=1, batch=512):
+    # llama.cpp offloads the last gpu_layers blocks, and the output layer once every block is offloaded
+    layers = info['layers']
+    offloaded = min(gpu_layers, layers)
+    gpu_weights = sum(info['layer_bytes'][layers - offloaded:])
+    if gpu_layers > layers:
+        gpu_weights += info['output_bytes']
+
+    # F16 K and V per layer, the cache of an offloaded layer lives in VRAM
+    kv_per_layer = 2 * capacity * slots * info['kv_length'] * 2
+    logits = batch * info['vocab_size'] * 4
+
+    ram = info['weight_bytes'] - gpu_weights + kv_per_layer * (layers - offloaded) + logits + COMPUTE_OVERHEAD
+    vram = gpu_weights + kv_per_layer * offloaded + (COMPUTE_OVERHEAD if offloaded else 0)
+    return {'ram': ram, 'vram': vram}
+
+
+def suggest_grp(trained, capacity, window=512):
+    # Self-Extend covers (T - W) * G + W tokens, the simpler G * T >= C rule in the tooltip rounds this up
+    if trained <= 0 or capacity <= trained:
+        return 1, window
+    window = min(window, trained // 2)
+    return math.ceil((capacity - window) / (trained - window)), window
+
+
+def describe(info):
+    return (f"{info['name']}\n{info['architecture']}, {info['parameters'] / 1e9:.1f}B parameters, "
+            f"{info['file_type']}\nTrained context: {info['context_length']}, {info['layers']} layers\n"
+            f"Weights: {info['weight_bytes'] / 1024 ** 3:.2f} GB")
+
+
+if __name__ == "__main__":
+    # Benchmark: index a models directory cold, then again from the cache.
+    import sys
+    import tempfile
+    import time
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.getcwd(), 'models')
+    cache_path = os.path.join(tempfile.mkdtemp(), 'model_index.json')
+
+    start = time.perf_counter()
+    models = ModelIndex(cache_path).scan(directory)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ModelIndex(cache_path).scan(directory)
+    warm = time.perf_counter() - start
+
+    for filename, info in models.items():
+        print(f"{filename}: " + (describe(info).replace('\n', ' | ') if info else "unreadable"))
+    print(f"{len(models)} models: first scan {cold * 1000:.1f} ms, cached scan {warm * 1000:.1f} ms")
@@ -18,6 +18,7 @@ class NotificationThread(QThread):
 
 
 def show_notification(title, description, self=None):
-    self.thread = NotificationThread(title, description)
-    self.thread.finished_signal.connect(lambda: print("Notification viewed"))
-    self.thread.start()
+    # self.thread is the window's resource monitor
+    self.notification_thread = NotificationThread(title, description)
+    self.notification_thread.finished_signal.connect(lambda: print("Notification viewed"))
+    self.notification_thread.start()
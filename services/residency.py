@@ -0,0 +1,146 @@
+import os
+import time
+from collections import OrderedDict
+
+import psutil
+from PySide6.QtCore import QObject, Signal
+
+import services.completion as Server
+import services.settings_handler as Settings
+from services.engine import get_engine
+from services.http_client import set_server_url
+from services.model_index import ModelIndex, estimate_memory
+from services.server_supervisor import ServerSupervisor
+from services.slot_cache import SlotCache
+
+# SERVER_PORT + 1 belongs to the auto-tuner
+EXTRA_PORT_START = Server.SERVER_PORT + 2
+
+
+class Resident:
+    def __init__(self, model_path, port, supervisor, slot_cache, footprint, slots):
+        self.model_path = model_path
+        self.port = port
+        self.supervisor = supervisor
+        self.slot_cache = slot_cache
+        self.footprint = footprint
+        self.slots = slots
+        self.last_used = time.time()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def name(self):
+        return os.path.basename(self.model_path)
+
+
+class ResidencyManager(QObject):
+    # Only forwarded for the active model
+    ready = Signal(float)
+    crashed = Signal(int)
+    status_changed = Signal(str)
+
+    def __init__(self, settings=None):
+        super().__init__()
+        self.settings = settings if settings is not None else Settings.load_settings()
+        self.model_index = ModelIndex(os.path.join(Server.temp_dir, 'model_index.json'))
+        # Least recently used first
+        self.residents = OrderedDict()
+        self.active = None
+        # Evicted servers still shutting down by port, their ports are not handed out again until they are gone
+        self.stopping = {}
+
+    def budget_bytes(self):
+        if self.settings['resident_mb'] > 0:
+            return self.settings['resident_mb'] * 1024 * 1024
+        return int(psutil.virtual_memory().total * 0.75)
+
+    def footprint(self, model_path, info, settings, slots):
+        if info is None:
+            return os.path.getsize(model_path)
+        return estimate_memory(info, settings['capacity'], settings['gpu_layers'], slots, settings['batch'])['ram']
+
+    def is_ready(self):
+        return self.active is not None and self.active.supervisor.is_ready
+
+    def _free_port(self):
+        used = {resident.port for resident in self.residents.values()} | set(self.stopping)
+        if Server.SERVER_PORT not in used:
+            return Server.SERVER_PORT
+        port = EXTRA_PORT_START
+        while port in used:
+            port += 1
+        return port
+
+    def activate(self, model_path):
+        self.settings = Settings.load_settings()
+        resident = self.residents.get(model_path)
+        if resident is None:
+            info = self.model_index.get(model_path)
+            self.model_index.save()
+            settings = Server.model_settings(model_path, self.settings)
+            slots = Server.parallel_slots(settings, info)
+            footprint = self.footprint(model_path, info, settings, slots)
+            self._make_room(footprint)
+            resident = self._launch(model_path, footprint, slots)
+        self.residents.move_to_end(model_path)
+        resident.last_used = time.time()
+
+        # New jobs and token counts go to this instance, jobs already running finish where they are
+        self.active = resident
+        get_engine().set_server_url(resident.url)
+        get_engine().set_slot_count(resident.slots)
+        set_server_url(resident.url)
+        if resident.supervisor.is_ready:
+            self.status_changed.emit(f"<font color='#b3b7b7'>Switched to</font> {resident.name}")
+        return resident
+
+    def _make_room(self, needed):
+        budget = self.budget_bytes()
+        if needed > budget:
+            print(f"Residency: {needed / 1024 ** 3:.1f} GB model is over the {budget / 1024 ** 3:.1f} GB budget")
+        while self.residents and (len(self.residents) >= self.settings['max_resident']
+                                  or sum(r.footprint for r in self.residents.values()) + needed > budget):
+            self.evict(next(iter(self.residents)))
+
+    def _launch(self, model_path, footprint, slots):
+        port = self._free_port()
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        log_path = Server.log_path if port == Server.SERVER_PORT else os.path.join(
+            Server.temp_dir, f'llama_output_{port}.log')
+        # Saved KV states only fit the model that made them, so each model keeps its own directory
+        slot_path = os.path.join(Server.slots_dir, name)
+        slot_cache = SlotCache(slot_path, self.settings['slot_cache_mb'])
+        slot_cache.validate(model_path)
+
+        supervisor = ServerSupervisor(port=port, log_path=log_path)
+        supervisor.command_factory = lambda: Server.build_command(port, model_path, slot_path=slot_path, slots=slots)
+        resident = Resident(model_path, port, supervisor, slot_cache, footprint, slots)
+        supervisor.ready.connect(lambda seconds: resident is self.active and self.ready.emit(seconds))
+        supervisor.crashed.connect(lambda code: resident is self.active and self.crashed.emit(code))
+        supervisor.status_changed.connect(lambda text: resident is self.active and self.status_changed.emit(text))
+
+        self.residents[model_path] = resident
+        print(f"Residency: loading {resident.name} on port {port} (~{footprint / 1024 ** 3:.1f} GB, "
+              f"{slots} slot{'s' if slots > 1 else ''})")
+        supervisor.start()
+        return resident
+
+    def evict(self, model_path):
+        resident = self.residents.pop(model_path)
+        print(f"Residency: evicting {resident.name} from port {resident.port}")
+        self.stopping[resident.port] = resident.supervisor
+        resident.supervisor.stopped.connect(lambda: self.stopping.pop(resident.port, None))
+        resident.supervisor.stop()
+        if resident is self.active:
+            self.active = None
+
+    def stop_all(self):
+        for model_path in list(self.residents):
+            self.evict(model_path)
+
+    def wait_stopped(self, timeout=None):
+        for supervisor in list(self.stopping.values()):
+            supervisor.wait(timeout)
@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+from collections import deque
+
+import psutil
+from PySide6.QtCore import QThread, Signal
+
+# Seconds between samples
+BUSY_INTERVAL = 0.25
+NORMAL_INTERVAL = 1.0
+IDLE_INTERVAL = 5.0
+HIDDEN_INTERVAL = 15.0
+IDLE_AFTER = 60.0
+
+
+def page_faults(process, memory_info):
+    if hasattr(memory_info, 'num_page_faults'):
+        return memory_info.num_page_faults
+    if hasattr(memory_info, 'pfaults'):
+        return memory_info.pfaults
+    # Linux: minflt and majflt from /proc, the command name may contain spaces so split after it
+    try:
+        with open(f'/proc/{process.pid}/stat', 'r') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+        return int(fields[7]) + int(fields[9])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class ResourceMonitor(QThread):
+    update_signal = Signal(str)
+
+    def __init__(self, history=600):
+        super().__init__()
+        # Bounded time series: 'system', 'app' (this process, including the in-process translator) and 'server'
+        self.series = {name: deque(maxlen=history) for name in ('system', 'app', 'server')}
+        self.lock = threading.Lock()
+        self.pid_source = lambda: None
+        self.context_source = lambda: 0
+        self.processes = {}
+
+        self.busy = False
+        self.visible = True
+        self.last_activity = time.monotonic()
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+
+    def set_busy(self, busy):
+        self.busy = busy
+        self.last_activity = time.monotonic()
+        self.wake.set()
+
+    def set_visible(self, visible):
+        self.visible = visible
+        self.wake.set()
+
+    def interval(self):
+        if self.busy:
+            return BUSY_INTERVAL
+        if not self.visible:
+            return HIDDEN_INTERVAL
+        if time.monotonic() - self.last_activity > IDLE_AFTER:
+            return IDLE_INTERVAL
+        return NORMAL_INTERVAL
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake.set()
+
+    def run(self):
+        psutil.cpu_percent(interval=None)
+        while not self.stop_event.is_set():
+            now = time.time()
+            system = {'time': now, 'cpu': psutil.cpu_percent(interval=None),
+                      'available': psutil.virtual_memory().available}
+            app = self.sample_process(os.getpid(), now)
+            server = self.sample_process(self.pid_source(), now)
+
+            with self.lock:
+                self.series['system'].append(system)
+                if app is not None:
+                    self.series['app'].append(app)
+                if server is not None:
+                    server['context'] = self.context_source()
+                    self.series['server'].append(server)
+
+            status_str = (f"<font color='#b3b7b7'>CPU:</font> {system['cpu']}% <font color='#b3b7b7'> Free RAM:</font> "
+                          f"{system['available'] / 1073741824:.2f}GB")
+            if server is not None:
+                status_str += f" <font color='#b3b7b7'> Server:</font> {server['rss'] / 1073741824:.2f}GB"
+            self.update_signal.emit(status_str)
+
+            self.wake.wait(self.interval())
+            self.wake.clear()
+
+            # TODO: how to monitor GPU and VRAM.... pynvml?
+
+    def sample_process(self, pid, now):
+        if pid is None:
+            return None
+        process = self.processes.get(pid)
+        try:
+            if process is None:
+                # cpu_percent compares against the previous call on the same object, so keep it
+                process = self.processes[pid] = psutil.Process(pid)
+                process.cpu_percent(interval=None)
+            with process.oneshot():
+                memory_info = process.memory_info()
+                return {'time': now, 'rss': memory_info.rss, 'cpu': process.cpu_percent(interval=None),
+                        'threads': process.num_threads(), 'faults': page_faults(process, memory_info)}
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            self.processes.pop(pid, None)
+            return None
+
+    def latest(self, name):
+        with self.lock:
+            return self.series[name][-1] if self.series[name] else None
+
+    def history(self, name, since=0.0):
+        with self.lock:
+            return [sample for sample in self.series[name] if sample['time'] >= since]
@@ -0,0 +1,152 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+
+import requests
+from PySide6.QtCore import QObject, Signal
+
+import services.completion as Server
+from services.http_client import get_client
+
+
+class ServerSupervisor(QObject):
+    ready = Signal(float)
+    crashed = Signal(int)
+    stopped = Signal()
+    status_changed = Signal(str)
+
+    def __init__(self, port=Server.SERVER_PORT, log_path=Server.log_path, max_restarts=5,
+                 ready_timeout=600.0, stop_timeout=5.0):
+        super().__init__()
+        self.port = port
+        self.log_path = log_path
+        self.max_restarts = max_restarts
+        self.ready_timeout = ready_timeout
+        self.stop_timeout = stop_timeout
+
+        self.process = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.is_ready = False
+        self.ready_seconds = None
+        self.command_factory = lambda: Server.build_command(port=self.port)
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+
+    def health_url(self):
+        return f"http://127.0.0.1:{self.port}/health"
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._supervise, name=f"server-supervisor-{self.port}", daemon=True)
+        self.thread.start()
+
+    def _launch(self):
+        flags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+        with open(self.log_path, 'w') as output_file:
+            return subprocess.Popen(self.command_factory(), stdout=output_file, stderr=subprocess.STDOUT,
+                                    creationflags=flags)
+
+    def _supervise(self):
+        restarts = 0
+        backoff = 1.0
+        while not self.stop_event.is_set():
+            start = time.monotonic()
+            self.status_changed.emit("Loading model...")
+            try:
+                self.process = self._launch()
+            except OSError as e:
+                print(f"Server failed to launch: {e}")
+                self.status_changed.emit("Server failed to launch")
+                break
+            if self.stop_event.is_set():
+                # stop() came while the process was being started
+                self._interrupt()
+
+            if self._wait_ready():
+                self.ready_seconds = time.monotonic() - start
+                self.is_ready = True
+                print(f"Server ready in {self.ready_seconds:.1f}s (pid {self.process.pid})")
+                self.ready.emit(self.ready_seconds)
+                restarts = 0
+                backoff = 1.0
+
+            code = self._wait_exit()
+            self.is_ready = False
+            if self.stop_event.is_set():
+                break
+
+            print("Server exited with error code:", code)
+            self.crashed.emit(code)
+            restarts += 1
+            if restarts > self.max_restarts:
+                self.status_changed.emit(f"Server crashed {restarts} times, giving up")
+                break
+
+            self.status_changed.emit(f"Server crashed, restarting in {backoff:.0f}s")
+            if self.stop_event.wait(backoff):
+                break
+            backoff = min(backoff * 2, 30.0)
+
+        self.process = None
+        self.stopped.emit()
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline and not self.stop_event.is_set():
+            if self.process.poll() is not None:
+                return False
+            try:
+                response = get_client().get(self.health_url(), timeout=1.0)
+                if response.status_code == 200 and response.json().get('status', 'ok') == 'ok':
+                    return True
+            except (requests.RequestException, ValueError):
+                pass
+            # 503 while the model is loading
+            self.stop_event.wait(0.25)
+        return False
+
+    def _wait_exit(self):
+        # Until the server exits, after stop() it gets stop_timeout to do so before it is killed
+        deadline = None
+        while True:
+            try:
+                return self.process.wait(0.25)
+            except subprocess.TimeoutExpired:
+                pass
+            if not self.stop_event.is_set():
+                continue
+            if deadline is None:
+                deadline = time.monotonic() + self.stop_timeout
+            elif time.monotonic() > deadline:
+                print(f"Server pid {self.process.pid} did not exit, killing it")
+                self.process.kill()
+
+    def stop(self):
+        # Returns at once, the supervisor thread waits for the exit and emits stopped
+        self.stop_event.set()
+        self._interrupt()
+
+    def _interrupt(self):
+        process = self.process
+        if process is None or process.poll() is not None:
+            return
+        try:
+            if os.name == 'nt':
+                # A windowless child of a GUI process has no console for CTRL_BREAK to reach, and the server keeps
+                # nothing that needs a clean exit, slot states are saved over HTTP beforehand
+                process.terminate()
+            else:
+                process.send_signal(signal.SIGINT)
+        except OSError as e:
+            print(f"Server pid {process.pid} could not be stopped: {e}")
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
@@ -1,17 +1,36 @@
 import configparser
 
+import psutil
+
+
+def default_threads():
+    # llama.cpp scales with physical cores, hyperthreads mostly add contention
+    return psutil.cpu_count(logical=False) or psutil.cpu_count() or 4
+
 
 def load_settings():
     config = configparser.ConfigParser()
 
     settings = {
-        'threads': 14,
+        'threads': default_threads(),
         'capacity': 4096,
         'temperature': 0.7,
         'new_predict': 512,
         'gpu_layers': 0,
         'grp_n': 1,
-        'grp_w': 512
+        'grp_w': 512,
+        'stream': 1,
+        'slot_cache_mb': 2048,
+        'parallel': 0,
+        'draft_max': 16,
+        'draft_min': 5,
+        'load_strategy': 'auto',
+        'prefetch': 1,
+        'batch': 512,
+        'max_resident': 2,
+        'resident_mb': 0,
+        'trace': 0,
+        'render_cache_mb': 64
     }
 
     config.read('config.ini')
@@ -20,10 +39,14 @@ def load_settings():
         for key in settings:
             if config.has_option('Settings', key):
                 value = config.get('Settings', key)
-                if key in ['threads', 'capacity', 'new_predict', 'gpu_layers', 'grp_n', 'grp_w']:
+                if key in ['threads', 'capacity', 'new_predict', 'gpu_layers', 'grp_n', 'grp_w', 'stream',
+                           'slot_cache_mb', 'parallel', 'draft_max', 'draft_min', 'prefetch', 'batch', 'max_resident',
+                           'resident_mb', 'trace', 'render_cache_mb']:
                     settings[key] = int(value)
                 elif key == 'temperature':
                     settings[key] = float(value)
+                elif key == 'load_strategy':
+                    settings[key] = str(value)
 
     return settings
 
@@ -109,3 +132,75 @@ def save_prompt_settings(settings):
 
     with open('config.ini', 'w') as configfile:
         config.write(configfile)
+
+
+def load_network_settings():
+    config = configparser.ConfigParser()
+
+    settings = {
+        'connect_timeout': 3.0,
+        'read_timeout': 600.0,
+        'pool_size': 8
+    }
+
+    config.read('config.ini')
+
+    if config.has_section('Network'):
+        for key in settings:
+            if config.has_option('Network', key):
+                value = config.get('Network', key)
+                if key in ['pool_size']:
+                    settings[key] = int(value)
+                elif key in ['connect_timeout', 'read_timeout']:
+                    settings[key] = float(value)
+
+    return settings
+
+
+def load_context_settings():
+    config = configparser.ConfigParser()
+
+    settings = {
+        'pin_system': 1,
+        'drop_oldest': 1,
+        'keep_turns': 0
+    }
+
+    config.read('config.ini')
+
+    if config.has_section('Context'):
+        for key in settings:
+            if config.has_option('Context', key):
+                settings[key] = int(config.get('Context', key))
+
+    return settings
+
+
+def load_tuned_settings(model_file):
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+
+    section = f'Tune:{model_file}'
+    if not config.has_section(section):
+        return None
+
+    settings = {}
+    for key in ['threads', 'batch', 'gpu_layers']:
+        settings[key] = config.getint(section, key)
+    for key in ['prompt_tps', 'gen_tps']:
+        settings[key] = config.getfloat(section, key)
+    return settings
+
+
+def save_tuned_settings(model_file, settings):
+    config = configparser.ConfigParser()
+
+    config.read('config.ini')
+    section = f'Tune:{model_file}'
+    if not config.has_section(section):
+        config.add_section(section)
+    for key in ['threads', 'batch', 'gpu_layers', 'prompt_tps', 'gen_tps']:
+        config.set(section, key, str(settings[key]))
+
+    with open('config.ini', 'w') as configfile:
+        config.write(configfile)
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import time
+
+from services.engine import request_job
+
+
+def model_fingerprint(model_path):
+    try:
+        stat = os.stat(model_path)
+    except OSError:
+        return ""
+    return f"{os.path.basename(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class SlotCache:
+    def __init__(self, directory, quota_mb=2048):
+        self.directory = directory
+        self.quota_bytes = quota_mb * 1024 * 1024
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        os.makedirs(directory, exist_ok=True)
+
+        try:
+            with open(self.manifest_path, 'r') as file:
+                self.manifest = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.manifest = {"model": "", "entries": {}}
+
+    def save_manifest(self):
+        with open(self.manifest_path, 'w') as file:
+            json.dump(self.manifest, file, indent=4)
+
+    def validate(self, model_path):
+        # KV states are only valid for the exact model file they were computed with
+        fingerprint = model_fingerprint(model_path)
+        if fingerprint != self.manifest["model"]:
+            for filename in list(self.manifest["entries"]):
+                self.remove(filename)
+            self.manifest["model"] = fingerprint
+            self.save_manifest()
+
+    def filename_for(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '.bin'
+
+    def has(self, key):
+        filename = self.filename_for(key)
+        return filename in self.manifest["entries"] and os.path.exists(os.path.join(self.directory, filename))
+
+    def save_job(self, key, slot_id=0):
+        filename = self.filename_for(key)
+        job = request_job(f"/slots/{slot_id}?action=save", {"filename": filename}, kind="slot")
+        job.result.connect(lambda _: self.on_saved(filename))
+        return job
+
+    def restore_job(self, key, slot_id=0):
+        filename = self.filename_for(key)
+        job = request_job(f"/slots/{slot_id}?action=restore", {"filename": filename}, kind="slot")
+        job.result.connect(lambda _: self.touch(filename))
+        return job
+
+    def touch(self, filename):
+        if filename in self.manifest["entries"]:
+            self.manifest["entries"][filename]["last_used"] = time.time()
+            self.save_manifest()
+
+    def on_saved(self, filename):
+        self.manifest["entries"][filename] = {"last_used": time.time()}
+        self.evict()
+        self.save_manifest()
+
+    def remove(self, filename):
+        self.manifest["entries"].pop(filename, None)
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+
+    def evict(self):
+        sizes = {}
+        for filename in list(self.manifest["entries"]):
+            path = os.path.join(self.directory, filename)
+            if os.path.exists(path):
+                sizes[filename] = os.path.getsize(path)
+            else:
+                self.manifest["entries"].pop(filename)
+
+        total = sum(sizes.values())
+        by_age = sorted(sizes, key=lambda name: self.manifest["entries"][name]["last_used"])
+        # Least recently used first, but never the state that was just written
+        for filename in by_age[:-1]:
+            if total <= self.quota_bytes:
+                break
+            total -= sizes[filename]
+            self.remove(filename)
+            print(f"Slot cache: evicted {filename}")
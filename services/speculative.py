@@ -0,0 +1,71 @@
+import os
+
+
+def draft_args(draft_path, settings):
+    if not draft_path or not os.path.exists(draft_path):
+        return []
+    return [
+        '-md', draft_path,
+        '-ngld', str(settings['gpu_layers']),
+        '--draft-max', str(settings['draft_max']),
+        '--draft-min', str(settings['draft_min'])
+    ]
+
+
+def acceptance_from_timings(timings):
+    if not timings or not timings.get('draft_n'):
+        return None
+    return {"accepted": timings['draft_n_accepted'], "generated": timings['draft_n'],
+            "rate": timings['draft_n_accepted'] / timings['draft_n'],
+            "tokens_per_second": timings.get('predicted_per_second', 0.0)}
+
+
+if __name__ == "__main__":
+    # Benchmark: effective tokens/s of the selected model on the llama.cpp server, target only and then with
+    # the draft model. Usage: python -m services.speculative [draft.gguf]
+    import sys
+    import time
+
+    import services.completion as Server
+    from services.http_client import HttpClient
+    from services.server_supervisor import ServerSupervisor
+    from services.settings_handler import load_settings
+
+    draft_path = sys.argv[1] if len(sys.argv) > 1 else Server.selected_draft_path()
+    if not draft_path or not os.path.exists(draft_path):
+        sys.exit("No draft model, pass one or select it in the settings")
+    port = Server.SERVER_PORT + 1
+    settings = dict(load_settings(), parallel=1)
+    client = HttpClient(base_url=f"http://127.0.0.1:{port}")
+    payload = {"messages": [{"role": "user", "content": "Tell me a story."}], "max_tokens": 128,
+               "temperature": 0.0, "cache_prompt": False}
+
+    for label, draft in (("target only", ""), ("draft model", draft_path)):
+        supervisor = ServerSupervisor(port=port, log_path=os.path.join(Server.temp_dir, 'speculative_output.log'),
+                                      max_restarts=0)
+        supervisor.command_factory = lambda draft=draft: Server.build_command(port, settings=settings,
+                                                                              draft_path=draft)
+        supervisor.start()
+        try:
+            while not supervisor.is_ready:
+                if not supervisor.thread.is_alive():
+                    sys.exit(f"{label}: server failed to load, see {supervisor.log_path}")
+                time.sleep(0.1)
+
+            # The first reply warms up the compute buffers
+            client.post_json("/v1/chat/completions", dict(payload, max_tokens=1))
+            tokens = seconds = 0.0
+            stats = []
+            for _ in range(5):
+                timings = client.post_json("/v1/chat/completions", payload)['timings']
+                tokens += timings['predicted_n']
+                seconds += timings['predicted_ms'] / 1000
+                stats.append(acceptance_from_timings(timings))
+        finally:
+            supervisor.stop()
+            supervisor.wait()
+
+        drafted = sum(stat['generated'] for stat in stats if stat)
+        accepted = sum(stat['accepted'] for stat in stats if stat)
+        rate = f", acceptance {accepted / drafted:.1%}" if drafted else ""
+        print(f"{label}: {tokens / seconds:.1f} tokens/s{rate}")
@@ -0,0 +1,162 @@
+import csv
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from PySide6.QtCore import QObject, Signal
+
+# Per-task timings the llama.cpp server prints after each reply
+EVAL_PATTERN = re.compile(r"(prompt eval|eval) time\s*=\s*([\d.]+) ms /\s*(\d+) (?:tokens|runs)")
+
+FIELDS = ['time', 'model', 'kind', 'prompt_tokens', 'cached_tokens', 'prompt_ms_per_token', 'gen_tokens',
+          'gen_tps', 'draft_rate', 'source']
+
+
+def record_from_timings(timings, usage=None):
+    record = {
+        'prompt_tokens': timings.get('prompt_n', 0),
+        'cached_tokens': timings.get('cache_n', 0),
+        'prompt_ms_per_token': round(timings['prompt_ms'] / timings['prompt_n'], 2)
+        if timings.get('prompt_n') else 0.0,
+        'gen_tokens': timings.get('predicted_n', 0),
+        'gen_tps': round(timings.get('predicted_per_second', 0.0), 2),
+        'draft_rate': round(timings['draft_n_accepted'] / timings['draft_n'], 3) if timings.get('draft_n') else '',
+    }
+    if 'cache_n' in timings:
+        record['prompt_tokens'] += timings['cache_n']
+    elif usage and 'prompt_tokens' in usage:
+        # Older servers only report the evaluated part, the rest came from the cache
+        record['cached_tokens'] = max(0, usage['prompt_tokens'] - record['prompt_tokens'])
+        record['prompt_tokens'] = usage['prompt_tokens']
+    return record
+
+
+class LogTailer:
+    def __init__(self, telemetry, interval=0.5):
+        self.telemetry = telemetry
+        self.interval = interval
+        self.path = None
+        self.position = 0
+        self.prompt = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def follow(self, path):
+        self.path = path
+        self.position = 0
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="log-tailer", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            path = self.path
+            try:
+                # The log is truncated on every server start
+                if os.path.getsize(path) < self.position:
+                    self.position = 0
+                with open(path, 'rb') as file:
+                    file.seek(self.position)
+                    lines = file.readlines()
+            except (OSError, TypeError):
+                continue
+            # Leave a half written line for the next pass
+            if lines and not lines[-1].endswith(b'\n'):
+                lines.pop()
+            for line in lines:
+                self.position += len(line)
+                self.parse(line.decode('utf-8', errors='replace'))
+
+    def parse(self, line):
+        match = EVAL_PATTERN.search(line)
+        if match is None:
+            return
+        ms, tokens = float(match.group(2)), int(match.group(3))
+        if match.group(1) == 'prompt eval':
+            self.prompt = (ms, tokens)
+        elif self.prompt is not None:
+            self.telemetry.on_log_timings({
+                'prompt_n': self.prompt[1], 'prompt_ms': self.prompt[0],
+                'predicted_n': tokens, 'predicted_per_second': tokens / ms * 1000 if ms else 0.0
+            })
+            self.prompt = None
+
+
+class Telemetry(QObject):
+    recorded = Signal(object)
+
+    def __init__(self, size=512):
+        super().__init__()
+        self.records = deque(maxlen=size)
+        # Replies whose response carried no timings, completed from the server log
+        self.pending = deque(maxlen=16)
+        self.lock = threading.Lock()
+        self.model = ""
+        self.tailer = LogTailer(self)
+
+    def set_source(self, model, log_path):
+        self.model = model
+        self.pending.clear()
+        self.tailer.follow(log_path)
+
+    def record(self, job):
+        if not job.timings:
+            self.pending.append((job.kind, job.usage))
+            return
+        self._add(record_from_timings(job.timings, job.usage), job.kind, 'response')
+
+    def on_log_timings(self, timings):
+        # Called from the tailer thread, log lines of replies that had timings are ignored
+        try:
+            kind, usage = self.pending.popleft()
+        except IndexError:
+            return
+        self._add(record_from_timings(timings, usage), kind, 'log')
+
+    def _add(self, record, kind, source):
+        record.update({'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'model': self.model, 'kind': kind,
+                       'source': source})
+        with self.lock:
+            self.records.append(record)
+        self.recorded.emit(record)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.records)
+
+    def summary(self, last=20):
+        records = [record for record in self.snapshot() if record['gen_tokens']][-last:]
+        if not records:
+            return None
+        prompt_tokens = sum(record['prompt_tokens'] for record in records)
+        return {
+            'replies': len(records),
+            'gen_tps': sum(record['gen_tps'] for record in records) / len(records),
+            'prompt_ms_per_token': sum(record['prompt_ms_per_token'] for record in records) / len(records),
+            'cached_ratio': sum(record['cached_tokens'] for record in records) / prompt_tokens
+            if prompt_tokens else 0.0
+        }
+
+    def export_csv(self, path):
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(self.snapshot())
+
+    def close(self):
+        self.tailer.stop()
+
+
+_telemetry = None
+
+
+def get_telemetry():
+    global _telemetry
+    if _telemetry is None:
+        _telemetry = Telemetry()
+    return _telemetry
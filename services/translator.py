@@ -4,6 +4,8 @@ import re
 import ctranslate2
 import sentencepiece as spm
 
+import services.tracing as tracing
+
 
 # script_dir = os.path.dirname(os.path.realpath(__file__))
 # models_dir = os.path.join(script_dir, 'model')
@@ -21,6 +23,7 @@ class Translator:
         self.sp.Load(os.path.join(self.path, "spm.128k.model"))
         self.translator = ctranslate2.Translator(self.path)
 
+    @tracing.traced("Translator.translate", "translate")
     def translate(self, text_input, source_lang, target_lang):
         text_without_emojis, emojis = self.extract_emojis(text_input)
 
@@ -2,7 +2,8 @@ import json
 import os
 from configparser import ConfigParser
 
-from PySide6.QtCore import Qt, QUrl
+import psutil
+from PySide6.QtCore import Qt, QUrl, Signal
 from PySide6.QtGui import QPalette, QColor, QCursor, QDesktopServices
 from PySide6.QtWidgets import (QVBoxLayout,
                                QMainWindow,
@@ -13,12 +14,17 @@ import services.settings_handler as Settings
 import services.windows_api_handler
 from components.custom_sliders import CustomSlider, CustomSliderDouble
 from components.custom_titlebar import CustomTitleBar
+from services.auto_tune import AutoTuner
+from services.completion import parallel_slots, model_settings
+from services.model_index import ModelIndex, estimate_memory, suggest_grp, describe
 
 
 # TODO: construct config path and replace all hard encoded strings below
 
 
 class SettingsWindow(QMainWindow):
+    model_changed = Signal(str)
+
     def __init__(self, parent=None):
         super().__init__(parent)
 
@@ -35,6 +41,7 @@ class SettingsWindow(QMainWindow):
 
         self.move(int((screen_width - self.init_width) / 2), int((screen_height - self.init_height) / 2))
 
+        self.model_index = ModelIndex(os.path.join(os.getcwd(), 'temp', 'model_index.json'))
         self.initUI()
 
     def initUI(self):
@@ -114,7 +121,7 @@ class SettingsWindow(QMainWindow):
         model_config.addWidget(self.model_select_box)
         model_config.addWidget(QLabel("\n# Model parameters: "))
         # 1.2
-        self.thread_slider = CustomSlider("Threads: ", 14, 1, 16, 128,
+        self.thread_slider = CustomSlider("Threads: ", Settings.default_threads(), 1, 16, 128,
                                           "Set the number of threads for processing.\n\nRange: 1-128.", 1)
         model_config.addWidget(self.thread_slider)
         # 1.3
@@ -137,6 +144,38 @@ class SettingsWindow(QMainWindow):
                                               "This option allows offloading some layers to the GPU for computation.\nGenerally results in decreased performance.\n\nNeeds much more RAM.\n\nSet to 0 for a weak GPU be faster.",
                                               1)
         model_config.addWidget(self.gpu_layers_slider)
+        self.memory_label = QLabel("")
+        model_config.addWidget(self.memory_label)
+        # 1.7
+        button_style = """
+        QPushButton {
+            background-color: #599e5e;
+            border: none;
+            padding-top: 2px;
+            padding-right: 10px;
+            padding-bottom: 2px;
+            padding-left: 10px;
+        }
+        
+        QPushButton:hover {
+            background-color: #2b8451;
+        }
+        """
+
+        tune_layout = QHBoxLayout()
+        self.tune_label = QLabel("")
+        self.tune_button = QPushButton("Auto-tune")
+        self.tune_button.setStyleSheet(button_style)
+        self.tune_button.setToolTip("Measure prompt and generation speed for a few thread, batch and GPU layer "
+                                    "values,\nand keep the fastest for the selected model.\n\n"
+                                    "Stop the chat server first. Takes a few minutes.")
+        self.tune_button.clicked.connect(self.start_tune)
+        tune_layout.addWidget(self.tune_label)
+        tune_layout.addStretch()
+        tune_layout.addWidget(self.tune_button)
+        model_config.addLayout(tune_layout)
+        self.tuner = None
+        self.show_tuned()
         # 1.A
         model_config.addWidget(QLabel("\n# LongLM parameters: "))
         grp_tip = r"""Set GroupSize to 1 = disable
@@ -166,6 +205,7 @@ https://arxiv.org/pdf/2401.01325.pdf
         self.grp_w_slider = CustomSlider("Window:", 512, 256, 1536, 4096,
                                          grp_tip, 1)
         model_config.addWidget(self.grp_w_slider)
+        self.grp_tip = grp_tip
 
         help_layout = QHBoxLayout()
         self.help_label = QLabel("More about LongLM", self)
@@ -177,6 +217,28 @@ https://arxiv.org/pdf/2401.01325.pdf
         help_layout.addWidget(self.help_label)
         model_config.addLayout(help_layout)
 
+        # 1.B
+        model_config.addWidget(QLabel("# Speculative decoding: "))
+        draft_tip = """A small draft model (same vocabulary as the main model) guesses
+the next tokens, and the main model checks them in one pass.
+
+Faster generation when most guesses are accepted,
+at the cost of loading a second model into RAM.
+
+Select (none) to disable."""
+        self.draft_select_box = QComboBox()
+        self.draft_select_box.setStyleSheet(combo_style)
+        self.draft_select_box.setToolTip(draft_tip)
+        self.loadDraftFiles()
+        self.draft_select_box.currentIndexChanged.connect(self.draftSelected)
+        model_config.addWidget(self.draft_select_box)
+        self.draft_max_slider = CustomSlider("DraftMax:", 16, 1, 16, 64,
+                                             "Maximum number of tokens to draft per step.\n\n" + draft_tip, 1)
+        model_config.addWidget(self.draft_max_slider)
+        self.draft_min_slider = CustomSlider("DraftMin:", 5, 0, 5, 32,
+                                             "Minimum number of tokens to draft per step.\n\n" + draft_tip, 1)
+        model_config.addWidget(self.draft_min_slider)
+
         # 1.X translator config
         left_middle_title_layout = QHBoxLayout()
         left_middle_title_layout.setAlignment(Qt.AlignVCenter)
@@ -308,21 +370,6 @@ https://arxiv.org/pdf/2401.01325.pdf
         # 2.X Character card import/export
         chara_card_buttons_layout = QHBoxLayout()
 
-        button_style = """
-        QPushButton {
-            background-color: #599e5e;
-            border: none;
-            padding-top: 2px;
-            padding-right: 10px;
-            padding-bottom: 2px;
-            padding-left: 10px;
-        }
-        
-        QPushButton:hover {
-            background-color: #2b8451;
-        }
-        """
-
         card_import = QPushButton("Import")
         card_import.setStyleSheet(button_style)
         card_import.clicked.connect(self.load_from_json)
@@ -345,6 +392,9 @@ https://arxiv.org/pdf/2401.01325.pdf
 
         settings = Settings.load_settings()
         self.update_sliders(settings)
+        self.update_model_info()
+        self.content_size_slider.spin.valueChanged.connect(self.update_model_info)
+        self.gpu_layers_slider.spin.valueChanged.connect(self.update_model_info)
 
         prompt_settings = Settings.load_prompt_settings()
         self.update_text_edits(prompt_settings)
@@ -400,12 +450,113 @@ https://arxiv.org/pdf/2401.01325.pdf
 
     def loadFiles(self):
         path = "./models"
-        files = [f for f in os.listdir(path) if f.endswith('gguf')]
-        self.model_select_box.addItems(files)
+        models = self.model_index.scan(path)
+        for filename, info in models.items():
+            self.model_select_box.addItem(filename)
+            if info is not None:
+                self.model_select_box.setItemData(self.model_select_box.count() - 1, describe(info), Qt.ToolTipRole)
+
+    def update_model_info(self):
+        model_path = os.path.join("./models", self.model_select_box.currentText())
+        info = self.model_index.get(model_path)
+        if info is None:
+            self.memory_label.setText("")
+            for slider in [self.grp_n_slider, self.grp_w_slider]:
+                slider.slider.setToolTip(self.grp_tip)
+            return
+
+        settings = model_settings(model_path, dict(Settings.load_settings(), **self.slider_settings()))
+        capacity = settings['capacity']
+        available = psutil.virtual_memory().available
+        estimate = estimate_memory(info, capacity, settings['gpu_layers'], parallel_slots(settings, info, available),
+                                   settings['batch'])
+        color = "#fd879a" if estimate['ram'] > available else "#b3b7b7"
+        text = f"<font color='{color}'>Needs ~{estimate['ram'] / 1024 ** 3:.1f} GB RAM"
+        if estimate['vram']:
+            text += f", {estimate['vram'] / 1024 ** 3:.1f} GB VRAM"
+        text += f" ({available / 1024 ** 3:.1f} GB free)</font>"
+
+        trained = info['context_length']
+        grp_n, grp_w = suggest_grp(trained, capacity)
+        if capacity > trained > 0 and settings['grp_n'] * trained < capacity:
+            text += f"<br><font color='#fd879a'>Capacity is above the trained {trained}, raise GroupSize</font>"
+        self.memory_label.setText(text)
+
+        suggestion = (f"\nThis model: T = {trained}, so for C = {capacity}\n"
+                      f"try GroupSize {grp_n} and Window {grp_w}." if grp_n > 1 else
+                      f"\nThis model: T = {trained}, C = {capacity} fits, LongLM is not needed.")
+        for slider in [self.grp_n_slider, self.grp_w_slider]:
+            slider.slider.setToolTip(self.grp_tip + suggestion)
+
+    def loadDraftFiles(self):
+        self.draft_select_box.addItem("(none)")
+        self.draft_select_box.addItems([f for f in os.listdir("./models") if f.endswith('gguf')])
+
+        config = ConfigParser()
+        config.read('config.ini')
+        draft_file = config.get('LLM', 'draft_file', fallback="")
+        index = self.draft_select_box.findText(draft_file) if draft_file != "" else 0
+        self.draft_select_box.setCurrentIndex(max(index, 0))
+
+    def draftSelected(self, index):
+        draft_file = self.draft_select_box.itemText(index) if index > 0 else ""
+        config = ConfigParser()
+        config.read('config.ini')
+        if not config.has_section('LLM'):
+            config.add_section('LLM')
+        config.set('LLM', 'draft_file', draft_file)
+        with open('config.ini', 'w') as configfile:
+            config.write(configfile)
 
     def fileSelected(self, index):
         selected_file = self.model_select_box.itemText(index)
         self.saveSelection(selected_file)
+        self.show_tuned()
+        self.update_model_info()
+        self.model_changed.emit(selected_file)
+
+    def show_tuned(self):
+        tuned = Settings.load_tuned_settings(self.model_select_box.currentText())
+        if tuned is None:
+            self.tune_label.setText("Not tuned for this model")
+            self.tune_label.setToolTip("")
+            return
+        self.tune_label.setText(f"{tuned['gen_tps']} tok/s, {tuned['prompt_tps']} prompt tok/s")
+        # The sliders stay the defaults for other models, this one is started with what was measured
+        self.tune_label.setToolTip(f"Used for this model instead of the sliders: "
+                                   f"-t {tuned['threads']} -b {tuned['batch']} -ngl {tuned['gpu_layers']}")
+
+    def start_tune(self):
+        if self.tuner is not None:
+            self.tuner.cancel()
+            self.tuner = None
+            self.tune_button.setText("Auto-tune")
+            self.show_tuned()
+            return
+
+        model_file = self.model_select_box.currentText()
+        if model_file == "":
+            return
+        settings = dict(Settings.load_settings(), **self.slider_settings())
+        model_path = os.path.join(os.getcwd(), 'models', model_file)
+        self.tuner = AutoTuner(model_path, settings, self.model_index.get(model_path))
+        self.tuner.progress.connect(self.tune_label.setText)
+        self.tuner.finished.connect(self.tune_finished)
+        self.tuner.failed.connect(self.tune_failed)
+        self.tuner.start()
+        self.tune_button.setText("Cancel")
+
+    def tune_finished(self, tuned):
+        self.tuner = None
+        self.tune_button.setText("Auto-tune")
+        self.show_tuned()
+        self.update_model_info()
+
+    def tune_failed(self, message):
+        self.tuner = None
+        self.tune_button.setText("Auto-tune")
+        self.show_tuned()
+        QMessageBox.warning(self, "Auto-tune", message)
 
     def saveSelection(self, selected_file):
         config = ConfigParser()
@@ -510,19 +661,27 @@ https://arxiv.org/pdf/2401.01325.pdf
         self.gpu_layers_slider.setValue(settings['gpu_layers'])
         self.grp_n_slider.setValue(settings['grp_n'])
         self.grp_w_slider.setValue(settings['grp_w'])
+        self.draft_max_slider.setValue(settings['draft_max'])
+        self.draft_min_slider.setValue(settings['draft_min'])
 
-    def closeEvent(self, event):
-        settings = {
+    def slider_settings(self):
+        return {
             'threads': self.thread_slider.value(),
             'capacity': self.content_size_slider.value(),
             'temperature': self.temperature_slider.value(),
             'new_predict': self.predict_size_slider.value(),
             'gpu_layers': self.gpu_layers_slider.value(),
             'grp_n': self.grp_n_slider.value(),
-            'grp_w': self.grp_w_slider.value()
+            'grp_w': self.grp_w_slider.value(),
+            'draft_max': self.draft_max_slider.value(),
+            'draft_min': self.draft_min_slider.value()
         }
 
-        Settings.save_settings(settings)
+    def closeEvent(self, event):
+        if self.tuner is not None:
+            self.tuner.cancel()
+
+        Settings.save_settings(self.slider_settings())
 
         prompt_settings = {
             'user_name': self.sender_name_line_edit.text(),
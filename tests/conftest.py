@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The services keep their files under the working directory, the tests get a scratch one
+os.chdir(tempfile.mkdtemp(prefix="matcha-tests-"))
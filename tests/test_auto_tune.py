@@ -0,0 +1,20 @@
+import services.completion as Server
+from services.auto_tune import gpu_layer_candidates
+
+INFO = {'layers': 32}
+
+
+def test_no_gpu_build_keeps_the_setting(tmp_path, monkeypatch):
+    monkeypatch.setattr(Server, 'backend_dir', str(tmp_path))
+    monkeypatch.setattr(Server.sys, 'platform', 'linux')
+    (tmp_path / "llama-server").touch()
+    assert gpu_layer_candidates(INFO, 0) == [0]
+
+
+def test_gpu_build_searches_the_model_layers(tmp_path, monkeypatch):
+    monkeypatch.setattr(Server, 'backend_dir', str(tmp_path))
+    monkeypatch.setattr(Server.sys, 'platform', 'linux')
+    (tmp_path / "llama-server").touch()
+    (tmp_path / "libggml-cuda.so").touch()
+    assert gpu_layer_candidates(INFO, 0) == [0, 8, 16, 24, 33]
+    assert gpu_layer_candidates(None, 20) == [0, 10, 20, 99]
@@ -0,0 +1,85 @@
+import pytest
+
+from services.chat_history import ChatHistory
+from services.chat_model import ChatModel
+from services.chat_store import ChatStore
+from services.context_manager import ContextManager
+
+
+class WordCounter:
+    def count(self, text):
+        return len(text.split()), True
+
+
+@pytest.fixture
+def chat(tmp_path):
+    messages = ChatStore(str(tmp_path), 'messages')
+    context_store = ChatStore(str(tmp_path), 'context')
+    model = ChatModel(messages)
+    context = ContextManager(counter=WordCounter(), store=context_store)
+    context.resume("system prompt")
+    history = ChatHistory(model, context)
+    yield model, context, history
+    messages.close()
+    context_store.close()
+
+
+def turn(model, context, history, question, answer):
+    history.begin_turn()
+    context.append("user", question)
+    model.append(question, "#6edcbe", "Right", "Puff")
+    history.begin_reply()
+    context.append("assistant", answer)
+    model.append(answer, "#8dd4f4", "Left", "Fluffy")
+
+
+def state(model, context):
+    return [message['text'] for message in model.serialize()], [entry.content for entry in context.read(1)]
+
+
+def test_undo_and_redo(chat):
+    model, context, history = chat
+    assert not history.can_undo() and not history.can_redo()
+    turn(model, context, history, "hello", "Hi there.")
+    turn(model, context, history, "how are you", "Fine.")
+    two_turns = state(model, context)
+
+    assert history.undo()
+    assert state(model, context) == (["hello", "Hi there."], ["hello", "Hi there."])
+    assert history.can_redo()
+    assert history.undo()
+    assert state(model, context) == ([], [])
+    assert not history.can_undo() and not history.undo()
+
+    assert history.redo() and history.redo()
+    assert state(model, context) == two_turns
+    assert not history.can_redo()
+
+
+def test_new_turn_drops_redo(chat):
+    model, context, history = chat
+    turn(model, context, history, "hello", "Hi there.")
+    history.undo()
+    turn(model, context, history, "again", "Sure.")
+    assert not history.can_redo()
+    assert state(model, context) == (["again", "Sure."], ["again", "Sure."])
+
+
+def test_regenerate_keeps_the_question(chat):
+    model, context, history = chat
+    turn(model, context, history, "hello", "Hi there.")
+    assert history.can_regenerate()
+    assert history.regenerate()
+    assert state(model, context) == (["hello"], ["hello"])
+
+
+def test_history_survives_a_context_resume(chat):
+    model, context, history = chat
+    turn(model, context, history, "hello", "Hi there.")
+    turn(model, context, history, "how are you", "Fine.")
+    # What reload_chat does with the same context when the settings change
+    context.resume("system prompt")
+    assert history.undo()
+    assert state(model, context) == (["hello", "Hi there."], ["hello", "Hi there."])
+    assert history.redo()
+    assert state(model, context)[1] == ["hello", "Hi there.", "how are you", "Fine."]
@@ -0,0 +1,129 @@
+import threading
+
+from services.chat_library import ChatLibrary, MATCH_START, MATCH_END
+
+
+def bubble(text, alignment='Left', sender='Fluffy'):
+    return {'text': text, 'color': '#8dd4f4', 'alignment': alignment, 'sender': sender}
+
+
+def open_library(tmp_path):
+    return ChatLibrary(str(tmp_path / "library.db"), commit_interval=0.01)
+
+
+def test_search_folds_diacritics_and_highlights(tmp_path):
+    library = open_library(tmp_path)
+    session = library.start_session("Fluffy", "Puff")
+    session.extend(0, [bubble("Shall we meet at the Café tomorrow?"), bubble("Only if there is tea", 'Right', "Puff")])
+    library.flush()
+
+    results = library.search("cafe")
+    assert len(results) == 1
+    assert f"{MATCH_START}Café{MATCH_END}" in results[0]['snippet']
+    assert (results[0]['session'], results[0]['position'], results[0]['character']) == (session.id, 0, "Fluffy")
+    library.close()
+
+
+def test_last_word_matches_as_prefix(tmp_path):
+    library = open_library(tmp_path)
+    session = library.start_session("Fluffy", "Puff")
+    session.extend(0, [bubble("the weather is lovely"), bubble("the kettle is on")])
+    library.flush()
+
+    assert [result['position'] for result in library.search("weath")] == [0]
+    assert library.search("kettle weath") == []
+    library.close()
+
+
+def test_best_match_wins_over_newer_ones(tmp_path):
+    library = open_library(tmp_path)
+    old = library.start_session("Fluffy", "Puff")
+    old.extend(0, [bubble("kettle kettle kettle")])
+    new = library.start_session("Fluffy", "Puff")
+    new.extend(0, [bubble(f"message {n} mentions the kettle among many other words today") for n in range(200)])
+    library.flush()
+
+    results = library.search("kettle", limit=10)
+    assert len(results) == 10
+    assert (results[0]['session'], results[0]['position']) == (old.id, 0)
+    library.close()
+
+
+def test_truncate_removes_from_search(tmp_path):
+    library = open_library(tmp_path)
+    session = library.start_session("Fluffy", "Puff")
+    session.extend(0, [bubble("first garden"), bubble("second garden")])
+    session.truncate(1)
+    library.flush()
+
+    assert [result['position'] for result in library.search("garden")] == [0]
+    assert library.count(session.id) == 1
+    library.close()
+
+
+def test_context_round_trip(tmp_path):
+    library = open_library(tmp_path)
+    session = library.start_session("Fluffy", "Puff")
+    entries = [{'role': 'system', 'content': "system prompt", 'tokens': 7},
+               {'role': 'user', 'content': "hello", 'tokens': 5},
+               {'role': 'assistant', 'content': "hi there\nand welcome", 'tokens': 9}]
+    session.context.extend(0, entries)
+    session.context.truncate(2)
+    session.context.extend(2, [{'role': 'assistant', 'content': "hi", 'tokens': 4}])
+    library.flush()
+    library.close()
+
+    library = open_library(tmp_path)
+    assert library.current.id == session.id
+    assert library.context_count(session.id) == 3
+    assert library.read_context(session.id) == entries[:2] + [{'role': 'assistant', 'content': "hi", 'tokens': 4}]
+    library.close()
+
+
+def test_empty_session_is_dropped_with_its_context(tmp_path):
+    library = open_library(tmp_path)
+    empty = library.start_session("Fluffy", "Puff")
+    empty.context.extend(0, [{'role': 'system', 'content': "system prompt", 'tokens': 7}])
+    library.start_session("Fluffy", "Puff")
+    library.flush()
+
+    assert library.read_context(empty.id) == []
+    library.close()
+
+
+def test_only_the_newest_search_is_delivered(tmp_path):
+    library = open_library(tmp_path)
+    session = library.start_session("Fluffy", "Puff")
+    session.extend(0, [bubble(f"the garden number {n}") for n in range(300)] + [bubble("the greenhouse")])
+    library.flush()
+
+    delivered = []
+    done = threading.Event()
+
+    def collect(text, results, elapsed):
+        delivered.append((text, len(results)))
+        if text == "the greenh":
+            done.set()
+
+    for text in ("t", "th", "the", "the g", "the gr", "the gre", "the greenh"):
+        library.search_later(text, collect)
+    assert done.wait(5.0)
+    assert delivered[-1] == ("the greenh", 1)
+    library.close()
+
+
+def test_words_are_counted_for_an_older_library(tmp_path):
+    library = open_library(tmp_path)
+    session = library.start_session("Fluffy", "Puff")
+    session.extend(0, [bubble("tea in the garden"), bubble("the kettle")])
+    library.flush()
+    library.connection.execute("DELETE FROM words")
+    library.connection.commit()
+    library.close()
+
+    library = open_library(tmp_path)
+    library.flush()
+    assert dict(library.connection.execute("SELECT word, messages FROM words")) == \
+        {'tea': 1, 'in': 1, 'the': 2, 'garden': 1, 'kettle': 1}
+    assert [result['position'] for result in library.search("the")] == [1, 0]
+    library.close()
@@ -0,0 +1,103 @@
+import os
+
+from services.chat_store import ChatStore
+
+
+def record(n):
+    return {'text': f"message {n}", 'n': n}
+
+
+def numbers(store):
+    return [row['n'] for row in store.read(0, len(store))]
+
+
+def journal(directory):
+    [name] = [name for name in os.listdir(directory) if name.endswith('.journal')]
+    return os.path.join(directory, name)
+
+
+def test_reopen_replays_appends_and_truncations(tmp_path):
+    store = ChatStore(str(tmp_path))
+    store.extend(record(n) for n in range(10))
+    store.truncate(6)
+    store.extend([record(6), record(7)])
+    store.close()
+
+    store = ChatStore(str(tmp_path))
+    assert numbers(store) == list(range(8))
+    assert store.read(3, 5) == [record(3), record(4)]
+    store.close()
+
+
+def test_torn_journal_tail_is_dropped(tmp_path):
+    store = ChatStore(str(tmp_path))
+    store.extend([record(0), record(1)])
+    store.extend([record(2)])
+    store.close()
+    path = journal(tmp_path)
+    with open(path, 'rb') as file:
+        data = file.read()
+    # A crash in the middle of the last line
+    with open(path, 'wb') as file:
+        file.write(data[:-5])
+
+    store = ChatStore(str(tmp_path))
+    assert numbers(store) == [0, 1]
+    store.extend([record(2)])
+    store.close()
+    store = ChatStore(str(tmp_path))
+    assert numbers(store) == [0, 1, 2]
+    store.close()
+
+
+def test_corrupt_line_ends_the_journal(tmp_path):
+    store = ChatStore(str(tmp_path))
+    for n in range(3):
+        store.extend([record(n)])
+    store.close()
+    path = journal(tmp_path)
+    with open(path, 'rb') as file:
+        lines = file.read().splitlines(keepends=True)
+    lines[1] = lines[1].replace(b'message 1', b'message X')
+    with open(path, 'wb') as file:
+        file.write(b''.join(lines))
+
+    store = ChatStore(str(tmp_path))
+    assert numbers(store) == [0]
+    assert os.path.getsize(journal(tmp_path)) == len(lines[0])
+    store.close()
+
+
+def test_compaction_keeps_every_record(tmp_path):
+    store = ChatStore(str(tmp_path), compact_after=20)
+    for start in range(0, 100, 7):
+        store.extend(record(n) for n in range(start, min(start + 7, 100)))
+        if start == 49:
+            store.truncate(50)
+    store.flush()
+    assert numbers(store) == [n for n in range(100) if n < 50 or n >= 56]
+    store.close()
+
+    names = os.listdir(tmp_path)
+    assert not any(name.endswith('.tmp') for name in names)
+    assert len({name.split('.')[1] for name in names}) == 1
+    store = ChatStore(str(tmp_path))
+    assert store.base > 0
+    assert numbers(store) == [n for n in range(100) if n < 50 or n >= 56]
+    store.close()
+
+
+def test_unfinished_compaction_falls_back(tmp_path):
+    store = ChatStore(str(tmp_path), compact_after=5)
+    store.extend(record(n) for n in range(5))
+    store.extend(record(n) for n in range(5, 8))
+    store.close()
+    gen = max(int(name.split('.')[1]) for name in os.listdir(tmp_path))
+    # A newer generation whose snapshot never got its trailer
+    with open(os.path.join(tmp_path, f"messages.{gen + 1}.snapshot"), 'wb') as file:
+        file.write(b'{"text": "message 0", "n": 0}\n')
+
+    store = ChatStore(str(tmp_path))
+    assert numbers(store) == list(range(8))
+    assert not os.path.exists(os.path.join(tmp_path, f"messages.{gen + 1}.snapshot"))
+    store.close()
@@ -0,0 +1,34 @@
+import services.completion as Server
+import services.settings_handler as Settings
+
+GB = 1024 ** 3
+
+# A small model: 1 GB of weights over 24 layers, 1 MB of KV cache per token per slot
+INFO = {'layers': 24, 'layer_bytes': [GB // 24] * 24, 'output_bytes': 0, 'weight_bytes': GB,
+        'kv_length': 1024 * 1024 // (2 * 2 * 24), 'vocab_size': 32000}
+
+
+def option(command, flag):
+    return command[command.index(flag) + 1]
+
+
+def test_tuned_settings_are_used_for_their_model(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Settings.save_settings({'threads': 4, 'batch': 512, 'gpu_layers': 0})
+    Settings.save_tuned_settings("tuned.gguf", {'threads': 6, 'batch': 256, 'gpu_layers': 10,
+                                                'prompt_tps': 100.0, 'gen_tps': 10.0})
+
+    command = Server.build_command(model_path=str(tmp_path / "tuned.gguf"), draft_path="")
+    assert (option(command, '-t'), option(command, '-b'), option(command, '-ngl')) == ('6', '256', '10')
+
+    command = Server.build_command(model_path=str(tmp_path / "other.gguf"), draft_path="")
+    assert (option(command, '-t'), option(command, '-b'), option(command, '-ngl')) == ('4', '512', '0')
+
+
+def test_one_slot_unless_the_extra_kv_cache_fits(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    settings = dict(Settings.load_settings(), capacity=2048, parallel=0, gpu_layers=0, batch=512)
+    assert Server.parallel_slots(settings) == 1
+    assert Server.parallel_slots(settings, INFO, available=2 * GB) == 1
+    assert Server.parallel_slots(settings, INFO, available=16 * GB) == 3
+    assert Server.parallel_slots(dict(settings, parallel=2), INFO, available=GB) == 2
@@ -0,0 +1,176 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services import http_client
+from services.chat_store import ChatStore
+from services.context_manager import ContextManager, TokenCounter, MESSAGE_OVERHEAD, estimate_tokens
+
+
+class WordCounter:
+    # One token per word, counted exactly unless offline
+    def __init__(self):
+        self.online = True
+        self.counted = 0
+
+    def count(self, text):
+        self.counted += 1
+        return len(text.split()), self.online
+
+
+def conversation(turns, store=None, **options):
+    context = ContextManager(counter=WordCounter(), store=store, **options)
+    context.resume("system prompt")
+    for turn in range(turns):
+        context.append("user", f"question {turn}")
+        context.append("assistant", f"answer {turn} is here")
+    return context
+
+
+def contents(messages):
+    return [message["content"] for message in messages]
+
+
+def test_everything_fits():
+    context = conversation(3)
+    messages = context.fit(1000)
+    assert len(messages) == 7
+    assert context.fitted_tokens == 2 + 3 * (2 + 4) + 7 * MESSAGE_OVERHEAD
+
+
+def test_oldest_whole_turns_are_dropped():
+    context = conversation(5)
+    turn = 2 + 4 + 2 * MESSAGE_OVERHEAD
+    budget = 2 + MESSAGE_OVERHEAD + 2 * turn
+    messages = context.fit(budget)
+    assert contents(messages) == ["system prompt", "question 3", "answer 3 is here", "question 4", "answer 4 is here"]
+    assert context.fitted_tokens == budget
+
+
+def test_volatile_note_counts_against_the_budget():
+    context = conversation(5)
+    context.set_volatile("it is monday")
+    turn = 2 + 4 + 2 * MESSAGE_OVERHEAD
+    messages = context.fit(2 + MESSAGE_OVERHEAD + 2 * turn)
+    assert contents(messages) == ["system prompt", "it is monday\nquestion 4", "answer 4 is here"]
+    assert context.fitted_tokens <= 2 + MESSAGE_OVERHEAD + 2 * turn
+
+
+def test_last_entry_is_sent_even_when_too_long():
+    context = conversation(2)
+    context.append("user", "word " * 500)
+    assert contents(context.fit(100))[1:] == ["word " * 500]
+
+
+def test_keep_turns():
+    context = conversation(5, keep_turns=2)
+    assert contents(context.fit(1000)) == ["system prompt", "question 3", "answer 3 is here", "question 4",
+                                           "answer 4 is here"]
+
+
+def test_resume_reads_only_what_a_fit_needs(tmp_path):
+    store = ChatStore(str(tmp_path), 'context')
+    conversation(1000, store=store)
+    store.close()
+
+    store = ChatStore(str(tmp_path), 'context')
+    context = ContextManager(counter=WordCounter(), store=store)
+    context.resume("system prompt")
+    assert len(context) == 2001 and context.entries == []
+    assert [entry.content for entry in context.read(1999)] == ["question 999", "answer 999 is here"]
+
+    messages = context.fit(200)
+    assert contents(messages)[-1] == "answer 999 is here"
+    assert context.offset > 1900
+    assert context.counter.counted < 100
+    store.close()
+
+
+def test_changed_system_prompt_keeps_the_conversation(tmp_path):
+    store = ChatStore(str(tmp_path), 'context')
+    conversation(3, store=store)
+    context = ContextManager(counter=WordCounter(), store=store)
+    context.resume("new prompt")
+    assert contents(context.fit(1000)) == ["new prompt", "question 0", "answer 0 is here", "question 1",
+                                           "answer 1 is here", "question 2", "answer 2 is here"]
+    assert store.read(0, 1)[0]["content"] == "new prompt"
+    store.close()
+
+
+def test_truncate_and_read_reach_into_the_store(tmp_path):
+    store = ChatStore(str(tmp_path), 'context')
+    conversation(200, store=store)
+    context = ContextManager(counter=WordCounter(), store=store)
+    context.resume("system prompt")
+
+    removed = context.read(301)
+    assert [entry.content for entry in removed[:2]] == ["question 150", "answer 150 is here"]
+    context.truncate(301)
+    assert len(context) == len(store) == 301
+    context.extend(removed)
+    assert len(context) == len(store) == 401
+    assert store.read(400, 401)[0]["content"] == "answer 199 is here"
+    store.close()
+
+
+def test_read_from_the_start_after_resume(tmp_path):
+    store = ChatStore(str(tmp_path), 'context')
+    conversation(2, store=store)
+    context = ContextManager(counter=WordCounter(), store=store)
+    context.resume("system prompt")
+    assert [entry.content for entry in context.read(0)] == ["system prompt", "question 0", "answer 0 is here",
+                                                           "question 1", "answer 1 is here"]
+    store.close()
+
+
+class TokenizeHandler(BaseHTTPRequestHandler):
+    # One token per character, slowly, like a busy server
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        time.sleep(0.05)
+        data = json.dumps({"tokens": list(range(len(payload["content"])))}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_counts_are_estimated_until_the_server_answers():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TokenizeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    http_client.set_server_url(f"http://127.0.0.1:{server.server_address[1]}")
+    try:
+        counter = TokenCounter()
+        counted = threading.Event()
+        counter.counted = counted.set
+        context = ContextManager(counter=counter)
+        context.resume("system prompt")
+        texts = [f"message number {n}" for n in range(5)]
+
+        start = time.monotonic()
+        for text in texts:
+            context.append("user", text)
+        context.fit(1000)
+        # Nothing waited for the server
+        assert time.monotonic() - start < 0.05
+        assert context.entry(1).tokens == estimate_tokens(texts[0]) + MESSAGE_OVERHEAD
+
+        # Called whenever the queue runs dry, each time a fit can use more exact counts
+        deadline = time.monotonic() + 5.0
+        while not all(context.entry(n).exact for n in range(6)) and time.monotonic() < deadline:
+            assert counted.wait(5.0)
+            counted.clear()
+            context.fit(1000)
+        assert [context.entry(n + 1).tokens for n in range(5)] == [len(text) + MESSAGE_OVERHEAD for text in texts]
+        assert all(context.entry(n).exact for n in range(6))
+    finally:
+        http_client.set_server_url(http_client.SERVER_URL)
+        server.shutdown()
+        server.server_close()
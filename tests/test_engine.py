@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PySide6.QtCore import Qt
+
+from services.engine import CompletionEngine, Job, chat_job, request_job
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Answers like llama.cpp: chunked server-sent events for a chat, a 400 for a prompt asking for it
+    protocol_version = "HTTP/1.1"
+    connections = set()
+    hold = threading.Event()
+
+    def setup(self):
+        super().setup()
+        self.connections.add(self.client_address)
+
+    def do_GET(self):
+        self.send_json(200, {"status": "ok", "slots_idle": 1, "slots_processing": 0})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if self.path.startswith("/slots/"):
+            self.send_json(200, {"id_slot": 0, "filename": payload["filename"]})
+            return
+        prompt = payload["messages"][-1]["content"]
+        if prompt == "bad":
+            self.send_json(400, {"error": {"message": "bad request"}})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for word in ("Hello", " there."):
+            self.send_chunk(f'data: {json.dumps({"choices": [{"delta": {"content": word}}]})}\n\n')
+            if prompt == "hang":
+                # Stays silent until the client goes away, like a long prompt evaluation
+                self.hold.wait(5)
+                return
+        self.send_chunk(f'data: {json.dumps({"choices": [], "usage": {"total_tokens": 7}})}\n\n')
+        self.send_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    StandInHandler.connections.clear()
+    StandInHandler.hold.clear()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    StandInHandler.hold.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def engine(server):
+    engine = CompletionEngine()
+    engine.set_server_url(server)
+    yield engine
+    engine.shutdown()
+
+
+def connect(signal, slot):
+    # There is no event loop here to deliver queued signals, the slots run on the engine thread
+    signal.connect(slot, Qt.DirectConnection)
+
+
+def run(engine, job, timeout=5.0):
+    outcome = {}
+    connect(job.finished, lambda text, tokens: outcome.update(text=text, tokens=tokens))
+    connect(job.result, lambda value: outcome.update(result=value))
+    connect(job.failed, lambda error: outcome.update(error=error))
+    engine.submit(job).future.result(timeout)
+    return outcome
+
+
+def test_chat_reply_and_usage(engine):
+    tokens = []
+    job = chat_job([{"role": "user", "content": "hi"}], stream=True)
+    connect(job.token_received, tokens.append)
+    assert run(engine, job) == {"text": "Hello there.", "tokens": 7}
+    assert tokens == ["Hello", " there."]
+
+
+def test_error_status_does_not_poison_the_pool(engine):
+    failed = run(engine, chat_job([{"role": "user", "content": "bad"}], stream=True))
+    assert "400" in failed["error"]
+
+    for _ in range(3):
+        assert run(engine, chat_job([{"role": "user", "content": "hi"}]))["text"] == "Hello there."
+    assert run(engine, request_job("/health"))["result"]["status"] == "ok"
+
+
+def test_connection_is_reused(engine):
+    for _ in range(3):
+        run(engine, chat_job([{"role": "user", "content": "hi"}]))
+    assert len(StandInHandler.connections) == 1
+
+
+def test_cancel_closes_the_stream(engine):
+    job = chat_job([{"role": "user", "content": "hang"}], stream=True)
+    first = threading.Event()
+    connect(job.token_received, lambda _: first.set())
+    outcome = {}
+    connect(job.finished, lambda text, tokens: outcome.update(text=text, tokens=tokens))
+    engine.submit(job)
+    assert first.wait(5)
+
+    start = time.perf_counter()
+    job.cancel()
+    job.future.result(5)
+    assert time.perf_counter() - start < 2.0
+    assert outcome == {"text": "Hello", "tokens": -1}
+
+
+def on_loop(engine, func):
+    done = threading.Event()
+    engine.loop.call_soon_threadsafe(lambda: (func(), done.set()))
+    assert done.wait(5)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_preempted_before_resuming_is_requeued(engine):
+    engine.start()
+    on_loop(engine, lambda: engine.busy_slots.update({0: Job("chat")}))
+    job = chat_job([{"role": "user", "content": "hi"}], kind="summary")
+    outcome = {}
+    connect(job.finished, lambda text, tokens: outcome.update(text=text, tokens=tokens))
+    engine.submit(job)
+    wait_until(lambda: engine.waiters)
+
+    def hand_over_and_preempt():
+        # The job gets the slot and loses it again before its task ran
+        engine._release_slot(0)
+        job.preempted = True
+        job.task.cancel()
+
+    on_loop(engine, hand_over_and_preempt)
+    job.future.result(5)
+    assert outcome == {"text": "Hello there.", "tokens": 7}
+
+
+def test_slot_jobs_wait_for_the_chat_slot(engine):
+    engine.start()
+    on_loop(engine, lambda: engine.busy_slots.update({0: Job("chat")}))
+    job = engine.submit(request_job("/slots/0?action=save", {"filename": "chat.bin"}, kind="slot"))
+    time.sleep(0.2)
+    assert not job.done()
+
+    on_loop(engine, lambda: engine._release_slot(0))
+    job.future.result(5)
+    assert job.response == {"id_slot": 0, "filename": "chat.bin"}
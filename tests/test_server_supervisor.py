@@ -0,0 +1,67 @@
+import http.server
+import signal
+import sys
+import threading
+import time
+
+import pytest
+from PySide6.QtCore import Qt
+
+from services.server_supervisor import ServerSupervisor
+
+# Serves /health like a loaded llama.cpp server, optionally ignoring SIGINT like a server stuck in a long decode
+SERVER = """
+import http.server, signal, sys
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "15")
+        self.end_headers()
+        self.wfile.write(b'{"status":"ok"}')
+
+    def log_message(self, *args):
+        pass
+
+if sys.argv[2] == "stubborn":
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+http.server.HTTPServer(("127.0.0.1", int(sys.argv[1])), Handler).serve_forever()
+"""
+
+
+def free_port():
+    server = http.server.HTTPServer(("127.0.0.1", 0), http.server.BaseHTTPRequestHandler)
+    port = server.server_address[1]
+    server.server_close()
+    return port
+
+
+def start(tmp_path, mode):
+    port = free_port()
+    supervisor = ServerSupervisor(port=port, log_path=str(tmp_path / "server.log"), max_restarts=0,
+                                  stop_timeout=0.5)
+    supervisor.command_factory = lambda: [sys.executable, "-c", SERVER, str(port), mode]
+    stopped = threading.Event()
+    supervisor.stopped.connect(stopped.set, Qt.DirectConnection)
+    supervisor.start()
+    deadline = time.monotonic() + 10
+    while not supervisor.is_ready:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    return supervisor, stopped
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="SIGINT is only sent on POSIX")
+@pytest.mark.parametrize("mode, killed", [("polite", False), ("stubborn", True)])
+def test_stop_returns_at_once_and_the_server_exits(tmp_path, mode, killed):
+    supervisor, stopped = start(tmp_path, mode)
+    process = supervisor.process
+
+    start_time = time.perf_counter()
+    supervisor.stop()
+    assert time.perf_counter() - start_time < 0.1
+
+    assert stopped.wait(5)
+    assert (process.returncode == -signal.SIGKILL) == killed
+    supervisor.wait()
+    assert supervisor.process is None